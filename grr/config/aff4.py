@@ -21,3 +21,42 @@ config_lib.DEFINE_string(
     "AFF4.change_email", None,
     "Email used by AFF4NotificationEmailListener to notify "
     "about AFF4 changes.")
+
+config_lib.DEFINE_integer(
+    "AFF4.read_ahead_max_chunks", 64,
+    "Maximum number of chunks of an AFF4 image prefetched in the background "
+    "while it is read sequentially.")
+
+config_lib.DEFINE_integer(
+    "AFF4.read_ahead_threads", 10,
+    "Number of threads prefetching the chunks of AFF4 images.")
+
+config_lib.DEFINE_integer(
+    "AFF4.chunk_cache_max_bytes", 32 * 1024 * 1024,
+    "Maximum size in bytes of the chunks cached by an AFF4 image.")
+
+config_lib.DEFINE_integer(
+    "AFF4.child_index_flush_interval", 0,
+    "If set, the child index entries of the created objects are collected "
+    "and written to the data store in batches every this many seconds. If 0, "
+    "they are written along with each object.")
+
+config_lib.DEFINE_integer(
+    "AFF4.child_index_max_pending", 10000,
+    "Number of pending child index entries which triggers a write, regardless "
+    "of AFF4.child_index_flush_interval.")
+
+config_lib.DEFINE_integer(
+    "AFF4.recursive_list_batch_size", 1000,
+    "Number of urns whose children are listed by each data store query when "
+    "AFF4 trees are listed recursively.")
+
+config_lib.DEFINE_integer(
+    "AFF4.recursive_list_fan_out", 10,
+    "Number of queries listing the children of an AFF4 tree which run "
+    "concurrently. If 1, the tree is listed by the calling thread.")
+
+config_lib.DEFINE_integer(
+    "AFF4.delete_batch_size", 1000,
+    "Number of AFF4 objects listed, opened and deleted at once when deleting "
+    "a tree of objects.")
@@ -16,6 +16,24 @@ config_lib.DEFINE_integer("Dataserver.max_connections", 5,
                           ("Maximum number of connections to the data server "
                            "per process."))
 
+config_lib.DEFINE_bool("Dataserver.auto_rebalance", False,
+                       ("If set, the master rebalances the data servers on its "
+                        "own when one of them holds too much data or serves "
+                        "too many requests."))
+
+config_lib.DEFINE_integer("Dataserver.auto_rebalance_interval", 3600,
+                          ("Minimum time in seconds between two automatic "
+                           "rebalancing operations."))
+
+config_lib.DEFINE_float("Dataserver.auto_rebalance_size_ratio", 1.5,
+                        ("A data server holding more than this many times the "
+                         "average size triggers automatic rebalancing."))
+
+config_lib.DEFINE_float("Dataserver.auto_rebalance_load_ratio", 2.0,
+                        ("A data server serving more than this many times the "
+                         "average number of requests triggers automatic "
+                         "rebalancing."))
+
 config_lib.DEFINE_integer("Dataserver.port", 7000,
                           "Port for a specific data server.")
 
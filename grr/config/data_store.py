@@ -40,6 +40,121 @@ config_lib.DEFINE_string(
     help=("Location of the data store (usually a "
           "filesystem directory)"))
 
+config_lib.DEFINE_choice(
+    "Datastore.compression_codec",
+    default="none",
+    choices=["none", "zlib", "bz2"],
+    help=("Codec large values are compressed with before they are stored. "
+          "Compressed values are marked, so values stored before compression "
+          "was enabled stay readable."))
+
+config_lib.DEFINE_integer(
+    "Datastore.compression_level",
+    default=6,
+    help="Compression level of Datastore.compression_codec, from 1 to 9.")
+
+config_lib.DEFINE_integer(
+    "Datastore.compression_threshold",
+    default=4096,
+    help="Values at least this many bytes long are compressed.")
+
+config_lib.DEFINE_list(
+    "Datastore.compressed_attributes", ["aff4:flow_state/"],
+    help=("Prefixes of the attributes whose values are compressed whatever "
+          "their size, as long as this makes them smaller. The default "
+          "matches the records of the flow states."))
+
+# Caching data store.
+config_lib.DEFINE_string(
+    "CachingDataStore.implementation",
+    default="FakeDataStore",
+    help=("Storage subsystem whose reads are cached when "
+          "Datastore.implementation is CachingDataStore."))
+
+config_lib.DEFINE_list(
+    "CachingDataStore.subjects",
+    [r"aff4:/foreman$", r"aff4:/config/", r"aff4:/ACL/"],
+    help=("Regular expressions matching the start of the subjects whose reads "
+          "are cached. Subjects which are frequently written by other "
+          "processes, such as running hunts, should only be added along with "
+          "CachingDataStore.invalidation_channel."))
+
+config_lib.DEFINE_integer(
+    "CachingDataStore.ttl",
+    default=60,
+    help=("Number of seconds cached reads are used for, unless the subject is "
+          "written in the meantime."))
+
+config_lib.DEFINE_integer(
+    "CachingDataStore.max_size",
+    default=10000,
+    help="Number of reads kept in the data store cache.")
+
+config_lib.DEFINE_bool(
+    "CachingDataStore.invalidation_channel",
+    default=False,
+    help=("If set, writes to cached subjects are recorded in the data store so "
+          "that other processes invalidate their caches too."))
+
+config_lib.DEFINE_integer(
+    "CachingDataStore.invalidation_poll_interval",
+    default=1,
+    help=("Number of seconds between two reads of the invalidations written "
+          "by other processes."))
+
+# Instrumented data store.
+config_lib.DEFINE_string(
+    "InstrumentedDataStore.implementation",
+    default="FakeDataStore",
+    help=("Storage subsystem whose calls are measured when "
+          "Datastore.implementation is InstrumentedDataStore."))
+
+config_lib.DEFINE_float(
+    "InstrumentedDataStore.hot_subjects_sample_rate",
+    default=0.01,
+    help=("Fraction of the data store calls used to find the subjects "
+          "accessed the most."))
+
+config_lib.DEFINE_integer(
+    "InstrumentedDataStore.hot_subjects_max_tracked",
+    default=10000,
+    help=("Maximum number of subjects whose sampled accesses are counted. "
+          "The least accessed half is dropped when it is reached."))
+
+config_lib.DEFINE_integer(
+    "InstrumentedDataStore.hot_subjects_report_size",
+    default=50,
+    help="Number of subjects reported as the most accessed ones.")
+
+# Recording data store.
+config_lib.DEFINE_string(
+    "RecordingDataStore.implementation",
+    default="FakeDataStore",
+    help=("Storage subsystem whose calls are recorded when "
+          "Datastore.implementation is RecordingDataStore."))
+
+config_lib.DEFINE_string(
+    "RecordingDataStore.trace_path",
+    default="%(Config.prefix)/var/grr-datastore-trace",
+    help=("Path of the data store call traces. Each process adds its pid to "
+          "it."))
+
+config_lib.DEFINE_float(
+    "RecordingDataStore.sample_rate",
+    default=1.0,
+    help="Fraction of the data store calls which are recorded.")
+
+config_lib.DEFINE_bool(
+    "RecordingDataStore.redact_values",
+    default=True,
+    help=("If set, the values written are recorded as placeholders of the "
+          "same size."))
+
+config_lib.DEFINE_integer(
+    "RecordingDataStore.max_trace_size",
+    default=1024 * 1024 * 1024,
+    help="Size of a trace in bytes at which recording stops.")
+
 # SQLite data store.
 config_lib.DEFINE_integer(
     "SqliteDatastore.vacuum_check",
@@ -72,6 +187,44 @@ config_lib.DEFINE_integer(
     help=("Number of file handles kept in the SQLite "
           "data_store cache."))
 
+config_lib.DEFINE_integer(
+    "SqliteDatastore.reader_pool_size",
+    default=4,
+    help=("Number of idle read only connections kept open for each SQLite "
+          "file. Reads use them to run concurrently with writes."))
+
+config_lib.DEFINE_integer(
+    "SqliteDatastore.group_commit_size",
+    default=1000,
+    help=("Number of pending writes to a SQLite file at which they are "
+          "committed, even if no writer asked for it."))
+
+config_lib.DEFINE_float(
+    "SqliteDatastore.group_commit_latency",
+    default=0.1,
+    help=("Maximum number of seconds writes to a SQLite file wait for other "
+          "writes to be committed with. Pending writes are also committed "
+          "when the data store is flushed."))
+
+# Log structured data store.
+config_lib.DEFINE_integer(
+    "LogStructuredDatastore.memtable_size",
+    default=16 * 1024 * 1024,
+    help=("Number of bytes written to the in-memory table before it is "
+          "written out to a segment file."))
+
+config_lib.DEFINE_integer(
+    "LogStructuredDatastore.index_interval",
+    default=32,
+    help=("Number of subjects between two entries of the sparse index "
+          "kept for each segment file."))
+
+config_lib.DEFINE_integer(
+    "LogStructuredDatastore.max_segments",
+    default=8,
+    help=("Number of segment files at which they get merged into a single "
+          "one in the background."))
+
 # MySQLAdvanced data store.
 config_lib.DEFINE_string("Mysql.host", "localhost",
                          "The MySQL server hostname.")
@@ -159,6 +312,18 @@ config_lib.DEFINE_integer(
     help=("Number of seconds to wait in-between attempts"
           "to reconnect to the database."))
 
+config_lib.DEFINE_integer(
+    "HTTPDataStore.max_batch_size",
+    100,
+    help=("Maximum number of commands sent to a data server in a single "
+          "batch."))
+
+config_lib.DEFINE_integer(
+    "HTTPDataStore.max_pending_requests",
+    100,
+    help=("Number of requests whose responses have not been read yet at which "
+          "a connection to a data server is synced before being reused."))
+
 config_lib.DEFINE_string(
     "CloudBigtable.project_id",
     default=None,
@@ -54,6 +54,30 @@ config_lib.DEFINE_integer("Worker.queue_shards", 5,
                           "Queue notifications will be sharded across "
                           "this number of datastore subjects.")
 
+config_lib.DEFINE_integer("Worker.processes", 1,
+                          "The number of worker processes to run. If this is "
+                          "more than one, the worker supervises this many "
+                          "worker processes which divide the notification "
+                          "shards among themselves.")
+
+config_lib.DEFINE_integer("Worker.shard_lease_time", 60,
+                          "How long a worker process holds on to its "
+                          "notification shards after it stops renewing its "
+                          "leases, e.g. because it died.")
+
+config_lib.DEFINE_integer("Worker.prefetch_batch_size", 0,
+                          "If set, the worker locks and reads flows, their "
+                          "completed requests and their responses in batches "
+                          "of this size. This saves data store round trips "
+                          "which helps with remote data stores. 0 disables "
+                          "prefetching.")
+
+config_lib.DEFINE_bool("Worker.pack_responses", False,
+                       "If True, the responses to a flow request are packed "
+                       "into a few chunks once its status message arrives. "
+                       "This makes reading requests with many responses much "
+                       "cheaper for the worker.")
+
 config_lib.DEFINE_integer("Worker.notification_expiry_time", 600,
                           "The queue manager expires stale notifications "
                           "after this many seconds.")
@@ -62,6 +86,24 @@ config_lib.DEFINE_integer("Worker.notification_retry_interval", 30,
                           "The queue manager retries to work on requests it "
                           "could not complete after this many seconds.")
 
+config_lib.DEFINE_string("Worker.notification_channel_class",
+                         "NotificationChannel",
+                         "The channel used to wake up workers when new "
+                         "notifications are written. The default does not "
+                         "signal and workers just poll. Use "
+                         "LocalSocketNotificationChannel if all frontends and "
+                         "workers run on a single host.")
+
+config_lib.DEFINE_string("Worker.notification_channel_path",
+                         "/tmp/grr_notification_channel",
+                         "The directory holding the sockets of the "
+                         "LocalSocketNotificationChannel.")
+
+config_lib.DEFINE_integer("Worker.notification_channel_fallback_interval", 10,
+                          "If the notification channel signals workers, they "
+                          "still scan for notifications after this many "
+                          "seconds without a signal.")
+
 # We write a journal entry for the flow when it's about to be processed.
 # If the journal entry is there after this time, the flow will get terminated.
 config_lib.DEFINE_integer(
@@ -157,6 +199,20 @@ config_lib.DEFINE_integer("Frontend.message_expiry_time", 600,
                           "Maximum time messages remain valid within the "
                           "system.")
 
+config_lib.DEFINE_integer("Frontend.cipher_cache_size", 50000,
+                          "Maximum number of outbound session ciphers the "
+                          "frontend keeps for clients.")
+
+config_lib.DEFINE_integer("Frontend.cipher_cache_max_age", 24 * 60 * 60,
+                          "Outbound session ciphers are rotated after this "
+                          "many seconds.")
+
+config_lib.DEFINE_integer("Frontend.last_seen_flush_interval", 0,
+                          "If set, the CLIENT_IP, CLOCK and PING updates of "
+                          "polling clients are kept in memory and written to "
+                          "the data store in batches every this many seconds. "
+                          "If 0, they are written on every poll.")
+
 config_lib.DEFINE_string("Frontend.upload_store", "FileUploadFileStore",
                          "The implementation of the upload file store.")
 
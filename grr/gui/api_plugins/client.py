@@ -64,6 +64,23 @@ class ApiClientId(rdfvalue.RDFString):
     return rdf_client.ClientURN(self._value)
 
 
+_CLIENT_SCHEMA = aff4_grr.VFSGRRClient.SchemaCls
+
+# The client attributes used by ApiClient.InitFromAff4Object().
+API_CLIENT_ATTRIBUTES = [
+    _CLIENT_SCHEMA.CLIENT_INFO, _CLIENT_SCHEMA.HARDWARE_INFO,
+    _CLIENT_SCHEMA.SYSTEM, _CLIENT_SCHEMA.HOSTNAME, _CLIENT_SCHEMA.OS_RELEASE,
+    _CLIENT_SCHEMA.OS_VERSION, _CLIENT_SCHEMA.KERNEL, _CLIENT_SCHEMA.ARCH,
+    _CLIENT_SCHEMA.FQDN, _CLIENT_SCHEMA.INSTALL_DATE,
+    _CLIENT_SCHEMA.KNOWLEDGE_BASE, _CLIENT_SCHEMA.MEMORY_SIZE,
+    _CLIENT_SCHEMA.FIRST_SEEN, _CLIENT_SCHEMA.PING,
+    _CLIENT_SCHEMA.LAST_BOOT_TIME, _CLIENT_SCHEMA.CLOCK,
+    _CLIENT_SCHEMA.LAST_CRASH, _CLIENT_SCHEMA.LABELS,
+    _CLIENT_SCHEMA.INTERFACES, _CLIENT_SCHEMA.VOLUMES,
+    _CLIENT_SCHEMA.CLOUD_INSTANCE
+]
+
+
 class ApiClient(rdf_structs.RDFProtoStruct):
   """API client object."""
 
@@ -165,7 +182,8 @@ class ApiSearchClientsHandler(api_call_handler_base.ApiCallHandler):
     result_urns = sorted(
         index.LookupClients(keywords), key=str)[args.offset:args.offset + end]
 
-    result_set = aff4.FACTORY.MultiOpen(result_urns, token=token)
+    result_set = aff4.FACTORY.MultiOpen(
+        result_urns, token=token, projection=API_CLIENT_ATTRIBUTES)
 
     api_clients = []
     for child in result_set:
@@ -210,7 +228,10 @@ class ApiLabelsRestrictedSearchClientsHandler(
       all_urns.update(index.LookupClients(label_filter))
 
     all_objs = aff4.FACTORY.MultiOpen(
-        sorted(all_urns, key=str), aff4_type=aff4_grr.VFSGRRClient, token=token)
+        sorted(all_urns, key=str),
+        aff4_type=aff4_grr.VFSGRRClient,
+        token=token,
+        projection=API_CLIENT_ATTRIBUTES)
 
     api_clients = []
     index = 0
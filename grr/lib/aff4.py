@@ -6,7 +6,10 @@ This contains an AFF4 data model implementation.
 
 import __builtin__
 import abc
+import atexit
+import collections
 import itertools
+import Queue
 import StringIO
 import threading
 import time
@@ -22,6 +25,7 @@ from grr.lib import lexer
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
+from grr.lib import threadpool
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.rdfvalues import aff4_rdfvalues
@@ -259,6 +263,101 @@ class DeletionPool(object):
     return self._urns_for_deletion
 
 
+class SubtreeDeletion(object):
+  """Deletes trees of objects, streaming them in batches.
+
+  The trees are walked depth first, AFF4.delete_batch_size urns at a time, so
+  memory only grows with the depth of the trees and the width of their
+  directories. Once a batch is listed, the OnDelete() hooks of its objects
+  run with a DeletionPool limited to the batch. The objects are deleted after
+  all their children, through a MutationPool flushed whenever a batch worth of
+  mutations is pending.
+
+  Objects are only removed once nothing is left below them and the roots are
+  only removed from the index of their parents at the end, so the remaining
+  objects stay reachable: an interrupted deletion is resumed by deleting the
+  same roots again.
+  """
+
+  def __init__(self, token=None, progress_callback=None):
+    """Constructor.
+
+    Args:
+      token: The security token used for the deletion.
+      progress_callback: If set, called after every flush of the deletions.
+    """
+    self.token = token
+    self.progress_callback = progress_callback
+    self.batch_size = config.CONFIG["AFF4.delete_batch_size"]
+    self.mutation_pool = data_store.DB.GetMutationPool(token=token)
+    self.deleted = 0
+
+  def Run(self, roots):
+    """Deletes the roots and everything below them."""
+    self._DeleteSubtrees(roots)
+    self._DeleteFromParentIndex(roots)
+    self.Flush()
+
+  def _DeleteFromParentIndex(self, roots):
+    for root in roots:
+      # Only the index of the parent object should be updated. Everything
+      # below the target object (along with indexes) is deleted.
+      FACTORY._DeleteChildFromIndex(  # pylint: disable=protected-access
+          root, self.token, mutation_pool=self.mutation_pool)
+
+  def _DeleteSubtrees(self, urns):
+    for batch in utils.Grouper(urns, self.batch_size):
+      listing = dict(FACTORY.MultiListChildren(batch, token=self.token))
+
+      deletion_pool = DeletionPool(token=self.token)
+      # pylint: disable=protected-access
+      deletion_pool._children_lists_cache.update(listing)
+      # pylint: enable=protected-access
+      for obj in deletion_pool.MultiOpen(batch):
+        obj.OnDelete(deletion_pool=deletion_pool)
+
+      # Objects marked by the hooks were listed recursively by the pool.
+      if deletion_pool.urns_for_deletion:
+        self._Delete(list(deletion_pool.urns_for_deletion))
+        self._DeleteFromParentIndex(deletion_pool.root_urns_for_deletion)
+
+      children = list(itertools.chain.from_iterable(listing.itervalues()))
+      del listing, deletion_pool
+      if children:
+        self._DeleteSubtrees(children)
+
+      self._Delete(batch)
+
+  def _Delete(self, urns):
+    for urn in urns:
+      try:
+        FACTORY.intermediate_cache.ExpireObject(urn.Path())
+      except KeyError:
+        pass
+    if FACTORY.child_index_writer:
+      FACTORY.child_index_writer.Discard(urns)
+
+    self.mutation_pool.DeleteSubjects(urns)
+    self.deleted += len(urns)
+    if self.mutation_pool.Size() >= self.batch_size:
+      self.Flush()
+
+  def Flush(self):
+    self.mutation_pool.Flush()
+    logging.debug("Removed %d objects", self.deleted)
+    if self.progress_callback:
+      self.progress_callback()
+
+
+def _ProjectedPredicates(projection):
+  """Returns the predicates to read for a projection of attributes."""
+  # The type is needed to instantiate the object.
+  predicates = set([AFF4Object.SchemaCls.TYPE.predicate])
+  for attribute in projection:
+    predicates.add(getattr(attribute, "predicate", attribute))
+  return predicates
+
+
 def _ValidateAFF4Type(aff4_type):
   """Validates and normalizes aff4_type to class object."""
   if aff4_type is None:
@@ -273,6 +372,144 @@ def _ValidateAFF4Type(aff4_type):
   return aff4_type
 
 
+class ChildIndexWriter(object):
+  """Coalesces the child index updates of the objects created by a process.
+
+  Instead of writing the index:dir entries of all the ancestors of every new
+  object, the pending (parent, child) pairs of all the threads are collected
+  and deduplicated, then written in bulk through a MutationPool by a
+  background thread, or as soon as max_pending of them are waiting.
+
+  Pairs already written are remembered in the intermediate cache of the
+  factory so they are not written again until they expire from it. Pairs that
+  could not be written are queued again.
+  """
+
+  def __init__(self, intermediate_cache, flush_interval, max_pending=10000,
+               token=None):
+    """Constructor.
+
+    Args:
+      intermediate_cache: The cache of the urns whose index entries exist.
+      flush_interval: How often (in seconds) pending entries are written.
+      max_pending: How many pending entries trigger a write.
+      token: The token to use for writing.
+    """
+    self.intermediate_cache = intermediate_cache
+    self.flush_interval = flush_interval
+    self.max_pending = max_pending
+    self.token = token
+    self.lock = threading.RLock()
+    # Only one flush runs at a time so that once Flush() returns, all the
+    # entries added before it are in the data store.
+    self.flush_lock = threading.Lock()
+    # Maps parent urns to the basenames of their pending children.
+    self.pending = {}
+    self.pending_paths = set()
+    self.last_flush = time.time()
+
+    self.flush_thread = utils.InterruptableThread(
+        name="ChildIndexWriter",
+        target=self._PeriodicFlush,
+        sleep_time=flush_interval)
+    self.flush_thread.start()
+
+  def Add(self, urn):
+    """Queues the index entries of urn and its ancestors."""
+    full = False
+    with self.lock:
+      while urn.Path() != "/":
+        path = urn.Path()
+        # The ancestors of an urn already indexed or pending are as well.
+        if path in self.pending_paths:
+          break
+        try:
+          self.intermediate_cache.Get(path)
+          break
+        except KeyError:
+          pass
+
+        dirname = rdfvalue.RDFURN(urn.Dirname())
+        self.pending.setdefault(dirname, set()).add(urn.Basename())
+        self.pending_paths.add(path)
+        stats.STATS.IncrementCounter("aff4_child_index_updates")
+        urn = dirname
+
+      full = len(self.pending_paths) >= self.max_pending
+
+    if full:
+      self.Flush()
+
+  def Discard(self, urns):
+    """Drops the pending entries of deleted urns."""
+    with self.lock:
+      for urn in urns:
+        path = urn.Path()
+        if path not in self.pending_paths:
+          continue
+
+        self.pending_paths.discard(path)
+        dirname = rdfvalue.RDFURN(urn.Dirname())
+        children = self.pending.get(dirname, set())
+        children.discard(urn.Basename())
+        if not children:
+          self.pending.pop(dirname, None)
+
+  def _PeriodicFlush(self):
+    # Entries are written by size in between, only flush when they are due.
+    if time.time() - self.last_flush < self.flush_interval:
+      return
+
+    try:
+      self.Flush()
+    except Exception:  # pylint: disable=broad-except
+      # The entries are queued again, the next flush retries them.
+      logging.exception("Failed to write child index entries.")
+
+  def Flush(self):
+    """Writes all the pending index entries to the data store."""
+    with self.flush_lock:
+      self.last_flush = time.time()
+      with self.lock:
+        pending, self.pending = self.pending, {}
+        paths, self.pending_paths = self.pending_paths, set()
+
+      if not pending:
+        return
+
+      try:
+        self._Write(pending)
+      except Exception:
+        with self.lock:
+          for dirname, basenames in pending.iteritems():
+            self.pending.setdefault(dirname, set()).update(basenames)
+          self.pending_paths.update(paths)
+        raise
+
+      for path in paths:
+        self.intermediate_cache.Put(path, 1)
+
+      stats.STATS.IncrementCounter("aff4_child_index_writes", len(pending))
+
+  def _Write(self, pending):
+    now = rdfvalue.RDFDatetime.Now().SerializeToDataStore()
+    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+      for dirname, basenames in pending.iteritems():
+        attributes = {}
+        for basename in basenames:
+          attributes["index:dir/%s" % utils.SmartStr(basename)] = [EMPTY_DATA]
+        # See Factory._UpdateChildIndex, the root is not timestamped.
+        if dirname != u"/":
+          attributes[AFF4Object.SchemaCls.LAST] = [now]
+
+        mutation_pool.MultiSet(dirname, attributes, replace=True)
+
+  def Stop(self):
+    """Stops the background thread and writes all pending entries."""
+    self.flush_thread.Stop()
+    self.Flush()
+
+
 class Factory(object):
   """A central factory for AFF4 objects."""
 
@@ -281,6 +518,16 @@ class Factory(object):
         max_size=config.CONFIG["AFF4.intermediate_cache_max_size"],
         max_age=config.CONFIG["AFF4.intermediate_cache_age"])
 
+    self.child_index_writer = None
+    flush_interval = config.CONFIG["AFF4.child_index_flush_interval"]
+    if flush_interval > 0:
+      self.child_index_writer = ChildIndexWriter(
+          self.intermediate_cache,
+          flush_interval,
+          max_pending=config.CONFIG["AFF4.child_index_max_pending"])
+      # Registered after the data store flush, so this runs before it.
+      atexit.register(self.child_index_writer.Stop)
+
     # Create a token for system level actions. This token is used by other
     # classes such as HashFileStore and NSRLFilestore to create entries under
     # aff4:/files, as well as to create top level paths like aff4:/foreman
@@ -309,20 +556,40 @@ class Factory(object):
 
     raise RuntimeError("Unknown age specification: %s" % age)
 
-  def GetAttributes(self, urns, token=None, age=NEWEST_TIME):
-    """Retrieves all the attributes for all the urns."""
+  def GetAttributes(self, urns, token=None, age=NEWEST_TIME, projection=None):
+    """Retrieves all the attributes for all the urns.
+
+    Args:
+      urns: The urns to read.
+      token: The security token used in this call.
+      age: The age policy of the values to read.
+      projection: If set, only these attributes (and the type) are read.
+
+    Yields:
+      (urn, [(attribute, value, timestamp), ...]) tuples.
+    """
     urns = set([utils.SmartUnicode(u) for u in urns])
     to_read = {urn: self._MakeCacheInvariant(urn, token, age) for urn in urns}
 
+    prefixes = AFF4_PREFIXES
+    predicates = None
+    if projection is not None:
+      predicates = _ProjectedPredicates(projection)
+      prefixes = sorted(predicates)
+
     # Urns not present in the cache we need to get from the database.
     if to_read:
       for subject, values in data_store.DB.MultiResolvePrefix(
           to_read,
-          AFF4_PREFIXES,
+          prefixes,
           timestamp=self.ParseAgeSpecification(age),
           token=token,
           limit=None):
 
+        # The predicates are resolved as prefixes, which may match others.
+        if predicates is not None:
+          values = [value for value in values if value[0] in predicates]
+
         # Ensure the values are sorted.
         values.sort(key=lambda x: x[-1], reverse=True)
 
@@ -376,6 +643,10 @@ class Factory(object):
       mutation_pool: An optional MutationPool object to write to. If not given,
                      the data_store is used directly.
     """
+    if self.child_index_writer:
+      self.child_index_writer.Add(urn)
+      return
+
     try:
       # Create navigation aids by touching intermediate subject names.
       while urn.Path() != "/":
@@ -426,6 +697,8 @@ class Factory(object):
         self.intermediate_cache.ExpireObject(urn.Path())
       except KeyError:
         pass
+      if self.child_index_writer:
+        self.child_index_writer.Discard([urn])
 
       pool.DeleteAttributes(dirname,
                             ["index:dir/%s" % utils.SmartStr(basename)])
@@ -577,6 +850,81 @@ class Factory(object):
         follow_symlinks=False,
         transaction=transaction)
 
+  def MultiOpenWithLock(self,
+                        urns,
+                        aff4_type=None,
+                        token=None,
+                        lease_time=100):
+    """Locks and opens a number of urns, reading them in a single query.
+
+    Locking never blocks, urns which are locked already are skipped. The
+    returned objects must be closed (or used in a 'with' statement) by the
+    caller to release the locks.
+
+    Args:
+      urns: The urns to open.
+      aff4_type: If this optional parameter is set, objects which are not an
+          instance of this type are released and skipped.
+      token: The Security Token to use for opening these items.
+      lease_time: Maximum time the objects stay locked.
+
+    Returns:
+      A list of the opened objects.
+    """
+    transactions = {}
+    try:
+      for urn in urns:
+        urn = rdfvalue.RDFURN(urn)
+        try:
+          transactions[urn] = self._AcquireLock(
+              urn,
+              token=token,
+              blocking=False,
+              blocking_lock_timeout=10,
+              blocking_sleep_interval=1,
+              lease_time=lease_time)
+        except LockError:
+          pass
+
+      if not transactions:
+        return []
+
+      # Since we now own the data store subjects, we can read them all at once.
+      local_cache = dict(self.GetAttributes(transactions, token=token))
+      for urn in transactions:
+        # Objects which do not exist yet do not need to be read again.
+        local_cache.setdefault(utils.SmartUnicode(urn), [])
+
+      result = []
+      for urn, transaction in transactions.items():
+        try:
+          obj = self.Open(
+              urn,
+              aff4_type=aff4_type,
+              mode="rw",
+              token=token,
+              local_cache=local_cache,
+              follow_symlinks=False,
+              transaction=transaction)
+        except InstantiationError:
+          del transactions[urn]
+          transaction.Release()
+          continue
+
+        result.append(obj)
+
+      return result
+
+    except Exception:
+      # None of the objects are returned, so none of the locks would ever be
+      # released by the caller.
+      for urn, transaction in transactions.iteritems():
+        try:
+          transaction.Release()
+        except Exception:  # pylint: disable=broad-except
+          logging.exception("Failed to release the lock on %s.", urn)
+      raise
+
   def _AcquireLock(self,
                    urn,
                    token=None,
@@ -648,7 +996,8 @@ class Factory(object):
            local_cache=None,
            age=NEWEST_TIME,
            follow_symlinks=True,
-           transaction=None):
+           transaction=None,
+           projection=None):
     """Opens the named object.
 
     This instantiates the object from the AFF4 data store.
@@ -682,6 +1031,9 @@ class Factory(object):
 
       follow_symlinks: If object opened is a symlink, follow it.
       transaction: A lock in case this object is opened under lock.
+      projection: A list of the attributes to read. Other attributes are only
+         read from the data store when they are first accessed. Unset, all the
+         attributes are read.
 
     Returns:
       An AFF4Object instance.
@@ -713,7 +1065,9 @@ class Factory(object):
       token = data_store.default_token
 
     if "r" in mode and (local_cache is None or urn not in local_cache):
-      local_cache = dict(self.GetAttributes([urn], age=age, token=token))
+      local_cache = dict(
+          self.GetAttributes(
+              [urn], age=age, token=token, projection=projection))
 
     # Read the row from the table. We know the object already exists if there is
     # some data in the local_cache already for this object.
@@ -725,7 +1079,8 @@ class Factory(object):
         age=age,
         follow_symlinks=follow_symlinks,
         object_exists=bool(local_cache.get(urn)),
-        transaction=transaction)
+        transaction=transaction,
+        projection=projection)
 
     result.aff4_type = aff4_type
 
@@ -753,8 +1108,22 @@ class Factory(object):
                 token=None,
                 aff4_type=None,
                 age=NEWEST_TIME,
-                follow_symlinks=True):
-    """Opens a bunch of urns efficiently."""
+                follow_symlinks=True,
+                projection=None):
+    """Opens a bunch of urns efficiently.
+
+    Args:
+      urns: The urns to open.
+      mode: The mode to open the objects with.
+      token: The Security Token to use for opening the objects.
+      aff4_type: If set, only objects of this type are returned.
+      age: The age policy used to build the objects.
+      follow_symlinks: If objects opened are symlinks, follow them.
+      projection: A list of the attributes to read, see Open().
+
+    Yields:
+      The AFF4Object instances.
+    """
 
     if token is None:
       token = data_store.default_token
@@ -766,7 +1135,8 @@ class Factory(object):
 
     aff4_type = _ValidateAFF4Type(aff4_type)
 
-    for urn, values in self.GetAttributes(urns, token=token, age=age):
+    for urn, values in self.GetAttributes(
+        urns, token=token, age=age, projection=projection):
       try:
         obj = self.Open(
             urn,
@@ -774,7 +1144,8 @@ class Factory(object):
             token=token,
             local_cache={urn: values},
             age=age,
-            follow_symlinks=False)
+            follow_symlinks=False,
+            projection=projection)
         # We can't pass aff4_type to Open since it will raise on AFF4Symlinks.
         # Setting it here, if needed, so that BadGetAttributeError checking
         # works.
@@ -795,7 +1166,12 @@ class Factory(object):
 
     if symlinks:
       for obj in self.MultiOpen(
-          symlinks, mode=mode, token=token, aff4_type=aff4_type, age=age):
+          symlinks,
+          mode=mode,
+          token=token,
+          aff4_type=aff4_type,
+          age=age,
+          projection=projection):
         to_link = symlinks[obj.urn]
         for additional_symlink in to_link[1:]:
           clone = obj.__class__(obj.urn, clone=obj)
@@ -1022,15 +1398,20 @@ class Factory(object):
 
     return result
 
-  def MultiDelete(self, urns, token=None):
+  def MultiDelete(self, urns, token=None, progress_callback=None):
     """Drop all the information about given objects.
 
     DANGEROUS! This recursively deletes all objects contained within the
     specified URN.
 
+    Objects are deleted in batches by SubtreeDeletion, children first. If the
+    deletion is interrupted, deleting the same urns again resumes it.
+
     Args:
       urns: Urns of objects to remove.
       token: The Security Token to use for opening this item.
+      progress_callback: If set, called after every batch of deletions is
+          written, e.g. to heartbeat a long running flow.
     Raises:
       RuntimeError: If one of the urns is too short. This is a safety check to
       ensure the root is not removed.
@@ -1044,42 +1425,30 @@ class Factory(object):
       if urn.Path() == "/":
         raise RuntimeError("Can't delete root URN. Please enter a valid URN")
 
-    deletion_pool = DeletionPool(token=token)
-    deletion_pool.MultiMarkForDeletion(urns)
-
-    marked_root_urns = deletion_pool.root_urns_for_deletion
-    marked_urns = deletion_pool.urns_for_deletion
-
-    logging.debug(u"Found %d objects to remove when removing %s",
-                  len(marked_urns), utils.SmartUnicode(urns))
-
-    logging.debug(u"Removing %d root objects when removing %s: %s",
-                  len(marked_root_urns),
-                  utils.SmartUnicode(urns),
-                  utils.SmartUnicode(marked_root_urns))
+    # Urns below other ones are deleted along with them.
+    paths = set(urn.Path() for urn in urns)
+    roots = {}
+    for urn in urns:
+      ancestor = rdfvalue.RDFURN(urn.Dirname())
+      while ancestor.Path() != "/" and ancestor.Path() not in paths:
+        ancestor = rdfvalue.RDFURN(ancestor.Dirname())
 
-    pool = data_store.DB.GetMutationPool(token=token)
-    for root in marked_root_urns:
-      # Only the index of the parent object should be updated. Everything
-      # below the target object (along with indexes) is going to be
-      # deleted.
-      self._DeleteChildFromIndex(root, token, mutation_pool=pool)
+      if ancestor.Path() == "/":
+        roots[urn.Path()] = urn
+    roots = roots.values()
 
-    for urn_to_delete in marked_urns:
-      try:
-        self.intermediate_cache.ExpireObject(urn_to_delete.Path())
-      except KeyError:
-        pass
+    logging.debug(u"Removing %d root objects when removing %s",
+                  len(roots), utils.SmartUnicode(urns))
 
-    pool.DeleteSubjects(marked_urns)
-    pool.Flush()
+    deletion = SubtreeDeletion(token=token, progress_callback=progress_callback)
+    deletion.Run(roots)
 
     # Ensure this is removed from the cache as well.
     self.Flush()
 
-    logging.debug("Removed %d objects", len(marked_urns))
+    logging.debug("Removed %d objects", deletion.deleted)
 
-  def Delete(self, urn, token=None):
+  def Delete(self, urn, token=None, progress_callback=None):
     """Drop all the information about this object.
 
     DANGEROUS! This recursively deletes all objects contained within the
@@ -1088,11 +1457,13 @@ class Factory(object):
     Args:
       urn: The object to remove.
       token: The Security Token to use for opening this item.
+      progress_callback: If set, called after every batch of deletions is
+          written.
     Raises:
       RuntimeError: If the urn is too short. This is a safety check to ensure
       the root is not removed.
     """
-    self.MultiDelete([urn], token=token)
+    self.MultiDelete([urn], token=token, progress_callback=progress_callback)
 
   def MultiListChildren(self, urns, token=None, limit=None, age=NEWEST_TIME):
     """Lists bunch of directories efficiently.
@@ -1107,6 +1478,7 @@ class Factory(object):
     Yields:
        Tuples of Subjects and a list of children urns of a given subject.
     """
+    self.FlushChildIndex()
     checked_subjects = set()
 
     index_prefix = "index:dir/"
@@ -1147,6 +1519,22 @@ class Factory(object):
         self.MultiListChildren([urn], token=token, limit=limit, age=age))[0]
     return children_urns
 
+  # When this many urns are waiting to be listed, the deepest ones are listed
+  # first so the traversal stops growing.
+  RECURSIVE_LIST_MAX_FRONTIER = 100000
+
+  RECURSIVE_LIST_POOL_NAME = "AFF4RecursiveListChildren"
+
+  def _ListChildrenBatch(self, urns, results, token=None, limit=None,
+                         age=NEWEST_TIME):
+    """Lists children of urns, queueing (listing, exception) to results."""
+    try:
+      results.put((list(
+          self.MultiListChildren(urns, token=token, limit=limit, age=age)),
+                   None))
+    except Exception as e:  # pylint: disable=broad-except
+      results.put((None, e))
+
   def RecursiveMultiListChildren(self,
                                  urns,
                                  token=None,
@@ -1154,6 +1542,12 @@ class Factory(object):
                                  age=NEWEST_TIME):
     """Recursively lists bunch of directories.
 
+    The tree is walked breadth first. The urns waiting to be listed are split
+    in batches of AFF4.recursive_list_batch_size, up to
+    AFF4.recursive_list_fan_out of which are listed concurrently by a thread
+    pool. Results are yielded as soon as a batch is listed, and only the urns
+    still to be listed are kept in memory.
+
     Args:
       urns: List of urns to list children.
       token: Security token.
@@ -1174,25 +1568,63 @@ class Factory(object):
        RecursiveMultiListChildren(['a']) will return:
        [('a', ['b']), ('b', ['c', 'd'])]
     """
+    batch_size = config.CONFIG["AFF4.recursive_list_batch_size"]
+    fan_out = config.CONFIG["AFF4.recursive_list_fan_out"]
 
-    checked_urns = set()
-    urns_to_check = urns
-    while True:
-      found_children = []
+    pool = None
+    if fan_out > 1:
+      pool = threadpool.ThreadPool.Factory(self.RECURSIVE_LIST_POOL_NAME,
+                                           fan_out)
+      pool.Start()
+
+    # Every urn has a single parent, so only the given urns can be reached
+    # twice, when some of them are below others.
+    roots = set()
+    frontier = collections.deque()
+    for urn in urns:
+      if utils.SmartUnicode(urn) not in roots:
+        roots.add(utils.SmartUnicode(urn))
+        frontier.append(urn)
+
+    results = Queue.Queue()
+    in_flight = 0
+    while frontier or in_flight:
+      while frontier and in_flight < max(fan_out, 1):
+        size = min(batch_size, len(frontier))
+        if len(frontier) > self.RECURSIVE_LIST_MAX_FRONTIER:
+          batch = [frontier.pop() for _ in xrange(size)]
+        else:
+          batch = [frontier.popleft() for _ in xrange(size)]
 
-      for subject, values in self.MultiListChildren(
-          urns_to_check, token=token, limit=limit, age=age):
+        args = (batch, results, token, limit, age)
+        if pool is None:
+          self._ListChildrenBatch(*args)
+        else:
+          pool.AddTask(
+              target=self._ListChildrenBatch,
+              args=args,
+              name="RecursiveMultiListChildren")
+        in_flight += 1
 
-        found_children.extend(values)
-        yield subject, values
+      listing, error = results.get()
+      in_flight -= 1
+      if error is not None:
+        raise error
 
-      checked_urns.update(urns_to_check)
+      for subject, children in listing:
+        yield subject, children
 
-      urns_to_check = set(found_children) - checked_urns
-      if not urns_to_check:
-        break
+        for child in children:
+          if utils.SmartUnicode(child) not in roots:
+            frontier.append(child)
+
+  def FlushChildIndex(self):
+    """Writes the child index entries which are still pending."""
+    if self.child_index_writer:
+      self.child_index_writer.Flush()
 
   def Flush(self):
+    self.FlushChildIndex()
     data_store.DB.Flush()
     self.intermediate_cache.Flush()
 
@@ -1516,6 +1948,10 @@ class AFF4Object(object):
   # The data store transaction this object uses while it is being locked.
   transaction = None
 
+  # The predicates read when the object was opened with a projection. Objects
+  # pickled before projections were supported have none.
+  projection = None
+
   @property
   def locked(self):
     """Is this object currently locked?"""
@@ -1653,7 +2089,8 @@ class AFF4Object(object):
                aff4_type=None,
                object_exists=False,
                mutation_pool=None,
-               transaction=None):
+               transaction=None,
+               projection=None):
     if urn is not None:
       urn = rdfvalue.RDFURN(urn)
     self.urn = urn
@@ -1693,6 +2130,16 @@ class AFF4Object(object):
     # are new attributes which still need to be flushed to the data_store. When
     # this object is instantiated we populate self.synced_attributes with the
     # data_store, while the finish method flushes new changes.
+    # Serialized values of predicates which are not defined by any schema, keyed
+    # by predicate. Objects can use these for data which does not fit a fixed
+    # schema, e.g. flows store their state with one predicate per key.
+    self.raw_attributes = {}
+
+    # Attributes outside of the projection are read when first accessed.
+    self.projection = None
+    if projection is not None:
+      self.projection = _ProjectedPredicates(projection)
+
     if clone is not None:
       if isinstance(clone, dict):
         # Just use these as the attributes, do not go to the data store. This is
@@ -1705,6 +2152,9 @@ class AFF4Object(object):
         # data_store now.
         self.new_attributes = clone.new_attributes.copy()
         self.synced_attributes = clone.synced_attributes.copy()
+        self.raw_attributes = clone.raw_attributes.copy()
+        if clone.projection is not None:
+          self.projection = clone.projection.copy()
 
       else:
         raise RuntimeError("Cannot clone from %s." % clone)
@@ -1722,7 +2172,7 @@ class AFF4Object(object):
         else:
           # Populate the caches from the data store.
           for urn, values in FACTORY.GetAttributes(
-              [urn], age=age, token=self.token):
+              [urn], age=age, token=self.token, projection=projection):
             for attribute_name, value, ts in values:
               self.DecodeValueFromAttribute(attribute_name, value, ts)
 
@@ -1758,11 +2208,30 @@ class AFF4Object(object):
                                 LazyDecoder(cls, value, ts),
                                 self.synced_attributes)
     except KeyError:
-      pass
+      # Values are read newest first, keep the newest one.
+      self.raw_attributes.setdefault(attribute_name, value)
     except (ValueError, rdfvalue.DecodeError):
       logging.debug("%s: %s invalid encoding. Skipping.", self.urn,
                     attribute_name)
 
+  @utils.Synchronized
+  def _FaultInAttribute(self, attribute):
+    """Reads an attribute which is not part of the object's projection."""
+    if (self.projection is None or attribute.predicate in self.projection or
+        isinstance(attribute, SubjectAttribute)):
+      return
+
+    self.projection.add(attribute.predicate)
+    if "r" not in self.mode:
+      return
+
+    for _, values in FACTORY.GetAttributes(
+        [self.urn], age=self.age_policy, token=self.token,
+        projection=[attribute]):
+      for attribute_name, value, ts in values:
+        if attribute_name == attribute.predicate:
+          self.DecodeValueFromAttribute(attribute_name, value, ts)
+
   def _AddAttributeToCache(self, attribute_name, value, cache):
     """Helper to add a new attribute to a cache."""
     # If there's another value in cache with the same timestamp, the last added
@@ -2013,6 +2482,9 @@ class AFF4Object(object):
     self._CheckAttribute(attribute, value)
     # Does this represent a new version?
     if attribute.versioned:
+      # The new version is added to the ones already stored.
+      self._FaultInAttribute(attribute)
+
       if attribute.creates_new_object_version:
         self._new_version = True
 
@@ -2029,6 +2501,8 @@ class AFF4Object(object):
       self.synced_attributes.pop(attribute, None)
       self.new_attributes.pop(attribute, None)
       value.age = 0
+      if self.projection is not None:
+        self.projection.add(attribute.predicate)
 
     self._AddAttributeToCache(attribute, value, self.new_attributes)
     self._dirty = True
@@ -2044,6 +2518,7 @@ class AFF4Object(object):
     if self.mode != "w" and attribute.lock_protected and not self.transaction:
       raise IOError("Object must be locked to delete attribute %s." % attribute)
 
+    self._FaultInAttribute(attribute)
     if attribute in self.synced_attributes:
       self._to_delete.add(attribute)
       del self.synced_attributes[attribute]
@@ -2069,6 +2544,7 @@ class AFF4Object(object):
     Checking Get against None doesn't work as Get will return a default
     attribute value. This determines if the attribute has been manually set.
     """
+    self._FaultInAttribute(attribute)
     return (attribute in self.synced_attributes or
             attribute in self.new_attributes)
 
@@ -2113,6 +2589,7 @@ class AFF4Object(object):
     elif isinstance(attribute, basestring):
       attribute = Attribute.GetAttributeByName(attribute)
 
+    self._FaultInAttribute(attribute)
     return attribute.GetValues(self)
 
   def Update(self, attribute=None, user=None, priority=None):
@@ -2339,6 +2816,7 @@ class AFF4Volume(AFF4Object):
       RDFURNs instances of each child.
     """
     # Just grab all the children from the index.
+    FACTORY.FlushChildIndex()
     index_prefix = "index:dir/"
     for predicate, _, timestamp in data_store.DB.ResolvePrefix(
         self.urn,
@@ -2688,16 +3166,60 @@ class AFF4UnversionedMemoryStream(AFF4MemoryStreamBase):
 
 
 class ChunkCache(utils.FastStore):
-  """A cache which closes its objects when they expire."""
+  """A cache which closes its objects when they expire.
+
+  Besides the number of chunks, the cache can be bounded by the total size of
+  the chunks, as they were when added to the cache.
+  """
 
   def __init__(self, kill_cb=None, *args, **kw):
     self.kill_cb = kill_cb
+    self.max_bytes = kw.pop("max_bytes", None)
+    self.size = 0
+    self._sizes = {}
     super(ChunkCache, self).__init__(*args, **kw)
 
   def KillObject(self, obj):
     if self.kill_cb:
       self.kill_cb(obj)
 
+  def _Forget(self, key):
+    self.size -= self._sizes.pop(key, 0)
+
+  @utils.Synchronized
+  def Expire(self):
+    """Expires the oldest chunks until the cache is within its bounds."""
+    while self._age and (len(self._age) > self._limit or
+                         (self.max_bytes and self.size > self.max_bytes and
+                          len(self._age) > 1)):
+      node = self._age.PopLeft()
+      self._hash.pop(node.key, None)
+      self._Forget(node.key)
+      self.KillObject(node.data)
+
+  @utils.Synchronized
+  def Put(self, key, obj):
+    self._Forget(key)
+    self._sizes[key] = getattr(obj, "len", 0)
+    self.size += self._sizes[key]
+    return super(ChunkCache, self).Put(key, obj)
+
+  @utils.Synchronized
+  def ExpireObject(self, key):
+    self._Forget(key)
+    return super(ChunkCache, self).ExpireObject(key)
+
+  @utils.Synchronized
+  def Pop(self, key):
+    self._Forget(key)
+    return super(ChunkCache, self).Pop(key)
+
+  @utils.Synchronized
+  def Flush(self):
+    super(ChunkCache, self).Flush()
+    self._sizes = {}
+    self.size = 0
+
   def __getstate__(self):
     if self.kill_cb:
       raise NotImplementedError("Can't pickle callback.")
@@ -2721,9 +3243,13 @@ class AFF4ImageBase(AFF4Stream):
   # Subclasses should set the name of the type of stream to use for chunks.
   STREAM_TYPE = None
 
-  # How many chunks should be cached.
+  # How many chunks are read along with a chunk missing from the cache.
   LOOK_AHEAD = 10
 
+  # Prefetching of the chunks is done by this thread pool, shared by all the
+  # images.
+  READ_AHEAD_POOL_NAME = "AFF4ReadAhead"
+
   class SchemaCls(AFF4Stream.SchemaCls):
     """The schema for AFF4ImageBase."""
     _CHUNKSIZE = Attribute(
@@ -2801,7 +3327,7 @@ class AFF4ImageBase(AFF4Stream):
     super(AFF4ImageBase, self).Initialize()
     self.offset = 0
     # A cache for segments.
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self._InitChunkCache()
 
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
@@ -2813,6 +3339,20 @@ class AFF4ImageBase(AFF4Stream):
       self.size = 0
       self.content_last = None
 
+  def _InitChunkCache(self):
+    self.chunk_cache = ChunkCache(
+        self._WriteChunk,
+        100,
+        max_bytes=config.CONFIG["AFF4.chunk_cache_max_bytes"])
+
+    # The chunks being prefetched, mapped to an event set once they are read.
+    self._prefetching = {}
+    self._prefetch_lock = threading.Lock()
+    # The last chunk read and the number of chunks to prefetch after it, which
+    # grows as long as the chunks are read sequentially.
+    self._last_chunk_read = None
+    self._read_ahead = self.LOOK_AHEAD
+
   def SetChunksize(self, chunksize):
     # pylint: disable=protected-access
     self.Set(self.Schema._CHUNKSIZE(chunksize))
@@ -2892,10 +3432,119 @@ class AFF4ImageBase(AFF4Stream):
     self.chunk_cache.Put(chunk, fd)
     return fd
 
+  def _ChunkNames(self, chunks):
+    """Returns the keys of the given chunks in the chunk cache."""
+    return list(chunks)
+
+  def _NumChunks(self):
+    return (self.size + self.chunksize - 1) / self.chunksize
+
+  def _MaxReadAhead(self):
+    """The prefetched chunks can't take more than half of the cache."""
+    max_bytes = self.chunk_cache.max_bytes
+    # pylint: disable=protected-access
+    max_chunks = min(config.CONFIG["AFF4.read_ahead_max_chunks"],
+                     self.chunk_cache._limit / 2)
+    # pylint: enable=protected-access
+    if max_bytes:
+      max_chunks = min(max_chunks, max_bytes / 2 / self.chunksize)
+    return max(max_chunks, self.LOOK_AHEAD)
+
+  def _ReadAhead(self, chunk):
+    """Prefetches the chunks following chunk if the stream is read in order.
+
+    Every time the next chunk is read the read ahead window doubles, up to
+    AFF4.read_ahead_max_chunks. Any other access pattern resets it. Chunks are
+    prefetched in the background so the caller keeps consuming the chunks
+    already cached, once at least half of the window is missing so they are
+    read in batches.
+
+    Args:
+      chunk: The chunk about to be read.
+    """
+    # Only streams opened for reading are prefetched, a background read would
+    # overwrite the chunks being written otherwise.
+    if self.mode != "r" or chunk == self._last_chunk_read:
+      return
+
+    if (self._last_chunk_read is not None and
+        chunk == self._last_chunk_read + 1):
+      self._read_ahead = min(self._read_ahead * 2, self._MaxReadAhead())
+    else:
+      self._read_ahead = self.LOOK_AHEAD
+    self._last_chunk_read = chunk
+
+    # Random reads are served by the LOOK_AHEAD chunks read on a cache miss.
+    if self._read_ahead <= self.LOOK_AHEAD:
+      return
+
+    last_chunk = min(chunk + self._read_ahead, self._NumChunks() - 1)
+    with self._prefetch_lock:
+      names = []
+      for name in self._ChunkNames(xrange(chunk + 1, last_chunk + 1)):
+        if (name not in self.chunk_cache and name not in self._prefetching and
+            name not in names):
+          names.append(name)
+      if not names or len(names) < (last_chunk - chunk) / 2:
+        return
+
+      done = threading.Event()
+      for name in names:
+        self._prefetching[name] = done
+
+    pool = threadpool.ThreadPool.Factory(
+        self.READ_AHEAD_POOL_NAME, config.CONFIG["AFF4.read_ahead_threads"])
+    pool.Start()
+    try:
+      pool.AddTask(
+          target=self._Prefetch,
+          args=(names, done),
+          name="Prefetch %s" % self.urn,
+          inline=False,
+          blocking=False)
+    except threadpool.Full:
+      # The chunks will be read when needed.
+      self._PrefetchDone(names, done)
+
+  def _Prefetch(self, names, done):
+    try:
+      self._ReadChunks(names)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Failed to prefetch chunks of %s.", self.urn)
+    finally:
+      self._PrefetchDone(names, done)
+
+  def _PrefetchDone(self, names, done):
+    with self._prefetch_lock:
+      for name in names:
+        self._prefetching.pop(name, None)
+    done.set()
+
+  def _GetCachedChunk(self, name):
+    """Returns a cached chunk, waiting for it if it is being prefetched."""
+    try:
+      return self.chunk_cache.Get(name)
+    except KeyError:
+      pass
+
+    with self._prefetch_lock:
+      done = self._prefetching.get(name)
+    if done is None:
+      raise KeyError(name)
+
+    done.wait()
+    return self.chunk_cache.Get(name)
+
   def _GetChunkForReading(self, chunk):
     """Returns the relevant chunk from the datastore and reads ahead."""
+    names = self._ChunkNames([chunk])
+    if not names:
+      raise ChunkNotFoundError("Cannot open chunk %s" % chunk)
+    name = names[0]
+
+    self._ReadAhead(chunk)
     try:
-      return self.chunk_cache.Get(chunk)
+      return self._GetCachedChunk(name)
     except KeyError:
       pass
 
@@ -2903,15 +3552,17 @@ class AFF4ImageBase(AFF4Stream):
     # access pattern is contiguous reading so since we have to go to
     # the data store already, we read ahead to reduce round trips.
 
-    missing_chunks = []
-    for chunk_number in range(chunk, chunk + self.LOOK_AHEAD):
-      if chunk_number not in self.chunk_cache:
-        missing_chunks.append(chunk_number)
+    missing_chunks = [
+        missing_name
+        for missing_name in self._ChunkNames(
+            xrange(chunk, chunk + self.LOOK_AHEAD))
+        if missing_name not in self.chunk_cache
+    ]
 
     self._ReadChunks(missing_chunks)
     # This should work now - otherwise we just give up.
     try:
-      return self.chunk_cache.Get(chunk)
+      return self.chunk_cache.Get(name)
     except KeyError:
       raise ChunkNotFoundError("Cannot open chunk %s" % chunk)
 
@@ -3018,13 +3669,14 @@ class AFF4ImageBase(AFF4Stream):
     if "chunk_cache" in self.__dict__:
       self.chunk_cache.Flush()
       res = self.__dict__.copy()
-      del res["chunk_cache"]
+      for name in ["chunk_cache", "_prefetching", "_prefetch_lock"]:
+        res.pop(name, None)
       return res
     return self.__dict__
 
   def __setstate__(self, state):
     self.__dict__ = state
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self._InitChunkCache()
 
 
 class AFF4Image(AFF4ImageBase):
@@ -3053,6 +3705,8 @@ class AFF4InitHook(registry.InitHook):
     # pylint: enable=unused-variable,global-statement,g-import-not-at-top
     stats.STATS.RegisterCounterMetric("aff4_cache_hits")
     stats.STATS.RegisterCounterMetric("aff4_cache_misses")
+    stats.STATS.RegisterCounterMetric("aff4_child_index_updates")
+    stats.STATS.RegisterCounterMetric("aff4_child_index_writes")
 
 
 class AFF4Filter(object):
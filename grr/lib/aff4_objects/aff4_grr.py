@@ -561,7 +561,11 @@ class GRRForeman(aff4.AFF4Object):
     if not rules:
       return 0
 
-    client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
+    client = aff4.FACTORY.Open(
+        client_id,
+        mode="rw",
+        token=self.token,
+        projection=[VFSGRRClient.SchemaCls.LAST_FOREMAN_TIME])
     try:
       last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
     except AttributeError:
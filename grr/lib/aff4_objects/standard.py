@@ -101,7 +101,7 @@ class BlobImage(aff4.AFF4ImageBase):
   _HASH_SIZE = 32
 
   # How many chunks we read ahead
-  _READAHEAD = 5
+  LOOK_AHEAD = 5
 
   @classmethod
   def _GenerateChunkIds(cls, fds):
@@ -182,34 +182,15 @@ class BlobImage(aff4.AFF4ImageBase):
     """Chunks must be added using the AddBlob() method."""
     raise NotImplementedError("Direct writing of BlobImage not allowed.")
 
-  def _GetChunkForReading(self, chunk):
-    """Retrieve the relevant blob from the AFF4 data store or cache."""
-    offset = chunk * self._HASH_SIZE
-    self.index.seek(offset)
-
-    chunk_name = self.index.read(self._HASH_SIZE).encode("hex")
-
-    try:
-      return self.chunk_cache.Get(chunk_name)
-    except KeyError:
-      pass
-
-    # We don't have this chunk already cached. The most common read
-    # access pattern is contiguous reading so since we have to go to
-    # the data store already, we read ahead to reduce round trips.
-    self.index.seek(offset)
-    readahead = []
-
-    for _ in range(self._READAHEAD):
+  def _ChunkNames(self, chunks):
+    """Blobs are cached by their hashes, read from the index."""
+    names = []
+    for chunk in chunks:
+      self.index.seek(chunk * self._HASH_SIZE)
       name = self.index.read(self._HASH_SIZE).encode("hex")
-      if name and name not in self.chunk_cache:
-        readahead.append(name)
-
-    self._ReadChunks(readahead)
-    try:
-      return self.chunk_cache.Get(chunk_name)
-    except KeyError:
-      raise aff4.ChunkNotFoundError("Cannot open chunk %s" % chunk)
+      if name:
+        names.append(name)
+    return names
 
   def _ReadChunks(self, chunks):
     res = data_store.DB.ReadBlobs(chunks, token=self.token)
@@ -365,28 +346,8 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
           res[chunk_names[obj.urn]] = hsh.encode("hex")
     return res
 
-  def _GetChunkForReading(self, chunk):
-    """Returns the relevant chunk from the datastore and reads ahead."""
-    try:
-      return self.chunk_cache.Get(chunk)
-    except KeyError:
-      pass
-
-    # We don't have this chunk already cached. The most common read
-    # access pattern is contiguous reading so since we have to go to
-    # the data store already, we read ahead to reduce round trips.
-
-    missing_chunks = []
-    for chunk_number in range(chunk, chunk + 10):
-      if chunk_number not in self.chunk_cache:
-        missing_chunks.append(chunk_number)
-
-    self._ReadChunks(missing_chunks)
-    # This should work now - otherwise we just give up.
-    try:
-      return self.chunk_cache.Get(chunk)
-    except KeyError:
-      raise aff4.ChunkNotFoundError("Cannot open chunk %s" % chunk)
+  def _NumChunks(self):
+    return self.last_chunk + 1
 
   def _GetChunkForWriting(self, chunk):
     """Returns the relevant chunk from the datastore."""
@@ -4,6 +4,7 @@
 
 import itertools
 import os
+import StringIO
 import threading
 import time
 
@@ -994,6 +995,53 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     fd = aff4.FACTORY.Open("aff4:/tmp/dir2", token=self.token)
     self.assertListEqual(list(fd.ListChildren()), ["aff4:/tmp/dir2/hello4.txt"])
 
+  def testInterruptedDeleteResumes(self):
+    for i in range(3):
+      for j in range(3):
+        for k in range(3):
+          with aff4.FACTORY.Create(
+              "aff4:/tmp/dir%d/sub%d/file%d" % (i, j, k),
+              aff4.AFF4MemoryStream,
+              token=self.token) as fd:
+            fd.Write("hello")
+
+    def TmpSubjects():
+      # NOTE: We assume that tests are running with FakeDataStore.
+      return set(subject for subject in data_store.DB.subjects
+                 if subject.startswith("aff4:/tmp/"))
+
+    subjects = TmpSubjects()
+    self.assertEqual(len(subjects), 3 + 9 + 27)
+
+    flush = data_store.MutationPool.Flush
+    flushes = []
+
+    def FailingFlush(pool):
+      if len(flushes) == 3:
+        raise IOError("Data store unavailable.")
+      flushes.append(pool.Size())
+      flush(pool)
+
+    with test_lib.ConfigOverrider({"AFF4.delete_batch_size": 4}):
+      with utils.Stubber(data_store.MutationPool, "Flush", FailingFlush):
+        with self.assertRaises(IOError):
+          aff4.FACTORY.Delete("aff4:/tmp", token=self.token)
+
+    # Children are deleted first, the remaining objects are still reachable.
+    remaining = TmpSubjects()
+    self.assertTrue(remaining)
+    self.assertLess(len(remaining), len(subjects))
+    for subject in remaining:
+      self.assertTrue(
+          os.path.dirname(subject) == "aff4:/tmp" or
+          os.path.dirname(subject) in remaining)
+    self.assertIn(
+        rdfvalue.RDFURN("aff4:/tmp"),
+        aff4.FACTORY.ListChildren("aff4:/", token=self.token))
+
+    aff4.FACTORY.Delete("aff4:/tmp", token=self.token)
+    self.assertFalse(TmpSubjects())
+
   def testMultiDeleteRaisesWhenTryingToDeleteRoot(self):
     self.assertRaises(
         RuntimeError,
@@ -1190,6 +1238,50 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     for i in range(100):
       self.assertEqual(fd.Read(13), "Test%08X\n" % i)
 
+  def testAFF4ImageReadAhead(self):
+    """Sequential reads prefetch a growing window of chunks."""
+    path = "/C.12345/readahead"
+
+    self.WriteImage(path, "Test")
+
+    batches = []
+    read_chunks = aff4.AFF4Image._ReadChunks
+
+    def RecordingReadChunks(fd, chunks):
+      batches.append(len(chunks))
+      return read_chunks(fd, chunks)
+
+    with utils.Stubber(aff4.AFF4Image, "_ReadChunks", RecordingReadChunks):
+      fd = aff4.FACTORY.Open(path, token=self.token)
+      for i in range(100):
+        self.assertEqual(fd.Read(13), "Test%08X\n" % i)
+
+      # 130 chunks were read in fewer, larger batches than LOOK_AHEAD.
+      self.assertGreater(max(batches), fd.LOOK_AHEAD)
+      self.assertLess(len(batches), 130 / fd.LOOK_AHEAD)
+
+      # Random reads don't prefetch anything.
+      del batches[:]
+      fd = aff4.FACTORY.Open(path, token=self.token)
+      for i in [50, 10, 90, 30]:
+        fd.Seek(i * 13)
+        self.assertEqual(fd.Read(5), ("Test%08X\n" % i)[:5])
+      self.assertEqual(batches, [fd.LOOK_AHEAD] * 4)
+
+  def testChunkCacheMaxBytes(self):
+    cache = aff4.ChunkCache(None, 100, max_bytes=25)
+    for i in range(5):
+      cache.Put(i, StringIO.StringIO("%d" % i * 10))
+
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.size, 20)
+    self.assertEqual(cache.Get(4).getvalue(), "4" * 10)
+
+    cache.Pop(4)
+    self.assertEqual(cache.size, 10)
+    cache.Flush()
+    self.assertEqual(cache.size, 0)
+
   def WriteImage(self,
                  path,
                  prefix="Test",
@@ -1313,6 +1405,38 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
         sorted([x.urn for x in all_children]),
         [root_urn.Add("some1"), root_urn.Add("some2")])
 
+  def testProjection(self):
+    with aff4.FACTORY.Create(
+        self.client_id, aff4_grr.VFSGRRClient, mode="w",
+        token=self.token) as client:
+      client.Set(client.Schema.HOSTNAME("client1"))
+      client.Set(client.Schema.FQDN("client1.example.com"))
+
+    reads = []
+    multi_resolve_prefix = data_store.DB.MultiResolvePrefix
+
+    def MultiResolvePrefix(subjects, attribute_prefix, **kwargs):
+      reads.append(attribute_prefix)
+      return multi_resolve_prefix(subjects, attribute_prefix, **kwargs)
+
+    with utils.Stubber(data_store.DB, "MultiResolvePrefix", MultiResolvePrefix):
+      client, = aff4.FACTORY.MultiOpen(
+          [self.client_id],
+          token=self.token,
+          projection=[aff4_grr.VFSGRRClient.SchemaCls.HOSTNAME])
+
+      # Only the projected attributes and the type are read.
+      self.assertIsInstance(client, aff4_grr.VFSGRRClient)
+      self.assertEqual(reads, [["aff4:type", "metadata:hostname"]])
+      self.assertEqual(client.Get(client.Schema.HOSTNAME), "client1")
+      self.assertEqual(len(reads), 1)
+
+      # Other attributes are read when they are first accessed.
+      self.assertEqual(
+          client.Get(client.Schema.FQDN), "client1.example.com")
+      self.assertEqual(client.Get(client.Schema.FQDN), "client1.example.com")
+      self.assertEqual(len(reads), 2)
+
   def testObjectListChildren(self):
     root_urn = aff4.ROOT_URN.Add("path")
 
@@ -1367,6 +1491,102 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
         sorted(children), [client_urn.Add("some1"),
                            client_urn.Add("some2")])
 
+  def testFactoryRecursiveMultiListChildren(self):
+    client_urn = rdfvalue.RDFURN("C.%016X" % 0)
+    expected = {client_urn: [client_urn.Add("fs")]}
+    for i in range(5):
+      dir_urn = client_urn.Add("fs").Add("dir%d" % i)
+      expected.setdefault(client_urn.Add("fs"), []).append(dir_urn)
+      expected[dir_urn] = []
+      for j in range(3):
+        with aff4.FACTORY.Create(
+            dir_urn.Add("file%d" % j), aff4.AFF4Volume, token=self.token):
+          pass
+        expected[dir_urn].append(dir_urn.Add("file%d" % j))
+        expected[dir_urn.Add("file%d" % j)] = []
+
+    for fan_out in [1, 4]:
+      with test_lib.ConfigOverrider({
+          "AFF4.recursive_list_batch_size": 2,
+          "AFF4.recursive_list_fan_out": fan_out
+      }):
+        # Urns below other urns are only listed once.
+        results = list(
+            aff4.FACTORY.RecursiveMultiListChildren(
+                [client_urn, client_urn.Add("fs/dir1")], token=self.token))
+
+      self.assertEqual(len(results), len(expected))
+      self.assertEqual(
+          dict((rdfvalue.RDFURN(subject), sorted(children))
+               for subject, children in results), expected)
+
+  def testChildIndexWriter(self):
+    client_urn = rdfvalue.RDFURN("C.%016X" % 0)
+    dir_urn = client_urn.Add("fs/os/dir")
+    aff4.FACTORY.intermediate_cache.Flush()
+
+    writer = aff4.ChildIndexWriter(
+        aff4.FACTORY.intermediate_cache, 3600, token=self.token)
+    with utils.Stubber(aff4.FACTORY, "child_index_writer", writer):
+      for name in ["file1", "file2", "file3"]:
+        with aff4.FACTORY.Create(
+            dir_urn.Add(name), aff4.AFF4Volume, token=self.token):
+          pass
+
+      # The entries are pending, all the ancestors were only queued once.
+      self.assertEqual(
+          data_store.DB.ResolvePrefix(
+              dir_urn, "index:dir/", token=self.token), [])
+      self.assertEqual(len(writer.pending_paths), 7)
+      self.assertEqual(sorted(writer.pending[dir_urn]),
+                       ["file1", "file2", "file3"])
+
+      # Listing children writes them first.
+      children = aff4.FACTORY.ListChildren(dir_urn, token=self.token)
+      self.assertListEqual(
+          sorted(children), [dir_urn.Add("file1"), dir_urn.Add("file2"),
+                             dir_urn.Add("file3")])
+      self.assertFalse(writer.pending)
+      self.assertEqual(
+          aff4.FACTORY.ListChildren(client_urn, token=self.token),
+          [client_urn.Add("fs")])
+
+      # Children already indexed are not queued again.
+      with aff4.FACTORY.Create(
+          dir_urn.Add("file1"), aff4.AFF4Volume, token=self.token):
+        pass
+      self.assertFalse(writer.pending)
+
+      # Deleted children are dropped from the pending entries.
+      with aff4.FACTORY.Create(
+          dir_urn.Add("file4"), aff4.AFF4Volume, token=self.token):
+        pass
+      writer.Discard([dir_urn.Add("file4")])
+      self.assertFalse(writer.pending)
+
+      # Entries that could not be written are queued again.
+      with aff4.FACTORY.Create(
+          dir_urn.Add("file5"), aff4.AFF4Volume, token=self.token):
+        pass
+
+      def FailingFlush(_):
+        raise IOError("Data store unavailable.")
+
+      with utils.Stubber(data_store.MutationPool, "Flush", FailingFlush):
+        self.assertRaises(IOError, writer.Flush)
+        self.assertEqual(writer.pending, {dir_urn: set(["file5"])})
+
+        # The background thread logs the errors and retries later.
+        writer.last_flush = 0
+        writer._PeriodicFlush()  # pylint: disable=protected-access
+        self.assertEqual(writer.pending, {dir_urn: set(["file5"])})
+
+    writer.Stop()
+    self.assertFalse(writer.pending)
+    self.assertIn(
+        dir_urn.Add("file5"), aff4.FACTORY.ListChildren(
+            dir_urn, token=self.token))
+
   def testIndexNotUpdatedWhenWrittenWithinIntermediateCacheAge(self):
     with utils.Stubber(time, "time", lambda: 100):
       fd = aff4.FACTORY.Create(
@@ -1597,6 +1817,25 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
           self.assertRaises(aff4.LockError, fd.Close)
           self.assertRaises(aff4.LockError, fd.Flush)
 
+  def testMultiOpenWithLockReleasesLocksOnError(self):
+    urns = [self.client_id.Add("object%d" % i) for i in range(3)]
+    for urn in urns:
+      aff4.FACTORY.Create(
+          urn, aff4.AFF4MemoryStream, mode="w", token=self.token).Close()
+
+    def FailingGetAttributes(*_, **__):
+      raise IOError("Data store unavailable.")
+
+    with utils.Stubber(aff4.FACTORY, "GetAttributes", FailingGetAttributes):
+      self.assertRaises(
+          IOError, aff4.FACTORY.MultiOpenWithLock, urns, token=self.token)
+
+    # None of the objects stay locked.
+    fds = aff4.FACTORY.MultiOpenWithLock(urns, token=self.token)
+    self.assertEqual(len(fds), 3)
+    for fd in fds:
+      fd.Close()
+
   def testUpdateLeaseRaisesIfObjectIsNotLocked(self):
     client = aff4.FACTORY.Create(
         self.client_id, aff4_grr.VFSGRRClient, mode="w", token=self.token)
@@ -305,6 +305,11 @@ class Communicator(object):
     self.server_cipher_age = rdfvalue.RDFDatetime.Now()
     return self.server_cipher
 
+  def _GetRemoteCipher(self, destination):
+    """Returns a cipher for sending messages to destination."""
+    remote_public_key = self._GetRemotePublicKey(destination)
+    return Cipher(self.common_name, self.private_key, remote_public_key)
+
   def EncodeMessages(self,
                      message_list,
                      result,
@@ -349,8 +354,7 @@ class Communicator(object):
       # it's the only cipher it ever uses.
       cipher = self._GetServerCipher()
     else:
-      remote_public_key = self._GetRemotePublicKey(destination)
-      cipher = Cipher(self.common_name, self.private_key, remote_public_key)
+      cipher = self._GetRemoteCipher(destination)
 
     # Make a nonce for this transaction
     if timestamp is None:
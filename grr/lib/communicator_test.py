@@ -16,6 +16,7 @@ from grr.client import actions
 from grr.client import comms
 from grr.lib import aff4
 from grr.lib import communicator
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import front_end
 from grr.lib import queues
@@ -213,6 +214,91 @@ class ClientCommsTest(test_lib.GRRBaseTest):
     self.assertEqual(decoded_messages[0].auth_state,
                      rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED)
 
+  def testClientLastSeenIsAggregated(self):
+    """Check PING and CLOCK updates are coalesced when configured."""
+    new_client = self.MakeClientAFF4Record()
+    with test_lib.ConfigOverrider({"Frontend.last_seen_flush_interval": 3600}):
+      self.server_communicator = front_end.ServerCommunicator(
+          certificate=self.server_certificate,
+          private_key=self.server_private_key,
+          token=self.token)
+    aggregator = self.server_communicator.last_seen_aggregator
+
+    now = rdfvalue.RDFDatetime.Now()
+    with test_lib.FakeTime(now):
+      self.ClientServerCommunicate(timestamp=now)
+      self.ClientServerCommunicate(timestamp=now + 10)
+      encrypted_messages = self.cipher_text
+
+    # Nothing is written until the aggregator is flushed.
+    client_obj = aff4.FACTORY.Open(new_client.urn, token=self.token)
+    self.assertIsNone(client_obj.Get(client_obj.Schema.CLOCK))
+
+    # Updates that could not be written are kept.
+    def FailingFlush(_):
+      raise IOError("Data store unavailable.")
+
+    with utils.Stubber(data_store.MutationPool, "Flush", FailingFlush):
+      self.assertRaises(IOError, aggregator.Flush)
+    self.assertEqual(len(aggregator.pending), 1)
+
+    aggregator.Flush()
+    client_obj = aff4.FACTORY.Open(new_client.urn, token=self.token)
+    self.assertEqual(
+        now.AsSecondsFromEpoch(),
+        client_obj.Get(client_obj.Schema.PING).AsSecondsFromEpoch())
+    self.assertEqual(
+        (now + 10).AsSecondsFromEpoch(),
+        client_obj.Get(client_obj.Schema.CLOCK).AsSecondsFromEpoch())
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_client_last_seen_writes"), 1)
+
+    # Replay protection uses the in-memory clock even if the client object was
+    # evicted and the data store has not been written yet.
+    self.ClientServerCommunicate(timestamp=now + 3700 * 1000000)
+    self.server_communicator.client_cache.Flush()
+    decoded_messages, _, _ = self.server_communicator.DecryptMessage(
+        encrypted_messages)
+    self.assertEqual(decoded_messages[0].auth_state,
+                     rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED)
+
+    aggregator.Stop()
+
+  def testServerCipherIsReused(self):
+    """Test that the server does not do RSA operations on every poll."""
+    self.MakeClientAFF4Record()
+    client_id = self.client_communicator.common_name
+
+    def ServerEncode():
+      result = rdf_flows.ClientCommunication()
+      # The client expects the server to echo its nonce.
+      timestamp = self.server_communicator.EncodeMessages(
+          rdf_flows.MessageList(), result, destination=client_id)
+      self.client_communicator.timestamp = timestamp
+      return result
+
+    rsa_operations = stats.STATS.GetMetricValue("grr_rsa_operations")
+    first = ServerEncode()
+    second = ServerEncode()
+
+    # The session keys are the same but every packet gets a new IV.
+    self.assertEqual(first.encrypted_cipher, second.encrypted_cipher)
+    self.assertNotEqual(first.packet_iv, second.packet_iv)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_rsa_operations"), rsa_operations + 1)
+
+    # The client can decode both messages.
+    for comms_message in [first, second]:
+      _, source, _ = self.client_communicator.DecodeMessages(comms_message)
+      self.assertEqual(source, self.server_communicator.common_name)
+
+    # Once the cipher is too old it gets rotated.
+    max_age = config.CONFIG["Frontend.cipher_cache_max_age"]
+    with test_lib.FakeTime(time.time() + max_age + 1):
+      third = ServerEncode()
+
+    self.assertNotEqual(first.encrypted_cipher, third.encrypted_cipher)
+
   def testCompression(self):
     """Tests that the compression works."""
     with test_lib.ConfigOverrider({"Network.compression": "UNCOMPRESSED"}):
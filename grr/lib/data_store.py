@@ -37,8 +37,10 @@ able to filter it directly).
 
 import abc
 import atexit
+import bz2
 import sys
 import time
+import zlib
 
 import logging
 
@@ -46,11 +48,13 @@ from grr import config
 from grr.lib import access_control
 from grr.lib import blob_store
 from grr.lib import flags
+from grr.lib import notification_channel
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import structs
 
 flags.DEFINE_bool("list_storage", False, "List all storage subsystems present.")
 
@@ -172,6 +176,9 @@ class MutationPool(object):
 
     for queue, notifications in self.new_notifications:
       DB.CreateNotifications(queue, notifications, token=self.token)
+    # Now that the notifications are written, waiting workers can be woken up.
+    notification_channel.Publish(
+        set(queue for queue, _ in self.new_notifications))
     self.new_notifications = []
 
     self.delete_subject_requests = []
@@ -193,6 +200,63 @@ class MutationPool(object):
     self.new_notifications.append((queue, notifications))
 
 
+class ValueCompressor(object):
+  """Compresses the values stored by the data stores.
+
+  Values are compressed when they are larger than
+  Datastore.compression_threshold or their attribute starts with one of
+  Datastore.compressed_attributes. Compressed values start with MAGIC and the
+  codec used, so that values stored uncompressed are returned as they are.
+  """
+
+  MAGIC = "\x00GRRc"
+
+  # Values which happen to start with MAGIC are stored with the "n" codec.
+  CODECS = {
+      "n": (lambda data, level: data, lambda data: data),
+      "z": (zlib.compress, zlib.decompress),
+      "b": (bz2.compress, bz2.decompress),
+  }
+  CODEC_IDS = {"zlib": "z", "bz2": "b"}
+
+  def __init__(self):
+    self.codec_id = self.CODEC_IDS.get(
+        config.CONFIG["Datastore.compression_codec"])
+    self.level = config.CONFIG["Datastore.compression_level"]
+    self.threshold = config.CONFIG["Datastore.compression_threshold"]
+    self.attribute_prefixes = tuple(
+        utils.SmartUnicode(prefix)
+        for prefix in config.CONFIG["Datastore.compressed_attributes"])
+
+  def Compress(self, attribute, data):
+    """Returns the data to store for an attribute value serialized to data."""
+    if data.startswith(self.MAGIC):
+      return self.MAGIC + "n" + data
+
+    if (self.codec_id is None or
+        (len(data) < self.threshold and
+         not utils.SmartUnicode(attribute).startswith(self.attribute_prefixes))):
+      return data
+
+    compress, _ = self.CODECS[self.codec_id]
+    compressed = self.MAGIC + self.codec_id + compress(data, self.level)
+    if len(compressed) >= len(data):
+      return data
+
+    stats.STATS.IncrementCounter("datastore_compressed_bytes", len(data))
+    stats.STATS.IncrementCounter("datastore_compression_saved_bytes",
+                                 len(data) - len(compressed))
+    return compressed
+
+  def Decompress(self, data):
+    """Returns the serialized value stored as data."""
+    if not data.startswith(self.MAGIC):
+      return data
+
+    _, decompress = self.CODECS[data[len(self.MAGIC)]]
+    return decompress(data[len(self.MAGIC) + 1:])
+
+
 class DataStore(object):
   """Abstract database access."""
 
@@ -216,12 +280,20 @@ class DataStore(object):
   FLOW_RESPONSE_PREFIX = "flow:response:"
   FLOW_RESPONSE_TEMPLATE = FLOW_RESPONSE_PREFIX + "%08X:%08X"
 
+  # Responses of completed requests can be packed into a few chunks, named
+  # by the request id and the id of the first response they contain.
+  FLOW_PACKED_RESPONSES_PREFIX = "flow:packed_responses:"
+  FLOW_PACKED_RESPONSES_TEMPLATE = FLOW_PACKED_RESPONSES_PREFIX + "%08X:%08X"
+  FLOW_PACKED_RESPONSES_CHUNK_SIZE = 1024 * 1024
+
   mutation_pool_cls = MutationPool
 
   flusher_thread = None
   monitor_thread = None
 
   def __init__(self):
+    self.compressor = ValueCompressor()
+
     # Start the flusher thread.
     self.flusher_thread = utils.InterruptableThread(
         name="DataStore flusher thread", target=self.Flush, sleep_time=0.5)
@@ -613,6 +685,28 @@ class DataStore(object):
 
     """
 
+  def ScanSubjects(self,
+                   subject_prefix,
+                   after_urn=None,
+                   max_records=None,
+                   token=None):
+    """Lists the subjects which have values stored.
+
+    Args:
+      subject_prefix: Lists the subjects which begin with subject_prefix.
+      after_urn: If set, only lists the subjects which come after it.
+      max_records: The maximum number of subjects to list.
+      token: The security token used in this call.
+
+    Returns:
+      An iterator over the subjects, in order.
+
+    Raises:
+      NotImplementedError: If the data store can't list its subjects.
+    """
+    raise NotImplementedError(
+        "%s can not list its subjects." % self.__class__.__name__)
+
   def ScanAttribute(self,
                     subject_prefix,
                     attribute,
@@ -719,7 +813,19 @@ class DataStore(object):
                                request_limit=None,
                                response_limit=None,
                                token=None):
-    """Fetches all Requests and Responses for a given session_id."""
+    """Fetches all Requests and Responses for a given session_id.
+
+    Args:
+      session_id: The session id to use.
+      timestamp: A timestamp as used in the data store.
+      request_limit: The maximum number of requests to read.
+      response_limit: The maximum number of responses to read, for all the
+                      requests together. Packed responses count one by one.
+      token: A data store token.
+
+    Yields:
+      tuples (request, lists of fetched responses for the request)
+    """
     subject = session_id.Add("state")
     requests = {}
 
@@ -734,22 +840,28 @@ class DataStore(object):
       request_id = predicate.split(":", 1)[1]
       requests[str(subject.Add(request_id))] = serialized
 
-    # And the responses for them.
-    response_data = dict(
-        self.MultiResolvePrefix(
-            requests.keys(),
-            self.FLOW_RESPONSE_PREFIX,
-            limit=response_limit,
-            token=token,
-            timestamp=timestamp))
+    # And the responses for them. Every value holds at least one response, so
+    # reading response_limit values is enough.
+    response_data = {}
+    remaining = response_limit
+    for urn, values in self.MultiResolvePrefix(
+        requests.keys(),
+        [self.FLOW_RESPONSE_PREFIX, self.FLOW_PACKED_RESPONSES_PREFIX],
+        limit=response_limit,
+        token=token,
+        timestamp=timestamp):
+      responses = self._DecodeResponses(values)
+      if response_limit:
+        responses = responses[:remaining]
+        remaining -= len(responses)
+
+      response_data[urn] = responses
+      if response_limit and remaining <= 0:
+        break
 
     for urn, request_data in sorted(requests.items()):
       request = rdf_flows.RequestState.FromSerializedString(request_data)
-      responses = []
-      for _, serialized, _ in response_data.get(urn, []):
-        responses.append(rdf_flows.GrrMessage.FromSerializedString(serialized))
-
-      yield (request, sorted(responses, key=lambda msg: msg.response_id))
+      yield (request, response_data.get(urn, []))
 
   def ReadCompletedRequests(self,
                             session_id,
@@ -779,6 +891,79 @@ class DataStore(object):
         yield (rdf_flows.RequestState.FromSerializedString(serialized),
                rdf_flows.GrrMessage.FromSerializedString(status[request_id]))
 
+  def MultiReadCompletedRequests(self, timestamps, limit=None, token=None):
+    """Fetches the completed requests of several flows in one query.
+
+    Args:
+      timestamps: A dict mapping session ids to the (start, end) timestamp
+                  range to read for this flow.
+      limit: The total number of requests and status messages to read.
+      token: A data store token.
+
+    Returns:
+      A dict mapping session ids to lists of (request, status) tuples like
+      ReadCompletedRequests() yields them. If the limit was reached, each flow
+      is read with its own ReadCompletedRequests() call instead.
+    """
+    subjects = {}
+    for session_id in timestamps:
+      subjects[str(session_id.Add("state"))] = session_id
+
+    timestamps = {
+        session_id: (int(start), int(end))
+        for session_id, (start, end) in timestamps.iteritems()
+    }
+    start = min(start for start, _ in timestamps.itervalues())
+    end = max(end for _, end in timestamps.itervalues())
+
+    result = {}
+    count = 0
+    for subject, values in self.MultiResolvePrefix(
+        subjects, [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
+        token=token,
+        limit=limit,
+        timestamp=(start, end)):
+      count += len(values)
+      session_id = subjects[utils.SmartStr(subject)]
+      session_start, session_end = timestamps[session_id]
+
+      requests = {}
+      status = {}
+      for predicate, serialized, ts in values:
+        if not session_start <= ts <= session_end:
+          continue
+
+        parts = predicate.split(":", 3)
+        request_id = parts[2]
+        if parts[1] == "status":
+          status[request_id] = serialized
+        else:
+          requests[request_id] = serialized
+
+      result[session_id] = [
+          (rdf_flows.RequestState.FromSerializedString(serialized),
+           rdf_flows.GrrMessage.FromSerializedString(status[request_id]))
+          for request_id, serialized in sorted(requests.items())
+          if request_id in status
+      ]
+
+    if limit and count >= limit:
+      # The data stores don't tell which subjects the limit cut short, any
+      # flow might have been read partially or not at all.
+      return dict((session_id,
+                   list(
+                       self.ReadCompletedRequests(
+                           session_id,
+                           timestamp=session_timestamps,
+                           limit=limit,
+                           token=token)))
+                  for session_id, session_timestamps in timestamps.iteritems())
+
+    for session_id in timestamps:
+      result.setdefault(session_id, [])
+
+    return result
+
   def ReadResponsesForRequestId(self,
                                 session_id,
                                 request_id,
@@ -821,21 +1006,80 @@ class DataStore(object):
     response_data = dict(
         self.MultiResolvePrefix(
             response_subjects,
-            self.FLOW_RESPONSE_PREFIX,
+            [self.FLOW_RESPONSE_PREFIX, self.FLOW_PACKED_RESPONSES_PREFIX],
             token=token,
             timestamp=timestamp))
 
     for response_urn, request in sorted(response_subjects.items()):
-      responses = []
-      for _, serialized, _ in response_data.get(response_urn, []):
-        responses.append(rdf_flows.GrrMessage.FromSerializedString(serialized))
+      yield (request, self._DecodeResponses(response_data.get(response_urn,
+                                                              [])))
+
+  def _DecodeResponses(self, values):
+    """Decodes individually stored and packed responses of a request.
+
+    Args:
+      values: (predicate, value, timestamp) tuples read from the response
+              subject of the request.
+
+    Returns:
+      A list of GrrMessages sorted by response id.
+    """
+    responses = {}
+    for predicate, serialized, _ in values:
+      if predicate.startswith(self.FLOW_PACKED_RESPONSES_PREFIX):
+        for response in self.UnpackResponses(serialized):
+          responses[response.response_id] = response
+      else:
+        response = rdf_flows.GrrMessage.FromSerializedString(serialized)
+        responses[response.response_id] = response
 
-      yield (request, sorted(responses, key=lambda msg: msg.response_id))
+    return [responses[response_id] for response_id in sorted(responses)]
+
+  def PackResponses(self, serialized_responses):
+    """Packs serialized responses into length prefixed chunks.
+
+    Args:
+      serialized_responses: A list of (response_id, serialized GrrMessage)
+                            tuples, sorted by response id.
+
+    Yields:
+      (first response id, chunk) tuples. Chunks only exceed
+      FLOW_PACKED_RESPONSES_CHUNK_SIZE if a single response does.
+    """
+    chunk = []
+    chunk_size = 0
+    first_response_id = None
+    for response_id, serialized in serialized_responses:
+      if chunk and (chunk_size + len(serialized) >
+                    self.FLOW_PACKED_RESPONSES_CHUNK_SIZE):
+        yield first_response_id, "".join(chunk)
+        chunk = []
+        chunk_size = 0
+
+      if not chunk:
+        first_response_id = response_id
+
+      length = structs.VarintEncode(len(serialized))
+      chunk.append(length)
+      chunk.append(serialized)
+      chunk_size += len(length) + len(serialized)
+
+    if chunk:
+      yield first_response_id, "".join(chunk)
+
+  def UnpackResponses(self, chunk):
+    """Decodes the GrrMessages in a chunk one at a time."""
+    pos = 0
+    while pos < len(chunk):
+      length, pos = structs.VarintReader(chunk, pos)
+      yield rdf_flows.GrrMessage.FromSerializedString(chunk[pos:pos + length])
+      pos += length
 
   def StoreRequestsAndResponses(self,
                                 new_requests=None,
                                 new_responses=None,
                                 requests_to_delete=None,
+                                pack_responses=False,
                                 token=None):
     """Stores new flow requests and responses to the data store.
 
@@ -846,9 +1090,13 @@ class DataStore(object):
                      data store.
       requests_to_delete: A list of requests that should be deleted from the
                           data store.
+      pack_responses: If True, the responses of requests which receive their
+                      status message are packed into a few chunks so the
+                      worker can read them back cheaply.
       token: A data store token.
     """
     to_write = {}
+    completed = {}
     if new_requests is not None:
       for request, timestamp in new_requests:
         subject = request.session_id.Add("state")
@@ -867,6 +1115,10 @@ class DataStore(object):
           to_write.setdefault(subject, {}).setdefault(attribute, []).append(
               (response.SerializeToString(), timestamp))
 
+          response_subject = self.GetFlowResponseSubject(
+              response.session_id, response.request_id)
+          completed[response_subject] = response.request_id
+
         subject = self.GetFlowResponseSubject(response.session_id,
                                               response.request_id)
         attribute = self.FLOW_RESPONSE_TEMPLATE % (response.request_id,
@@ -889,6 +1141,44 @@ class DataStore(object):
           sync=True,
           token=token)
 
+    if pack_responses and completed:
+      self._PackCompletedResponses(completed, token=token)
+
+  def _PackCompletedResponses(self, completed, token=None):
+    """Replaces the individual responses of completed requests by chunks.
+
+    Responses which arrive after their status message are stored and read
+    individually as usual.
+
+    Args:
+      completed: A dict mapping response subjects to request ids.
+      token: A data store token.
+    """
+    for subject, values in self.MultiResolvePrefix(
+        completed, self.FLOW_RESPONSE_PREFIX, token=token):
+      request_id = completed[rdfvalue.RDFURN(subject)]
+      timestamp = max(ts for _, _, ts in values)
+
+      serialized_responses = []
+      for predicate, serialized, _ in values:
+        response_id = int(predicate.split(":")[-1], 16)
+        serialized_responses.append((response_id, serialized))
+      serialized_responses.sort()
+
+      to_set = {}
+      for first_response_id, chunk in self.PackResponses(serialized_responses):
+        predicate = self.FLOW_PACKED_RESPONSES_TEMPLATE % (request_id,
+                                                           first_response_id)
+        to_set[predicate] = [(chunk, timestamp)]
+
+      self.MultiSet(
+          subject,
+          to_set,
+          to_delete=[predicate for predicate, _, _ in values],
+          sync=True,
+          token=token)
+      stats.STATS.IncrementCounter("flow_responses_packed", len(values))
+
   def CheckRequestsForCompletion(self, requests, token=None):
     """Checks if there is a status message queued for a number of requests."""
 
@@ -985,6 +1275,179 @@ class DataStore(object):
       yield rdf_flows.GrrMessage.FromSerializedString(serialized)
 
 
+class WrappingDataStore(DataStore):
+  """Base class for data stores adding behaviour to another data store.
+
+  All calls are passed on to the data store named by the config option in
+  implementation_option. Subclasses override the methods they care about.
+  """
+
+  __abstract = True  # pylint: disable=g-bad-name
+
+  implementation_option = None
+
+  def __init__(self):
+    name = config.CONFIG[self.implementation_option]
+    try:
+      cls = DataStore.GetPlugin(name)
+    except KeyError:
+      raise RuntimeError("No Storage System %s found." % name)
+    if issubclass(cls, self.__class__):
+      raise RuntimeError("%s can not wrap itself." % self.__class__.__name__)
+
+    # The flusher thread started by the base class uses the wrapped store.
+    self.wrapped = cls()
+
+    super(WrappingDataStore, self).__init__()
+
+  def __getattr__(self, name):
+    # Anything specific to the wrapped data store is looked up there.
+    if name == "wrapped":
+      raise AttributeError(name)
+    return getattr(self.wrapped, name)
+
+  def Initialize(self):
+    self.wrapped.Initialize()
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    self.wrapped.DeleteSubject(subject, sync=sync, token=token)
+
+  def DeleteSubjects(self, subjects, sync=False, token=None):
+    self.wrapped.DeleteSubjects(subjects, sync=sync, token=token)
+
+  def Set(self,
+          subject,
+          attribute,
+          value,
+          timestamp=None,
+          token=None,
+          replace=True,
+          sync=True):
+    self.wrapped.Set(
+        subject,
+        attribute,
+        value,
+        timestamp=timestamp,
+        token=token,
+        replace=replace,
+        sync=sync)
+
+  def DBSubjectLock(self, subject, lease_time=None, token=None):
+    return self.wrapped.DBSubjectLock(
+        subject, lease_time=lease_time, token=token)
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None,
+               token=None):
+    self.wrapped.MultiSet(
+        subject,
+        values,
+        timestamp=timestamp,
+        replace=replace,
+        sync=sync,
+        to_delete=to_delete,
+        token=token)
+
+  def MultiDeleteAttributes(self,
+                            subjects,
+                            attributes,
+                            start=None,
+                            end=None,
+                            sync=True,
+                            token=None):
+    self.wrapped.MultiDeleteAttributes(
+        subjects, attributes, start=start, end=end, sync=sync, token=token)
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True,
+                       token=None):
+    self.wrapped.DeleteAttributes(
+        subject, attributes, start=start, end=end, sync=sync, token=token)
+
+  def Resolve(self, subject, attribute, token=None):
+    return self.wrapped.Resolve(subject, attribute, token=token)
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None,
+                         token=None):
+    return self.wrapped.MultiResolvePrefix(
+        subjects,
+        attribute_prefix,
+        timestamp=timestamp,
+        limit=limit,
+        token=token)
+
+  def ResolvePrefix(self,
+                    subject,
+                    attribute_prefix,
+                    timestamp=None,
+                    limit=None,
+                    token=None):
+    return self.wrapped.ResolvePrefix(
+        subject,
+        attribute_prefix,
+        timestamp=timestamp,
+        limit=limit,
+        token=token)
+
+  def ResolveMulti(self,
+                   subject,
+                   attributes,
+                   timestamp=None,
+                   limit=None,
+                   token=None):
+    return self.wrapped.ResolveMulti(
+        subject, attributes, timestamp=timestamp, limit=limit, token=token)
+
+  def ScanAttributes(self,
+                     subject_prefix,
+                     attributes,
+                     after_urn=None,
+                     max_records=None,
+                     token=None,
+                     relaxed_order=False):
+    return self.wrapped.ScanAttributes(
+        subject_prefix,
+        attributes,
+        after_urn=after_urn,
+        max_records=max_records,
+        token=token,
+        relaxed_order=relaxed_order)
+
+  def ScanSubjects(self,
+                   subject_prefix,
+                   after_urn=None,
+                   max_records=None,
+                   token=None):
+    return self.wrapped.ScanSubjects(
+        subject_prefix,
+        after_urn=after_urn,
+        max_records=max_records,
+        token=token)
+
+  def Flush(self):
+    self.wrapped.Flush()
+
+  def Size(self):
+    return self.wrapped.Size()
+
+  def Clear(self):
+    """Clears the wrapped store, if it supports it."""
+    self.wrapped.Clear()
+
+
 class DBSubjectLock(object):
   """Provide a simple subject lock using the database.
 
@@ -1127,3 +1590,12 @@ class DataStoreInit(registry.InitHook):
     """Initialize some Varz."""
     stats.STATS.RegisterCounterMetric("grr_commit_failure")
     stats.STATS.RegisterCounterMetric("datastore_retries")
+    stats.STATS.RegisterCounterMetric("flow_responses_packed")
+    stats.STATS.RegisterCounterMetric(
+        "datastore_compressed_bytes",
+        docstring="Size of the values compressed before they were stored.",
+        units=stats.MetricUnits.BYTES)
+    stats.STATS.RegisterCounterMetric(
+        "datastore_compression_saved_bytes",
+        docstring="Bytes saved by compressing values.",
+        units=stats.MetricUnits.BYTES)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""Copies the contents of a data store into another data store.
+
+The keyspace is split into partitions which are copied in parallel by a thread
+pool. Each partition is streamed from the source with ScanSubjects: subjects
+are listed a batch at a time, all the versions of all their attributes are
+read with a single MultiResolvePrefix and written unsynced to the destination,
+which is flushed once per batch.
+
+The last subject copied in every partition is written to a checkpoint file
+after each batch, so an interrupted migration resumes where it stopped. Once
+copied, the destination can be compared to the source with Verify().
+"""
+
+
+import json
+import logging
+import os
+import string
+import threading
+
+from grr.lib import data_store
+from grr.lib import threadpool
+from grr.lib import utils
+
+# Subjects are spread over the partitions by their first characters. Clients
+# being most of the data, their subjects are split further.
+DEFAULT_BOUNDARIES = sorted(
+    set(["aff4:/" + c for c in string.digits + string.ascii_letters] +
+        ["aff4:/C.%x" % i for i in range(16)]))
+
+
+class Error(Exception):
+  """Base class for migration errors."""
+
+
+class MigrationError(Error):
+  """Raised when some partitions could not be copied or verified."""
+
+
+class Partition(object):
+  """The subjects s such that start < s <= end."""
+
+  def __init__(self, start, end):
+    self.start = start
+    self.end = end
+
+  @property
+  def name(self):
+    return "%s-%s" % (self.start or "", self.end or "")
+
+  def __contains__(self, subject):
+    return ((self.start is None or subject > self.start) and
+            (self.end is None or subject <= self.end))
+
+
+def Partitions(boundaries=None):
+  """Splits the keyspace at the given subjects."""
+  boundaries = sorted(boundaries or DEFAULT_BOUNDARIES)
+  starts = [None] + boundaries
+  ends = boundaries + [None]
+  return [Partition(start, end) for start, end in zip(starts, ends)]
+
+
+class DataStoreMigration(object):
+  """Copies all the subjects of a data store into another one."""
+
+  THREAD_POOL_NAME = "DataStoreMigration"
+
+  def __init__(self,
+               source,
+               destination,
+               checkpoint_path=None,
+               boundaries=None,
+               threads=10,
+               batch_size=1000,
+               token=None):
+    """Constructor.
+
+    Args:
+      source: The data store to copy from.
+      destination: The data store to copy to.
+      checkpoint_path: File recording the progress of the copy. If it exists,
+          the copy resumes from it.
+      boundaries: Subjects at which the keyspace is partitioned, defaults to
+          DEFAULT_BOUNDARIES.
+      threads: Number of partitions copied at the same time.
+      batch_size: Number of subjects copied between two flushes of the
+          destination.
+      token: The security token used to access the data stores.
+    """
+    self.source = source
+    self.destination = destination
+    self.checkpoint_path = checkpoint_path
+    self.partitions = Partitions(boundaries)
+    self.threads = threads
+    self.batch_size = batch_size
+    self.token = token
+
+    self.lock = threading.Lock()
+    # Maps partition names to the last subject copied, or True once the whole
+    # partition has been copied.
+    self.checkpoint = {}
+    if checkpoint_path and os.path.exists(checkpoint_path):
+      with open(checkpoint_path, "rb") as fd:
+        self.checkpoint = json.load(fd)
+
+    self.subjects = 0
+    self.values = 0
+    self.failed = []
+    self.mismatches = []
+
+  def _WriteCheckpoint(self):
+    if not self.checkpoint_path:
+      return
+
+    tmp_path = self.checkpoint_path + ".tmp"
+    with open(tmp_path, "wb") as fd:
+      json.dump(self.checkpoint, fd)
+    os.rename(tmp_path, self.checkpoint_path)
+
+  def _ScanPartition(self, partition, after_urn):
+    """Yields the subjects of the partition after after_urn, in batches."""
+    while True:
+      batch = []
+      for subject in self.source.ScanSubjects(
+          "aff4:/",
+          after_urn=after_urn,
+          max_records=self.batch_size,
+          token=self.token):
+        subject = utils.SmartUnicode(subject)
+        if subject not in partition:
+          break
+        batch.append(subject)
+
+      if batch:
+        yield batch
+      if len(batch) < self.batch_size:
+        return
+      after_urn = batch[-1]
+
+  def _ReadRows(self, store, subjects):
+    """Returns all the values of subjects, leases excluded.
+
+    The values are kept as the data store returns them, so they are written
+    to the destination with the same types.
+
+    Args:
+      store: The data store to read from.
+      subjects: The subjects to read.
+
+    Returns:
+      A dict mapping subjects to lists of (attribute, value, timestamp).
+    """
+    rows = {}
+    for subject, values in store.MultiResolvePrefix(
+        subjects,
+        "",
+        timestamp=data_store.DataStore.ALL_TIMESTAMPS,
+        token=self.token):
+      rows[utils.SmartUnicode(subject)] = [
+          (utils.SmartUnicode(attribute), value, int(ts))
+          for attribute, value, ts in values
+          if attribute != data_store.DataStore.LEASE_ATTRIBUTE
+      ]
+    return rows
+
+  def _Comparable(self, values):
+    """Returns values in a form where type or encoding changes compare unequal.
+
+    Unicode and byte strings with the same contents compare equal, and may not
+    be ordered against each other, so every value is tagged with its type.
+
+    Args:
+      values: A list of (attribute, value, timestamp) as read by _ReadRows.
+
+    Returns:
+      A sorted list of (attribute, timestamp, type name, value).
+    """
+    if values is None:
+      return None
+    return sorted((attribute, ts, type(value).__name__, value)
+                  for attribute, value, ts in values)
+
+  def _CopyPartition(self, partition):
+    """Copies a partition, checkpointing after each batch."""
+    try:
+      after_urn = self.checkpoint.get(partition.name)
+      if after_urn is True:
+        return
+      if after_urn is None:
+        after_urn = partition.start
+
+      for subjects in self._ScanPartition(partition, after_urn):
+        rows = self._ReadRows(self.source, subjects)
+        # Deleting the rows first makes copying a batch again harmless. Writing
+        # with replace=True instead would only keep the last version of each
+        # attribute.
+        self.destination.DeleteSubjects(subjects, sync=True, token=self.token)
+
+        values_count = 0
+        for subject, values in rows.iteritems():
+          to_set = {}
+          for attribute, value, ts in values:
+            to_set.setdefault(attribute, []).append((value, ts))
+          self.destination.MultiSet(
+              subject, to_set, replace=False, sync=False, token=self.token)
+          values_count += len(values)
+        self.destination.Flush()
+
+        with self.lock:
+          self.subjects += len(subjects)
+          self.values += values_count
+          self.checkpoint[partition.name] = subjects[-1]
+          self._WriteCheckpoint()
+
+      with self.lock:
+        self.checkpoint[partition.name] = True
+        self._WriteCheckpoint()
+        logging.info("Copied %s, %d subjects copied so far.", partition.name,
+                     self.subjects)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Failed to copy %s.", partition.name)
+      with self.lock:
+        self.failed.append(partition.name)
+
+  def _VerifyPartition(self, partition):
+    """Compares a partition of the source with the destination."""
+    try:
+      for subjects in self._ScanPartition(partition, partition.start):
+        source_rows = self._ReadRows(self.source, subjects)
+        destination_rows = self._ReadRows(self.destination, subjects)
+        mismatches = [
+            subject for subject in subjects
+            if (self._Comparable(source_rows.get(subject)) !=
+                self._Comparable(destination_rows.get(subject)))
+        ]
+
+        with self.lock:
+          self.subjects += len(subjects)
+          self.mismatches.extend(mismatches)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Failed to verify %s.", partition.name)
+      with self.lock:
+        self.failed.append(partition.name)
+
+  def _RunOnPartitions(self, target):
+    self.subjects = 0
+    self.values = 0
+    self.failed = []
+
+    pool = threadpool.ThreadPool.Factory(self.THREAD_POOL_NAME, self.threads)
+    pool.Start()
+    for partition in self.partitions:
+      pool.AddTask(target=target, args=(partition,), name=partition.name)
+    pool.Join()
+
+    if self.failed:
+      raise MigrationError("Failed partitions: %s" % ", ".join(self.failed))
+
+  def Run(self):
+    """Copies the source into the destination.
+
+    Returns:
+      The number of subjects copied.
+
+    Raises:
+      MigrationError: If some partitions could not be copied. Running the
+          migration again resumes them.
+    """
+    self._RunOnPartitions(self._CopyPartition)
+    return self.subjects
+
+  def Verify(self):
+    """Compares the source with the destination.
+
+    Subjects written to the source since they were copied show up as
+    mismatches, the source should not be in use.
+
+    Returns:
+      The subjects whose values differ, sorted.
+
+    Raises:
+      MigrationError: If some partitions could not be verified.
+    """
+    self.mismatches = []
+    self._RunOnPartitions(self._VerifyPartition)
+    return sorted(self.mismatches)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Tests the data store migration."""
+
+
+
+import os
+
+
+from grr.lib import data_store_migration
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+
+from grr.lib.data_stores import fake_data_store
+
+
+class DataStoreMigrationTest(test_lib.GRRBaseTest):
+  """Test the data store migration."""
+
+  def setUp(self):
+    super(DataStoreMigrationTest, self).setUp()
+    self.source = fake_data_store.FakeDataStore()
+    self.destination = fake_data_store.FakeDataStore()
+    self.checkpoint_path = os.path.join(self.temp_dir, "checkpoint")
+
+    self.subjects = (["aff4:/C.%016X/fs/os/%d" % (i, i) for i in range(20)] +
+                     ["aff4:/hunts/H:%d" % i for i in range(5)] +
+                     ["aff4:/files/hash/%d" % i for i in range(5)])
+    for subject in self.subjects:
+      self.source.MultiSet(
+          subject, {"aff4:type": [("File", 1000)],
+                    "metadata:value": [("old", 1000), ("new", 2000)]},
+          replace=False,
+          token=self.token)
+
+  def _Migration(self):
+    return data_store_migration.DataStoreMigration(
+        self.source,
+        self.destination,
+        checkpoint_path=self.checkpoint_path,
+        threads=4,
+        batch_size=3,
+        token=self.token)
+
+  def testPartitions(self):
+    partitions = data_store_migration.Partitions(["aff4:/C", "aff4:/h"])
+    self.assertEqual([(p.start, p.end) for p in partitions],
+                     [(None, "aff4:/C"), ("aff4:/C", "aff4:/h"),
+                      ("aff4:/h", None)])
+    self.assertIn("aff4:/C", partitions[0])
+    self.assertIn("aff4:/C.0000000000000001", partitions[1])
+    self.assertIn("aff4:/hunts", partitions[2])
+
+  def testMigration(self):
+    migration = self._Migration()
+    self.assertEqual(migration.Run(), len(self.subjects))
+    self.assertEqual(migration.values, 3 * len(self.subjects))
+
+    for subject in self.subjects:
+      values = self.destination.ResolvePrefix(
+          subject,
+          "",
+          timestamp=self.destination.ALL_TIMESTAMPS,
+          token=self.token)
+      self.assertEqual(
+          sorted(values), [("aff4:type", "File", 1000),
+                           ("metadata:value", "new", 2000),
+                           ("metadata:value", "old", 1000)])
+
+    self.assertEqual(migration.Verify(), [])
+
+    self.source.Set(self.subjects[3], "metadata:value", "newer",
+                    token=self.token)
+    self.assertEqual(migration.Verify(), [self.subjects[3]])
+
+  def testValueTypesArePreserved(self):
+    subject = self.subjects[0]
+    self.source.MultiSet(
+        subject, {"index:intval": [(123, 1000)],
+                  "metadata:unicode": [(u"\xc3\xa9", 1000)],
+                  "metadata:bytes": [("\xc3\xa9", 1000)]},
+        token=self.token)
+
+    migration = self._Migration()
+    migration.Run()
+
+    def Typed(store):
+      return sorted((attribute, type(value), value, ts)
+                    for attribute, value, ts in store.ResolvePrefix(
+                        subject,
+                        "",
+                        timestamp=store.ALL_TIMESTAMPS,
+                        token=self.token))
+
+    self.assertEqual(Typed(self.destination), Typed(self.source))
+    self.assertIn(("index:intval", int, 123, 1000), Typed(self.destination))
+    self.assertEqual(migration.Verify(), [])
+
+    # Values of another type are reported even if they compare equal.
+    self.destination.Set(
+        subject, "index:intval", 123L, timestamp=1000, token=self.token)
+    self.destination.Set(
+        subject, "metadata:unicode", "\xc3\xa9", timestamp=1000,
+        token=self.token)
+    self.assertEqual(migration.Verify(), [subject])
+
+  def testResume(self):
+    copied = []
+    multi_set = fake_data_store.FakeDataStore.MultiSet
+
+    def FailingMultiSet(store, subject, *args, **kwargs):
+      if store is self.destination:
+        if subject == self.subjects[10]:
+          raise IOError("Destination unavailable.")
+        copied.append(subject)
+      return multi_set(store, subject, *args, **kwargs)
+
+    with utils.Stubber(fake_data_store.FakeDataStore, "MultiSet",
+                       FailingMultiSet):
+      with self.assertRaises(data_store_migration.MigrationError):
+        self._Migration().Run()
+
+    self.assertNotIn(self.subjects[10], copied)
+    self.assertTrue(os.path.exists(self.checkpoint_path))
+
+    # Only the failed partition is copied again, from its last checkpoint.
+    migration = self._Migration()
+    subjects = migration.Run()
+    self.assertLess(subjects, len(self.subjects) - len(copied) + 3)
+    self.assertEqual(migration.Verify(), [])
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
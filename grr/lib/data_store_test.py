@@ -31,6 +31,7 @@ from grr.lib import rdfvalue
 from grr.lib import sequential_collection
 from grr.lib import test_lib
 from grr.lib import threadpool
+from grr.lib import utils
 from grr.lib import worker
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import collects
@@ -970,6 +971,65 @@ class _DataStoreTest(test_lib.GRRBaseTest):
             token=self.token))
     self.assertEqual(len(results), 5)
 
+  def testScanSubjects(self):
+    for i in range(10):
+      data_store.DB.Set(
+          "aff4:/S/%d" % i, "aff4:foo", "value", token=self.token)
+    data_store.DB.Set("aff4:/S/3/child", "aff4:foo", "value", token=self.token)
+    data_store.DB.Set("aff4:/Sibling", "aff4:foo", "value", token=self.token)
+
+    subjects = list(data_store.DB.ScanSubjects("aff4:/S", token=self.token))
+    self.assertEqual(subjects, ["aff4:/S/0", "aff4:/S/1", "aff4:/S/2",
+                                "aff4:/S/3", "aff4:/S/3/child", "aff4:/S/4",
+                                "aff4:/S/5", "aff4:/S/6", "aff4:/S/7",
+                                "aff4:/S/8", "aff4:/S/9"])
+
+    subjects = list(
+        data_store.DB.ScanSubjects(
+            "aff4:/S", after_urn="aff4:/S/3", max_records=3,
+            token=self.token))
+    self.assertEqual(subjects, ["aff4:/S/3/child", "aff4:/S/4", "aff4:/S/5"])
+
+  def testCompression(self):
+    large = "x" * 10000
+    magic = data_store.ValueCompressor.MAGIC + "not compressed"
+
+    # Values stored before compression was enabled stay readable.
+    data_store.DB.Set("aff4:/compressed", "metadata:old", large,
+                      token=self.token)
+
+    with test_lib.ConfigOverrider({
+        "Datastore.compression_codec": "zlib",
+        "Datastore.compression_threshold": 100,
+        "Datastore.compressed_attributes": ["metadata:state/"]
+    }):
+      compressor = data_store.ValueCompressor()
+
+    # Attributes starting with one of the compressed_attributes are compressed
+    # whatever their size.
+    state = "y" * 50
+    self.assertTrue(
+        compressor.Compress("metadata:state/key", state).startswith(
+            data_store.ValueCompressor.MAGIC))
+    self.assertEqual(compressor.Compress("metadata:other", state), state)
+
+    with utils.Stubber(data_store.DB, "compressor", compressor):
+      data_store.DB.MultiSet(
+          "aff4:/compressed", {"metadata:large": [large],
+                               "metadata:small": ["small"],
+                               "metadata:magic": [magic],
+                               "metadata:state/key": [state]},
+          token=self.token)
+
+      values = dict((attribute, value)
+                    for attribute, value, _ in data_store.DB.ResolvePrefix(
+                        "aff4:/compressed", "metadata:", token=self.token))
+      self.assertEqual(values, {"metadata:old": large,
+                                "metadata:large": large,
+                                "metadata:small": "small",
+                                "metadata:magic": magic,
+                                "metadata:state/key": state})
+
   def testRDFDatetimeTimestamps(self):
 
     test_rows = self._MakeTimestampedRows()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+"""A data store which caches reads of another data store.
+
+Some subjects (the foreman, configuration and approvals) are read constantly
+but change rarely. This data store wraps the configured implementation and
+keeps the results of ResolvePrefix and MultiResolvePrefix for subjects
+matching CachingDataStore.subjects.
+
+Cached results expire after CachingDataStore.ttl seconds. In addition, every
+subject carries a generation which is bumped by each write going through this
+data store. A cached result is only used while the generation it was read at
+is still current, so a process always reads its own writes. Writes made with
+sync=False may only become visible once the data store is flushed, so their
+subjects are not cached until then.
+
+Writes made by other processes are only seen once the cached result expires,
+unless CachingDataStore.invalidation_channel is set. In that case each write
+to a cached subject is also recorded in the wrapped data store, which all
+processes poll to invalidate their own caches.
+"""
+
+
+import random
+import re
+import sys
+import threading
+import time
+
+from grr import config
+from grr.lib import data_store
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class CachedResult(object):
+  """A cached result, along with the generation it was read at."""
+
+  __slots__ = ("generation", "expires", "values")
+
+  def __init__(self, generation, expires, values):
+    self.generation = generation
+    self.expires = expires
+    self.values = values
+
+
+class CachingDataStore(data_store.WrappingDataStore):
+  """A read-through cache in front of another data store."""
+
+  INVALIDATION_SUBJECT = "aff4:/datastore_cache/invalidations"
+  INVALIDATION_PREFIX = "invalidate:"
+
+  implementation_option = "CachingDataStore.implementation"
+
+  def __init__(self):
+    patterns = config.CONFIG["CachingDataStore.subjects"]
+    self.subjects_regex = None
+    if patterns:
+      self.subjects_regex = re.compile(
+          "|".join("(?:%s)" % pattern for pattern in patterns))
+
+    self.ttl = config.CONFIG["CachingDataStore.ttl"]
+    self.results = utils.FastStore(
+        max_size=config.CONFIG["CachingDataStore.max_size"])
+    self.generations = {}
+    self.generations_lock = threading.RLock()
+    # Subjects written with sync=False, mapped to the number of the last such
+    # write. They are not cached until the data store is flushed.
+    self.unsynced = {}
+    self.unsynced_writes = 0
+
+    self.invalidation_channel = config.CONFIG[
+        "CachingDataStore.invalidation_channel"]
+    self.poll_interval = config.CONFIG[
+        "CachingDataStore.invalidation_poll_interval"]
+    self.last_poll = time.time()
+    # Invalidations are read back a while after they were written, since the
+    # clocks of other processes may be skewed.
+    self.invalidation_window = int(max(self.ttl, 60) * 1e6)
+    self.last_invalidations = {}
+    self.poll_lock = threading.Lock()
+    self.process_id = "%016x" % random.getrandbits(64)
+
+    super(CachingDataStore, self).__init__()
+
+  def _IsCached(self, subject):
+    return (self.subjects_regex is not None and
+            self.subjects_regex.match(subject) is not None)
+
+  def _Generation(self, subject):
+    with self.generations_lock:
+      return self.generations.get(subject, 0)
+
+  def _Invalidate(self, subjects):
+    """Invalidates cached results for the given subjects."""
+    with self.generations_lock:
+      for subject in subjects:
+        self.generations[subject] = self.generations.get(subject, 0) + 1
+
+  def _InvalidateWritten(self, subjects, sync=True):
+    """Invalidates subjects after a write, here and in other processes."""
+    subjects = [
+        s for s in set(utils.SmartStr(s) for s in subjects) if self._IsCached(s)
+    ]
+    if not subjects:
+      return
+
+    with self.generations_lock:
+      self._Invalidate(subjects)
+      if not sync:
+        self.unsynced_writes += 1
+        for subject in subjects:
+          self.unsynced[subject] = self.unsynced_writes
+
+    if self.invalidation_channel:
+      self.wrapped.MultiSet(
+          self.INVALIDATION_SUBJECT,
+          {self.INVALIDATION_PREFIX + s: [self.process_id]
+           for s in subjects},
+          sync=False)
+
+  def _PollInvalidations(self):
+    """Reads the invalidations written by other processes."""
+    if not self.invalidation_channel:
+      return
+
+    now = time.time()
+    if now < self.last_poll + self.poll_interval:
+      return
+
+    if not self.poll_lock.acquire(False):
+      return
+
+    try:
+      self.last_poll = now
+      start = max(0, int(now * 1e6) - self.invalidation_window)
+      records = self.wrapped.ResolvePrefix(
+          self.INVALIDATION_SUBJECT,
+          self.INVALIDATION_PREFIX,
+          timestamp=(start, sys.maxint))
+
+      invalidated = []
+      for attribute, process_id, timestamp in records:
+        subject = attribute[len(self.INVALIDATION_PREFIX):]
+        if self.last_invalidations.get(subject, 0) >= timestamp:
+          continue
+        self.last_invalidations[subject] = timestamp
+        # Our own writes were already invalidated.
+        if process_id != self.process_id:
+          invalidated.append(subject)
+
+      self._Invalidate(invalidated)
+
+      for subject, timestamp in self.last_invalidations.items():
+        if timestamp < start:
+          del self.last_invalidations[subject]
+    finally:
+      self.poll_lock.release()
+
+  def _CacheKey(self, subject, attribute_prefix, timestamp, limit):
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+    key = (subject, tuple(attribute_prefix), timestamp, limit)
+    try:
+      hash(key)
+    except TypeError:
+      return None
+    return key
+
+  def _GetCached(self, key):
+    """Returns the cached values for key, or None."""
+    try:
+      result = self.results.Get(key)
+    except KeyError:
+      return None
+
+    if (result.expires < time.time() or
+        result.generation != self._Generation(key[0])):
+      self.results.ExpireObject(key)
+      return None
+
+    return list(result.values)
+
+  def _PutCached(self, key, generation, values):
+    # Results read while the subject was being written, or before unsynced
+    # writes to it are visible, are not kept.
+    with self.generations_lock:
+      if (self.generations.get(key[0], 0) != generation or
+          key[0] in self.unsynced):
+        return
+      self.results.Put(key,
+                       CachedResult(generation,
+                                    time.time() + self.ttl, list(values)))
+
+  def ResolvePrefix(self,
+                    subject,
+                    attribute_prefix,
+                    timestamp=None,
+                    limit=None,
+                    token=None):
+    key = None
+    subject_str = utils.SmartStr(subject)
+    if self._IsCached(subject_str):
+      key = self._CacheKey(subject_str, attribute_prefix, timestamp, limit)
+
+    if key is None:
+      return self.wrapped.ResolvePrefix(
+          subject,
+          attribute_prefix,
+          timestamp=timestamp,
+          limit=limit,
+          token=token)
+
+    values = self._GetCached(key)
+    if values is not None:
+      stats.STATS.IncrementCounter("datastore_cache_hits")
+      # The values may have been read by MultiResolvePrefix, which doesn't
+      # sort them.
+      values.sort(key=lambda a: a[0])
+      return values
+
+    stats.STATS.IncrementCounter("datastore_cache_misses")
+    generation = self._Generation(subject_str)
+    values = self.wrapped.ResolvePrefix(
+        subject,
+        attribute_prefix,
+        timestamp=timestamp,
+        limit=limit,
+        token=token)
+    self._PutCached(key, generation, values)
+    return values
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None,
+                         token=None):
+    # A limit applies to all subjects together, so results can't be cached
+    # per subject.
+    if limit:
+      return self.wrapped.MultiResolvePrefix(
+          subjects,
+          attribute_prefix,
+          timestamp=timestamp,
+          limit=limit,
+          token=token)
+
+    results = []
+    # Subjects to read from the wrapped store, with their cache keys.
+    missing = []
+    keys = {}
+    generations = {}
+    for subject in subjects:
+      subject_str = utils.SmartStr(subject)
+      key = None
+      if self._IsCached(subject_str):
+        key = self._CacheKey(subject_str, attribute_prefix, timestamp, None)
+
+      if key is not None:
+        values = self._GetCached(key)
+        if values is not None:
+          stats.STATS.IncrementCounter("datastore_cache_hits")
+          if values:
+            results.append((subject, values))
+          continue
+
+        stats.STATS.IncrementCounter("datastore_cache_misses")
+        keys[subject_str] = key
+        generations[subject_str] = self._Generation(subject_str)
+
+      missing.append(subject)
+
+    if missing:
+      for subject, values in self.wrapped.MultiResolvePrefix(
+          missing, attribute_prefix, timestamp=timestamp, token=token):
+        subject_str = utils.SmartStr(subject)
+        key = keys.pop(subject_str, None)
+        if key is not None:
+          self._PutCached(key, generations[subject_str], values)
+        results.append((subject, values))
+
+      # Subjects without any value are cached too.
+      for subject_str, key in keys.iteritems():
+        self._PutCached(key, generations[subject_str], [])
+
+    return results
+
+  def Set(self,
+          subject,
+          attribute,
+          value,
+          timestamp=None,
+          token=None,
+          replace=True,
+          sync=True):
+    try:
+      self.wrapped.Set(
+          subject,
+          attribute,
+          value,
+          timestamp=timestamp,
+          token=token,
+          replace=replace,
+          sync=sync)
+    finally:
+      self._InvalidateWritten([subject], sync=sync)
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None,
+               token=None):
+    try:
+      self.wrapped.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          sync=sync,
+          to_delete=to_delete,
+          token=token)
+    finally:
+      self._InvalidateWritten([subject], sync=sync)
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True,
+                       token=None):
+    try:
+      self.wrapped.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=sync, token=token)
+    finally:
+      self._InvalidateWritten([subject], sync=sync)
+
+  def MultiDeleteAttributes(self,
+                            subjects,
+                            attributes,
+                            start=None,
+                            end=None,
+                            sync=True,
+                            token=None):
+    subjects = list(subjects)
+    try:
+      self.wrapped.MultiDeleteAttributes(
+          subjects, attributes, start=start, end=end, sync=sync, token=token)
+    finally:
+      self._InvalidateWritten(subjects, sync=sync)
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    try:
+      self.wrapped.DeleteSubject(subject, sync=sync, token=token)
+    finally:
+      self._InvalidateWritten([subject], sync=sync)
+
+  def DeleteSubjects(self, subjects, sync=False, token=None):
+    subjects = list(subjects)
+    try:
+      self.wrapped.DeleteSubjects(subjects, sync=sync, token=token)
+    finally:
+      self._InvalidateWritten(subjects, sync=sync)
+
+  def Clear(self):
+    super(CachingDataStore, self).Clear()
+    self.results.Flush()
+
+  def Flush(self):
+    with self.generations_lock:
+      flushed_writes = self.unsynced_writes
+
+    super(CachingDataStore, self).Flush()
+
+    # The unsynced writes made before the flush are visible now. Results read
+    # before that, at the current generation, may be stale.
+    with self.generations_lock:
+      flushed = [
+          subject for subject, write in self.unsynced.iteritems()
+          if write <= flushed_writes
+      ]
+      for subject in flushed:
+        del self.unsynced[subject]
+      self._Invalidate(flushed)
+
+    self._PollInvalidations()
+
+
+class CachingDataStoreInit(registry.InitHook):
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("datastore_cache_hits")
+    stats.STATS.RegisterCounterMetric("datastore_cache_misses")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Tests the caching data store."""
+
+
+
+from grr.lib import access_control
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+
+from grr.lib.data_stores import caching_data_store
+from grr.lib.data_stores import fake_data_store
+
+# pylint: mode=test
+
+
+class CachingDataStoreTest(data_store_test._DataStoreTest):
+  """Test the caching data store, caching all subjects."""
+
+  def InitDatastore(self):
+    self.token = access_control.ACLToken(
+        username="test", reason="Running tests")
+    with test_lib.ConfigOverrider({
+        "CachingDataStore.implementation": "FakeDataStore",
+        "CachingDataStore.subjects": ["aff4:/"]
+    }):
+      data_store.DB = caching_data_store.CachingDataStore()
+      data_store.DB.Initialize()
+
+  def testCorrectDataStore(self):
+    self.assertTrue(
+        isinstance(data_store.DB, caching_data_store.CachingDataStore))
+    self.assertTrue(
+        isinstance(data_store.DB.wrapped, fake_data_store.FakeDataStore))
+
+  def _CountReads(self):
+    reads = []
+    resolve_prefix = fake_data_store.FakeDataStore.ResolvePrefix
+
+    def CountingResolvePrefix(store, *args, **kwargs):
+      reads.append(args[0])
+      return resolve_prefix(store, *args, **kwargs)
+
+    return reads, utils.Stubber(fake_data_store.FakeDataStore, "ResolvePrefix",
+                                CountingResolvePrefix)
+
+  def testReadsAreCached(self):
+    subjects = ["aff4:/cached/%d" % i for i in range(10)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.Set(subject, "metadata:value", str(i), token=self.token)
+
+    reads, stubber = self._CountReads()
+    with stubber:
+      for _ in range(3):
+        results = dict(
+            data_store.DB.MultiResolvePrefix(
+                subjects + ["aff4:/cached/missing"],
+                "metadata:",
+                token=self.token))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(
+            data_store.DB.ResolvePrefix(
+                subjects[0], "metadata:", token=self.token)[0][1], "0")
+
+    # Subjects are only read once, including the one without any value.
+    self.assertEqual(len(reads), 11)
+
+  def testWritesInvalidate(self):
+    subject = "aff4:/cached/written"
+    data_store.DB.Set(subject, "metadata:value", "1", token=self.token)
+    self.assertEqual(
+        data_store.DB.ResolvePrefix(subject, "metadata:", token=self.token)[0]
+        [1], "1")
+
+    data_store.DB.Set(subject, "metadata:value", "2", token=self.token)
+    self.assertEqual(
+        data_store.DB.ResolvePrefix(subject, "metadata:", token=self.token)[0]
+        [1], "2")
+
+    data_store.DB.DeleteAttributes(
+        subject, ["metadata:value"], token=self.token)
+    self.assertEqual(
+        data_store.DB.ResolvePrefix(subject, "metadata:", token=self.token),
+        [])
+
+  def testUnsyncedWritesAreNotCachedUntilFlushed(self):
+    data_store.DB.flusher_thread.Stop()
+    subject = "aff4:/cached/unsynced"
+    data_store.DB.Set(
+        subject, "metadata:value", "1", sync=False, token=self.token)
+
+    reads, stubber = self._CountReads()
+    with stubber:
+      for _ in range(2):
+        data_store.DB.ResolvePrefix(subject, "metadata:", token=self.token)
+      self.assertEqual(len(reads), 2)
+
+      data_store.DB.Flush()
+      for _ in range(2):
+        data_store.DB.ResolvePrefix(subject, "metadata:", token=self.token)
+      self.assertEqual(len(reads), 3)
+
+  def testInvalidationChannel(self):
+    subject = "aff4:/cached/shared"
+
+    # Two processes using the same underlying data store.
+    with test_lib.ConfigOverrider({
+        "CachingDataStore.implementation": "FakeDataStore",
+        "CachingDataStore.subjects": ["aff4:/"],
+        "CachingDataStore.invalidation_channel": True
+    }):
+      writer = caching_data_store.CachingDataStore()
+      reader = caching_data_store.CachingDataStore()
+    reader.wrapped = writer.wrapped
+
+    writer.Set(subject, "metadata:value", "1", token=self.token)
+    self.assertEqual(
+        reader.ResolvePrefix(subject, "metadata:", token=self.token)[0][1], "1")
+
+    writer.Set(subject, "metadata:value", "2", token=self.token)
+
+    # The reader uses its cache until it reads the invalidations.
+    self.assertEqual(
+        reader.ResolvePrefix(subject, "metadata:", token=self.token)[0][1], "1")
+    reader.last_poll = 0
+    reader.Flush()
+    self.assertEqual(
+        reader.ResolvePrefix(subject, "metadata:", token=self.token)[0][1], "2")
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -268,17 +268,20 @@ class CloudBigTableDataStore(data_store.DataStore):
     if required_type in ("integer", "unsigned_integer"):
       return structs.VarintEncode(int(value))
     elif hasattr(value, "SerializeToString"):
-      return value.SerializeToString()
+      data = value.SerializeToString()
     else:
       # Types "string" and "bytes" are stored as strings here.
-      return utils.SmartStr(value)
+      data = utils.SmartStr(value)
+    return self.compressor.Compress(attribute, data)
 
   def Decode(self, attribute, value):
     """Decode the value to the required type."""
     required_type = self._attribute_types.get(attribute, "bytes")
     if required_type in ("integer", "unsigned_integer"):
       return structs.VarintReader(value, 0)[0]
-    elif required_type == "string":
+
+    value = self.compressor.Decompress(value)
+    if required_type == "string":
       return utils.SmartUnicode(value)
     else:
       return value
@@ -840,3 +843,34 @@ class CloudBigTableDataStore(data_store.DataStore):
         subject_results = self._ReOrderRowResults(row_data)
         results.append((subject, subject_results))
     return sorted(results, key=lambda x: x[0])
+
+  def ScanSubjects(self,
+                   subject_prefix,
+                   after_urn=None,
+                   max_records=None,
+                   token=None):
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = self._CleanAfterURN(after_urn, subject_prefix)
+
+    # Only the row keys are needed, a single stripped cell per row is enough
+    # to list them.
+    query_filter = row_filters.RowFilterChain([
+        row_filters.CellsRowLimitFilter(1),
+        row_filters.StripValueTransformerFilter(True)
+    ])
+
+    start_key = subject_prefix
+    if after_urn is not None:
+      start_key = after_urn + "\x00"
+    end_key = subject_prefix[:-1] + chr(ord(subject_prefix[-1]) + 1)
+
+    rows_data = self.CallWithRetry(
+        self.table.read_rows,
+        "read",
+        start_key=start_key,
+        end_key=end_key,
+        limit=max_records,
+        filter_=query_filter)
+    self.CallWithRetry(rows_data.consume_all, "read")
+
+    return iter(sorted(rows_data.rows or []))
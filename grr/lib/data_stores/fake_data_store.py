@@ -2,6 +2,8 @@
 """An implementation of an in-memory data store for testing."""
 
 
+import bisect
+import functools
 import sys
 import threading
 import time
@@ -30,22 +32,92 @@ class FakeDBSubjectLock(data_store.DBSubjectLock):
   def Release(self):
     with self.store.lock:
       if self.locked:
-        self.store.transactions.pop(self.subject, None)
+        # Only remove the lock if it has not expired and been taken over.
+        if self.store.transactions.get(self.subject) == self.expires:
+          del self.store.transactions[self.subject]
         self.locked = False
 
 
+class FakeRecord(dict):
+  """The attributes of a subject, which are also kept in sorted order."""
+
+  def __init__(self):
+    super(FakeRecord, self).__init__()
+    self.sorted_attributes = []
+
+  def __setitem__(self, attribute, values):
+    if attribute not in self:
+      bisect.insort(self.sorted_attributes, attribute)
+    super(FakeRecord, self).__setitem__(attribute, values)
+
+  def __delitem__(self, attribute):
+    super(FakeRecord, self).__delitem__(attribute)
+    del self.sorted_attributes[bisect.bisect_left(self.sorted_attributes,
+                                                  attribute)]
+
+  def pop(self, attribute, *default):
+    if attribute not in self and default:
+      return default[0]
+    values = self[attribute]
+    del self[attribute]
+    return values
+
+  def AttributesWithPrefix(self, prefix):
+    """Returns the sorted attributes starting with prefix."""
+    attributes = self.sorted_attributes
+    result = []
+    for i in xrange(bisect.bisect_left(attributes, prefix), len(attributes)):
+      if not attributes[i].startswith(prefix):
+        break
+      result.append(attributes[i])
+    return result
+
+
+def SubjectSynchronized(f):
+  """Holds the lock stripe of the subject passed as first argument."""
+
+  @functools.wraps(f)
+  def NewFunction(self, subject, *args, **kw):
+    with self.SubjectLock(subject):
+      return f(self, subject, *args, **kw)
+
+  return NewFunction
+
+
 class FakeDataStore(data_store.DataStore):
   """A fake data store - Everything is in memory."""
 
+  # Subjects are hashed onto this many locks.
+  LOCK_STRIPES = 64
+
   def __init__(self):
     super(FakeDataStore, self).__init__()
     self.subjects = {}
+    self.sorted_subjects = []
 
-    # All access to the store must hold this lock.
+    # Adding or removing subjects and transactions must hold this lock. It
+    # may be taken while holding a subject lock, but not the other way round.
     self.lock = threading.RLock()
+    # All access to a subject's record must hold its lock stripe.
+    self.subject_locks = [
+        threading.RLock() for _ in xrange(self.LOCK_STRIPES)
+    ]
     # The set of all transactions in flight.
     self.transactions = {}
 
+  def SubjectLock(self, subject):
+    subject = utils.SmartUnicode(subject)
+    return self.subject_locks[hash(subject) % self.LOCK_STRIPES]
+
+  def _GetRecord(self, subject, create=False):
+    """Returns the record of a subject, must hold the subject's lock."""
+    record = self.subjects.get(subject)
+    if record is None and create:
+      with self.lock:
+        record = self.subjects[subject] = FakeRecord()
+        bisect.insort(self.sorted_subjects, subject)
+    return record
+
   def _Encode(self, value):
     """Encode the value into a Binary BSON object.
 
@@ -73,23 +145,27 @@ class FakeDataStore(data_store.DataStore):
       except AttributeError:
         return utils.SmartStr(value)
 
-  @utils.Synchronized
+  @SubjectSynchronized
   def DeleteSubject(self, subject, sync=False, token=None):
     _ = sync
     subject = utils.SmartUnicode(subject)
-    try:
-      del self.subjects[subject]
-    except KeyError:
-      pass
+    with self.lock:
+      try:
+        del self.subjects[subject]
+      except KeyError:
+        return
+      del self.sorted_subjects[bisect.bisect_left(self.sorted_subjects,
+                                                  subject)]
 
   @utils.Synchronized
   def Clear(self):
     self.subjects = {}
+    self.sorted_subjects = []
 
   def DBSubjectLock(self, subject, lease_time=None, token=None):
     return FakeDBSubjectLock(self, subject, lease_time=lease_time, token=token)
 
-  @utils.Synchronized
+  @SubjectSynchronized
   def Set(self,
           subject,
           attribute,
@@ -108,17 +184,18 @@ class FakeDataStore(data_store.DataStore):
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       timestamp = time.time() * 1000000
 
-    if subject not in self.subjects:
-      self.subjects[subject] = {}
+    record = self._GetRecord(subject, create=True)
 
-    if replace or attribute not in self.subjects[subject]:
-      self.subjects[subject][attribute] = []
+    if replace or attribute not in record:
+      record[attribute] = []
 
-    self.subjects[subject][attribute].append(
-        [self._Encode(value), int(timestamp)])
-    self.subjects[subject][attribute].sort(key=lambda x: x[1])
+    values = record[attribute]
+    values.append([self._Encode(value), int(timestamp)])
+    # Values are kept sorted by timestamp, most writes are in order.
+    if len(values) > 1 and values[-2][1] > values[-1][1]:
+      values.sort(key=lambda x: x[1])
 
-  @utils.Synchronized
+  @SubjectSynchronized
   def MultiSet(self,
                subject,
                values,
@@ -148,7 +225,7 @@ class FakeDataStore(data_store.DataStore):
             replace=replace,
             sync=sync)
 
-  @utils.Synchronized
+  @SubjectSynchronized
   def DeleteAttributes(self,
                        subject,
                        attributes,
@@ -163,32 +240,29 @@ class FakeDataStore(data_store.DataStore):
           "String passed to DeleteAttributes (non string iterable expected).")
 
     subject = utils.SmartUnicode(subject)
-    try:
-      record = self.subjects[subject]
-      keys_to_delete = []
-      for name, values in record.iteritems():
-        if name not in attributes:
-          continue
+    record = self._GetRecord(subject)
+    if record is None:
+      return
 
-        start = start or 0
-        if end is None:
-          end = (2**63) - 1  # sys.maxint
-        new_values = []
-        for value, timestamp in values:
-          if not start <= timestamp <= end:
-            new_values.append((value, int(timestamp)))
+    start = start or 0
+    if end is None:
+      end = (2**63) - 1  # sys.maxint
 
-        if new_values:
-          record[name] = new_values
-        else:
-          keys_to_delete.append(name)
+    for name in set(utils.SmartUnicode(a) for a in attributes):
+      values = record.get(name)
+      if values is None:
+        continue
 
-      for key in keys_to_delete:
-        record.pop(key)
-    except KeyError:
-      pass
+      new_values = []
+      for value, timestamp in values:
+        if not start <= timestamp <= end:
+          new_values.append((value, int(timestamp)))
+
+      if new_values:
+        record[name] = new_values
+      else:
+        del record[name]
 
-  @utils.Synchronized
   def ScanAttributes(self,
                      subject_prefix,
                      attributes,
@@ -196,33 +270,81 @@ class FakeDataStore(data_store.DataStore):
                      max_records=None,
                      token=None,
                      relaxed_order=False):
-    subject_prefix = utils.SmartStr(rdfvalue.RDFURN(subject_prefix))
+    subject_prefix = utils.SmartUnicode(rdfvalue.RDFURN(subject_prefix))
     if subject_prefix[-1] != "/":
       subject_prefix += "/"
     if after_urn:
       after_urn = utils.SmartUnicode(after_urn)
-    subjects = []
-    for s in self.subjects.keys():
-      if s.startswith(subject_prefix) and s > after_urn:
-        subjects.append(s)
-    subjects.sort()
+
+    with self.lock:
+      sorted_subjects = self.sorted_subjects
+      first = bisect.bisect_left(sorted_subjects, max(subject_prefix,
+                                                      after_urn))
+      subjects = []
+      for i in xrange(first, len(sorted_subjects)):
+        s = sorted_subjects[i]
+        if not s.startswith(subject_prefix):
+          break
+        if s > after_urn:
+          subjects.append(s)
 
     return_count = 0
     for s in subjects:
       if max_records and return_count >= max_records:
         break
-      r = self.subjects[s]
       results = {}
-      for attribute in attributes:
-        attribute_list = r.get(attribute)
-        if attribute_list:
-          value, timestamp = attribute_list[-1]
-          results[attribute] = (timestamp, value)
+      with self.SubjectLock(s):
+        r = self._GetRecord(s)
+        if r is None:
+          continue
+        for attribute in attributes:
+          attribute_list = r.get(attribute)
+          if attribute_list:
+            value, timestamp = attribute_list[-1]
+            results[attribute] = (timestamp, value)
       if results:
         return_count += 1
         yield (s, results)
 
-  @utils.Synchronized
+  def ScanSubjects(self,
+                   subject_prefix,
+                   after_urn=None,
+                   max_records=None,
+                   token=None):
+    subject_prefix = utils.SmartUnicode(rdfvalue.RDFURN(subject_prefix))
+    if subject_prefix[-1] != "/":
+      subject_prefix += "/"
+    after_urn = utils.SmartUnicode(after_urn or "")
+
+    with self.lock:
+      sorted_subjects = self.sorted_subjects
+      first = bisect.bisect_left(sorted_subjects, max(subject_prefix,
+                                                      after_urn))
+      subjects = []
+      for i in xrange(first, len(sorted_subjects)):
+        if max_records and len(subjects) >= max_records:
+          break
+        s = sorted_subjects[i]
+        if not s.startswith(subject_prefix):
+          break
+        if s > after_urn and self.subjects.get(s):
+          subjects.append(s)
+
+    return iter(subjects)
+
+  def _SelectValues(self, values, timestamp, start, end):
+    """Returns the (value, timestamp) pairs to return, newest first."""
+    if not values:
+      return []
+    elif timestamp == self.NEWEST_TIMESTAMP:
+      # Values are sorted by timestamp, return the newest ones.
+      newest = values[-1][1]
+      selected = [v for v in values if v[1] == newest]
+    else:
+      selected = [v for v in values if start <= v[1] <= end]
+    selected.reverse()
+    return selected
+
   def ResolveMulti(self,
                    subject,
                    attributes,
@@ -243,47 +365,25 @@ class FakeDataStore(data_store.DataStore):
     if isinstance(attributes, str):
       attributes = [attributes]
 
-    try:
-      record = self.subjects[subject]
-    except KeyError:
-      return
+    # Return the results in the same order they requested.
+    results = []
+    with self.SubjectLock(subject):
+      record = self._GetRecord(subject)
+      if record is None:
+        return
 
-    # Holds all the attributes which matched. Keys are attribute names, values
-    # are lists of timestamped data.
-    results = {}
-    for attribute in attributes:
-      for attr, values in record.iteritems():
-        if attr == attribute:
-          for value, ts in values:
-            results_list = results.setdefault(attribute, [])
-            # If we are always after the latest ts we clear older ones.
-            if (results_list and timestamp == self.NEWEST_TIMESTAMP and
-                results_list[0][1] < ts):
-              results_list = []
-              results[attribute] = results_list
-
-            # Timestamp outside the range, drop it.
-            elif ts < start or ts > end:
-              continue
-
-            results_list.append((attribute, ts, value))
+      for attribute in attributes:
+        for data, ts in self._SelectValues(
+            record.get(attribute), timestamp, start, end):
+          results.append((attribute, data, ts))
 
-    # Return the results in the same order they requested.
-    remaining_limit = limit
-    for attribute in attributes:
-      # This returns triples of (attribute_name, timestamp, data). We want to
-      # sort by timestamp.
-      for _, ts, data in sorted(
-          results.get(attribute, []), key=lambda x: x[1], reverse=True):
-        if remaining_limit:
-          remaining_limit -= 1
-          if remaining_limit == 0:
-            yield (attribute, data, ts)
-            return
-
-        yield (attribute, data, ts)
+        if limit and len(results) >= limit:
+          results = results[:limit]
+          break
+
+    for result in results:
+      yield result
 
-  @utils.Synchronized
   def MultiResolvePrefix(self,
                          subjects,
                          attribute_prefix,
@@ -319,7 +419,7 @@ class FakeDataStore(data_store.DataStore):
   def Flush(self):
     pass
 
-  @utils.Synchronized
+  @SubjectSynchronized
   def ResolvePrefix(self,
                     subject,
                     attribute_prefix,
@@ -343,45 +443,27 @@ class FakeDataStore(data_store.DataStore):
     if isinstance(attribute_prefix, str):
       attribute_prefix = [attribute_prefix]
 
-    subject = utils.SmartUnicode(subject)
-    try:
-      record = self.subjects[subject]
-    except KeyError:
+    record = self._GetRecord(subject)
+    if record is None:
       return []
 
-    # Holds all the attributes which matched. Keys are attribute names, values
-    # are lists of timestamped data.
-    results = {}
-    nr_results = 0
-    for prefix in attribute_prefix:
-      for attribute, values in record.iteritems():
-        if limit and nr_results >= limit:
-          break
-        if utils.SmartStr(attribute).startswith(prefix):
-          for value, ts in values:
-            results_list = results.setdefault(attribute, [])
-            # If we are always after the latest ts we clear older ones.
-            if (results_list and timestamp == self.NEWEST_TIMESTAMP and
-                results_list[0][1] < ts):
-              results_list = []
-              results[attribute] = results_list
-
-            # Timestamp outside the range, drop it.
-            elif ts < start or ts > end:
-              continue
-
-            results_list.append((attribute, ts, value))
-            nr_results += 1
-            if limit and nr_results >= limit:
-              break
+    attribute_prefix = [utils.SmartUnicode(p) for p in attribute_prefix]
+    if len(attribute_prefix) == 1:
+      attributes = record.AttributesWithPrefix(attribute_prefix[0])
+    else:
+      attributes = set()
+      for prefix in attribute_prefix:
+        attributes.update(record.AttributesWithPrefix(prefix))
+      attributes = sorted(attributes)
 
     result = []
-    for attribute_name, values in sorted(results.items()):
-      # Values are triples of (attribute_name, timestamp, data). We want to
-      # sort by timestamp.
-      for _, ts, data in sorted(values, key=lambda x: x[1], reverse=True):
+    for attribute in attributes:
+      for data, ts in self._SelectValues(record[attribute], timestamp, start,
+                                         end):
         # Return triples (attribute_name, data, timestamp).
-        result.append((attribute_name, data, ts))
+        result.append((attribute, data, ts))
+        if limit and len(result) >= limit:
+          return result
     return result
 
   def Size(self):
@@ -3,6 +3,10 @@
 
 
 
+import threading
+
+
+from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
 from grr.lib import test_lib
@@ -14,6 +18,100 @@ class FakeDataStoreTest(data_store_test._DataStoreTest):
   def testApi(self):
     """The fake datastore doesn't strictly conform to the api but this is ok."""
 
+  def testPrefixLookupsMatchLinearScan(self):
+    subject = "aff4:/prefixes"
+    attributes = [
+        "metadata:", "metadata:a", "metadata:a/", "metadata:a/b",
+        "metadata:a0", "metadata:ab", "metadata:b", "aff4:type"
+    ]
+    data_store.DB.MultiSet(
+        subject, dict((attribute, ["x"]) for attribute in attributes),
+        token=self.token)
+
+    for prefix in [
+        "", "metadata:", "metadata:a", "metadata:a/", "metadata:a/b",
+        "metadata:ab", "metadata:c", "aff4:"
+    ]:
+      found = [
+          attribute
+          for attribute, _, _ in data_store.DB.ResolvePrefix(
+              subject, prefix, token=self.token)
+      ]
+      expected = sorted(a for a in attributes if a.startswith(prefix))
+      self.assertEqual(found, expected, prefix)
+
+    subjects = [
+        "aff4:/scan/a", "aff4:/scan/a/", "aff4:/scan/a/b", "aff4:/scan/a/b/c",
+        "aff4:/scan/a0", "aff4:/scan/a0/b", "aff4:/scan/ab/c", "aff4:/scan/b/c"
+    ]
+    for s in subjects:
+      data_store.DB.Set(s, "metadata:a", "x", token=self.token)
+
+    for prefix in ["aff4:/scan", "aff4:/scan/a", "aff4:/scan/a/b",
+                   "aff4:/scan/a0", "aff4:/scan/c"]:
+      expected = sorted(s for s in subjects if s.startswith(prefix + "/"))
+      self.assertEqual(
+          list(data_store.DB.ScanSubjects(prefix, token=self.token)),
+          expected, prefix)
+      self.assertEqual([
+          s for s, _ in data_store.DB.ScanAttributes(
+              prefix, ["metadata:a"], token=self.token)
+      ], expected, prefix)
+
+  def testConcurrentWritesAndScans(self):
+    prefix = "aff4:/concurrent"
+    # These subjects are never deleted, scans must always return them.
+    stable = ["%s/stable%02d" % (prefix, i) for i in range(20)]
+    for subject in stable:
+      data_store.DB.Set(subject, "metadata:a", "x", token=self.token)
+
+    errors = []
+    stop = threading.Event()
+
+    def Writer(writer_id):
+      subjects = ["%s/w%d_%02d" % (prefix, writer_id, i) for i in range(20)]
+      try:
+        while not stop.is_set():
+          for subject in subjects:
+            data_store.DB.MultiSet(
+                subject, {"metadata:a": ["x"],
+                          "metadata:b": ["y"]},
+                token=self.token)
+          for subject in subjects:
+            data_store.DB.DeleteSubject(subject, token=self.token)
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+
+    def Scanner():
+      try:
+        while not stop.is_set():
+          scanned = list(data_store.DB.ScanSubjects(prefix, token=self.token))
+          self.assertEqual(scanned, sorted(set(scanned)))
+          self.assertTrue(set(stable).issubset(scanned))
+
+          scanned = [
+              s for s, _ in data_store.DB.ScanAttributes(
+                  prefix, ["metadata:a"], token=self.token)
+          ]
+          self.assertEqual(scanned, sorted(set(scanned)))
+          self.assertTrue(set(stable).issubset(scanned))
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+
+    threads = [threading.Thread(target=Writer, args=(i,)) for i in range(4)]
+    threads += [threading.Thread(target=Scanner) for _ in range(2)]
+    for thread in threads:
+      thread.start()
+
+    stop.wait(2)
+    stop.set()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(errors, [])
+    self.assertEqual(
+        list(data_store.DB.ScanSubjects(prefix, token=self.token)), stable)
+
 
 def main(args):
   test_lib.main(args)
@@ -115,6 +115,8 @@ class DataServerConnection(object):
         # request so that the server knows which ones were already applied.
         return False
       self.requests.pop()
+      for subresponse in response.responses:
+        CheckResponseStatus(subresponse)
     return True
 
   def _SendRequest(self, command):
@@ -270,6 +272,129 @@ class DataServerConnection(object):
     self.conn.close()
 
 
+class _QueuedCommand(object):
+  """A command waiting in a CommandBatcher."""
+
+  def __init__(self, command, sync):
+    self.command = command
+    self.sync = sync
+    self.done = False
+    self.response = None
+    self.error = None
+
+
+class CommandBatcher(object):
+  """Combines the commands of many threads into batches for a data server.
+
+  Threads queue their commands and take turns at sending everything queued so
+  far as a single BATCH command, so that concurrent commands to the same data
+  server share a round trip. At most one batch per connection to the server is
+  in flight at any time.
+  """
+
+  def __init__(self, server):
+    self.server = server
+    self.cond = threading.Condition()
+    self.queue = []
+    self.senders = 0
+    self.max_senders = server.max_connections
+    self.max_batch_size = config.CONFIG["HTTPDataStore.max_batch_size"]
+    self.max_pending_requests = config.CONFIG[
+        "HTTPDataStore.max_pending_requests"]
+
+  def Submit(self, command, sync):
+    """Sends a command to the data server, possibly with other commands.
+
+    Args:
+      command: A DataStoreCommand.
+      sync: If True, wait for the response of the command. Otherwise, return
+        as soon as the command was sent.
+
+    Returns:
+      The DataStoreResponse to the command if sync is set, None otherwise.
+
+    Raises:
+      The error raised for the response of the command, if any.
+    """
+    queued = _QueuedCommand(command, sync)
+    with self.cond:
+      self.queue.append(queued)
+
+    self._Drain(queued)
+    if queued.error is not None:
+      raise queued.error
+    return queued.response
+
+  def Flush(self):
+    """Sends all the queued commands."""
+    self._Drain(None)
+
+  def _Drain(self, until):
+    """Sends batches until the queue is empty or 'until' is done."""
+    while True:
+      with self.cond:
+        while True:
+          if until is not None and until.done:
+            return
+          if self.queue and self.senders < self.max_senders:
+            break
+          if until is None and not self.queue:
+            return
+          self.cond.wait()
+
+        batch = self.queue[:self.max_batch_size]
+        del self.queue[:len(batch)]
+        self.senders += 1
+
+      try:
+        self._SendBatch(batch)
+      finally:
+        with self.cond:
+          self.senders -= 1
+          self.cond.notify_all()
+
+  def _SendBatch(self, batch):
+    """Sends queued commands and hands out their responses."""
+    if len(batch) == 1:
+      command = batch[0].command
+    else:
+      command = rdf_data_server.DataStoreCommand(
+          command=rdf_data_server.DataStoreCommand.Command.BATCH,
+          commands=[queued.command for queued in batch])
+
+    try:
+      connection = self.server.GetConnection()
+      if connection.NumPendingRequests() >= self.max_pending_requests:
+        # Do not let responses to pipelined requests pile up.
+        connection.Sync()
+
+      if not any(queued.sync for queued in batch):
+        connection.MakeRequestAndContinue(command, None)
+      elif len(batch) == 1:
+        batch[0].response = connection.SyncAndMakeRequest(command)
+      else:
+        response = connection.SyncAndMakeRequest(command)
+        if len(response.responses) != len(batch):
+          raise HTTPDataStoreError(
+              "Expected %d responses from %s:%d, got %d." %
+              (len(batch), self.server.Address(), self.server.Port(),
+               len(response.responses)))
+        for queued, subresponse in zip(batch, response.responses):
+          try:
+            queued.response = CheckResponseStatus(subresponse)
+          except data_store.Error as e:
+            queued.error = e
+          except access_control.UnauthorizedAccess as e:
+            queued.error = e
+    except Exception as e:  # pylint: disable=broad-except
+      for queued in batch:
+        if queued.error is None:
+          queued.error = e
+    finally:
+      for queued in batch:
+        queued.done = True
+
+
 class DataServer(object):
   """A DataServer object contains connections a data server."""
 
@@ -281,6 +406,7 @@ class DataServer(object):
     self.max_connections = config.CONFIG["Dataserver.max_connections"]
     # Start with a single connection.
     self.connections = [DataServerConnection(self)]
+    self.batcher = CommandBatcher(self)
 
   def Port(self):
     return self.port
@@ -296,11 +422,12 @@ class DataServer(object):
       self.conn.close()
       self.conn = None
 
-  @utils.Synchronized
   def Sync(self):
-    for conn in self.connections:
-      # TODO(user): Consider adding error handling here.
-      conn.Sync()
+    self.batcher.Flush()
+    with self.lock:
+      for conn in self.connections:
+        # TODO(user): Consider adding error handling here.
+        conn.Sync()
 
   @utils.Synchronized
   def GetConnection(self):
@@ -464,8 +591,10 @@ class HTTPDataStore(data_store.DataStore):
 
   cache = None
   inquirer = None
+  last_size_update = 0
 
   def __init__(self):
+    self.mapping_lock = threading.Lock()
     super(HTTPDataStore, self).__init__()
     self.cache = RemoteMappingCache(1000)
     self.inquirer = self.cache.GetInquirer()
@@ -515,13 +644,10 @@ class HTTPDataStore(data_store.DataStore):
     return self._MakeRequestSyncOrAsync(request, typ, True)
 
   def _MakeRequestSyncOrAsync(self, request, typ, sync):
-    subject = request.subject[0]
-    server = self.GetServer(subject)
+    # Commands from concurrent threads to the same data server are batched.
+    server = self.cache.Get(request.subject[0])
     cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
-    if sync:
-      return server.SyncAndMakeRequest(cmd)
-    else:
-      return server.MakeRequestAndContinue(cmd, subject)
+    return server.batcher.Submit(cmd, sync)
 
   def _MakeRequestsForPrefix(self, prefix, typ, request):
     cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
@@ -604,6 +730,29 @@ class HTTPDataStore(data_store.DataStore):
     """MultiResolvePrefix."""
     typ = rdf_data_server.DataStoreCommand.Command.MULTI_RESOLVE_PREFIX
     results = {}
+    if not limit:
+      # Without a limit, each data server gets a single request for all its
+      # subjects.
+      servers = {}
+      for subject in subjects:
+        server = self.cache.Get(subject)
+        servers.setdefault(id(server), (server, []))[1].append(subject)
+
+      for server, server_subjects in servers.itervalues():
+        request = self._MakeRequest(
+            server_subjects, attribute_prefix, timestamp=timestamp, token=token)
+        subjects_by_urn = dict(
+            (utils.SmartStr(urn), subject)
+            for urn, subject in zip(request.subject, server_subjects))
+
+        cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
+        response = server.batcher.Submit(cmd, True)
+        for result_set in response.results:
+          subject = subjects_by_urn[utils.SmartStr(result_set.subject)]
+          results[subject] = [(pred, self._Decode(value), ts)
+                              for (pred, value, ts) in result_set.payload]
+      return results.iteritems()
+
     remaining_limit = limit
     for subject in subjects:
       request = self._MakeRequest(
@@ -619,11 +768,10 @@ class HTTPDataStore(data_store.DataStore):
         result_set = response.results[0]
         values = [(pred, self._Decode(value), ts)
                   for (pred, value, ts) in result_set.payload]
-        if limit:
-          if len(values) >= remaining_limit:
-            results[subject] = values[:remaining_limit]
-            return results.iteritems()
-          remaining_limit -= len(values)
+        if len(values) >= remaining_limit:
+          results[subject] = values[:remaining_limit]
+          return results.iteritems()
+        remaining_limit -= len(values)
 
         results[subject] = values
     return results.iteritems()
@@ -665,6 +813,33 @@ class HTTPDataStore(data_store.DataStore):
       for r in sorted(results, key=lambda x: x[0]):
         yield r
 
+  def ScanSubjects(self,
+                   subject_prefix,
+                   after_urn=None,
+                   max_records=None,
+                   token=None):
+    """ScanSubjects."""
+
+    subject_prefix = utils.SmartStr(rdfvalue.RDFURN(subject_prefix))
+    if subject_prefix[-1] != "/":
+      subject_prefix += "/"
+
+    typ = rdf_data_server.DataStoreCommand.Command.SCAN_SUBJECTS
+    subjects = [subject_prefix]
+    if after_urn:
+      subjects.append(after_urn)
+    request = self._MakeRequest(subjects, [], token=token, limit=max_records)
+
+    # Each server lists up to max_records subjects, the first ones of all of
+    # them are returned.
+    results = []
+    for response in self._MakeRequestsForPrefix(subject_prefix, typ, request):
+      results.extend(result.subject for result in response.results)
+    results.sort()
+    if max_records:
+      results = results[:max_records]
+    return iter(results)
+
   def MultiSet(self,
                subject,
                values,
@@ -817,6 +992,9 @@ class HTTPDataStore(data_store.DataStore):
     super(HTTPDataStore, self).Flush()
     if self.inquirer:
       self.inquirer.Flush()
+      if (time.time() >=
+          self.last_size_update + config.CONFIG["Dataserver.stats_frequency"]):
+        self._RenewMapping()
 
   def CloseConnections(self):
     if self.inquirer:
@@ -828,13 +1006,26 @@ class HTTPDataStore(data_store.DataStore):
       self.last_size += serv.state.size
     self.last_size_update = new_time
 
+  def _RenewMapping(self):
+    """Fetches the mapping again, the data servers may have rebalanced."""
+    with self.mapping_lock:
+      old_intervals = [(serv.interval.start, serv.interval.end)
+                       for serv in self.inquirer.GetMapping().servers]
+      mapping = self.inquirer.RenewMapping()
+      self._ComputeNewSize(mapping, time.time())
+      new_intervals = [(serv.interval.start, serv.interval.end)
+                       for serv in mapping.servers]
+      if new_intervals != old_intervals:
+        logging.info("Data server ranges changed, forgetting cached mapping.")
+        self.cache.Flush()
+      return mapping
+
   def Size(self):
     """Get size of data store."""
     now = time.time()
     if now < self.last_size_update + 60:
       return self.last_size
-    mapping = self.inquirer.RenewMapping()
-    self._ComputeNewSize(mapping, now)
+    self._RenewMapping()
     return self.last_size
 
 
@@ -8,6 +8,7 @@ import shutil
 import socket
 import tempfile
 import threading
+import time
 import unittest
 
 
@@ -204,6 +205,49 @@ class HTTPDataStoreTest(HTTPDataStoreMixin, data_store_test._DataStoreTest):
     # This just makes sure the datastore can actually initialize.
     pass
 
+  def testConcurrentCommandsAreBatched(self):
+    subjects = ["aff4:/batched/%d" % i for i in range(10)]
+    server = data_store.DB.cache.Get(subjects[0])
+    batcher = server.batcher
+
+    batch_sizes = []
+    handle_batch = data_server.DataServerHandler.HandleBatch
+
+    def CountingHandleBatch(handler, cmd, permissions):
+      batch_sizes.append(len(cmd.commands))
+      return handle_batch(handler, cmd, permissions)
+
+    def Write(subject):
+      data_store.DB.Set(subject, "metadata:value", subject, token=self.token)
+
+    with utils.Stubber(data_server.DataServerHandler, "HandleBatch",
+                       CountingHandleBatch):
+      # Keep the commands queued until all threads have submitted theirs.
+      with batcher.cond:
+        batcher.senders = batcher.max_senders
+
+      threads = [
+          threading.Thread(target=Write, args=(subject,))
+          for subject in subjects
+      ]
+      for thread in threads:
+        thread.start()
+
+      while len(batcher.queue) < len(subjects):
+        time.sleep(0.01)
+
+      with batcher.cond:
+        batcher.senders = 0
+        batcher.cond.notify_all()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(batch_sizes, [len(subjects)])
+    for subject in subjects:
+      value, _ = data_store.DB.Resolve(
+          subject, "metadata:value", token=self.token)
+      self.assertEqual(value, subject)
+
 
 def main(args):
   test_lib.main(args)
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+"""A data store which measures how another data store is used.
+
+Every call is recorded in the datastore_latency, datastore_rows and
+datastore_bytes metrics, split by method and by subject family (client queues,
+flows, hunts, blobs, indexes...). A sample of the calls is also used to keep
+track of the subjects accessed the most, which the stats server reports at
+/datastore_hot_subjects.
+"""
+
+
+import random
+import re
+import threading
+import time
+
+from grr import config
+from grr.lib import data_store
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+# Families of subjects the metrics are split by, checked in order. Subjects
+# matching none of them are counted as "other".
+SUBJECT_FAMILIES = [
+    ("client_queue", r"aff4:/C\.[0-9a-fA-F]{16}/tasks$"),
+    ("flow", r"aff4:/(C\.[0-9a-fA-F]{16}/)?flows/"),
+    ("hunt", r"aff4:/hunts/"),
+    ("worker_queue", r"aff4:/[A-Z](/|$)"),
+    ("blob", r"aff4:/blobs/"),
+    ("index", r"aff4:/index/"),
+    ("file", r"aff4:/files/"),
+    ("client", r"aff4:/C\.[0-9a-fA-F]{16}"),
+]
+
+LATENCY_BINS = [
+    0, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50
+]
+
+
+def _ValueSize(value):
+  if isinstance(value, basestring):
+    return len(value)
+  if isinstance(value, rdfvalue.RDFValue):
+    return len(value.SerializeToString())
+  return 8
+
+
+class InstrumentedDataStore(data_store.WrappingDataStore):
+  """Records metrics about the calls made to another data store."""
+
+  implementation_option = "InstrumentedDataStore.implementation"
+
+  def __init__(self):
+    self.families = [(name, re.compile(regex))
+                     for name, regex in SUBJECT_FAMILIES]
+    self.sample_rate = config.CONFIG[
+        "InstrumentedDataStore.hot_subjects_sample_rate"]
+    self.max_hot_subjects = config.CONFIG[
+        "InstrumentedDataStore.hot_subjects_max_tracked"]
+    self.hot_subjects = {}
+    self.hot_subjects_lock = threading.Lock()
+
+    super(InstrumentedDataStore, self).__init__()
+
+  def _Family(self, subject):
+    subject = utils.SmartUnicode(subject)
+    for name, regex in self.families:
+      if regex.match(subject):
+        return name
+    return "other"
+
+  def _CommonFamily(self, subjects):
+    families = set(self._Family(subject) for subject in subjects)
+    if len(families) == 1:
+      return families.pop()
+    return "mixed"
+
+  def _Sample(self, subject):
+    """Counts a sample of the accesses to subject."""
+    if random.random() >= self.sample_rate:
+      return
+
+    subject = utils.SmartUnicode(subject)
+    with self.hot_subjects_lock:
+      self.hot_subjects[subject] = self.hot_subjects.get(subject, 0) + 1
+
+      # Only the most accessed half of the subjects is kept when there are too
+      # many of them.
+      if len(self.hot_subjects) > self.max_hot_subjects:
+        kept = sorted(
+            self.hot_subjects.iteritems(), key=lambda x: x[1],
+            reverse=True)[:self.max_hot_subjects // 2]
+        self.hot_subjects = dict(kept)
+
+  def _Record(self, method, family, start, rows=0, size=0):
+    self._RecordLatency(
+        method, family, time.time() - start, rows=rows, size=size)
+
+  def _RecordLatency(self, method, family, latency, rows=0, size=0):
+    fields = [method, family]
+    stats.STATS.RecordEvent("datastore_latency", latency, fields=fields)
+    if rows:
+      stats.STATS.IncrementCounter("datastore_rows", rows, fields=fields)
+    if size:
+      stats.STATS.IncrementCounter("datastore_bytes", size, fields=fields)
+
+  def _RecordIterator(self, method, family, latency, iterator, count):
+    """Yields from iterator, recording the call once it is exhausted.
+
+    Only the time spent in the data store counts towards the latency, the
+    time the caller spends on each item is left out.
+
+    Args:
+      method: The name of the data store method.
+      family: The family of the subjects read.
+      latency: The time spent in the data store call which returned iterator.
+      iterator: The results of the call.
+      count: A function returning the rows and bytes of an item.
+
+    Yields:
+      The items of iterator.
+    """
+    iterator = iter(iterator)
+    rows = size = 0
+    try:
+      while True:
+        start = time.time()
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+        finally:
+          latency += time.time() - start
+
+        item_rows, item_size = count(item)
+        rows += item_rows
+        size += item_size
+        yield item
+    finally:
+      self._RecordLatency(method, family, latency, rows=rows, size=size)
+
+  def HotSubjects(self, count=None):
+    """Returns the subjects accessed the most.
+
+    Args:
+      count: Number of subjects to return, defaults to
+          InstrumentedDataStore.hot_subjects_report_size.
+
+    Returns:
+      A list of (subject, estimated number of accesses) tuples, the most
+      accessed first.
+    """
+    if count is None:
+      count = config.CONFIG["InstrumentedDataStore.hot_subjects_report_size"]
+
+    with self.hot_subjects_lock:
+      hot_subjects = sorted(
+          self.hot_subjects.iteritems(), key=lambda x: x[1], reverse=True)
+
+    return [(subject, int(samples / self.sample_rate))
+            for subject, samples in hot_subjects[:count]]
+
+  def ResolvePrefix(self,
+                    subject,
+                    attribute_prefix,
+                    timestamp=None,
+                    limit=None,
+                    token=None):
+    start = time.time()
+    self._Sample(subject)
+    results = super(InstrumentedDataStore, self).ResolvePrefix(
+        subject,
+        attribute_prefix,
+        timestamp=timestamp,
+        limit=limit,
+        token=token)
+    self._Record(
+        "ResolvePrefix",
+        self._Family(subject),
+        start,
+        rows=len(results),
+        size=sum(_ValueSize(value) for _, value, _ in results))
+    return results
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None,
+                         token=None):
+    start = time.time()
+    subjects = list(subjects)
+    for subject in subjects:
+      self._Sample(subject)
+
+    results = super(InstrumentedDataStore, self).MultiResolvePrefix(
+        subjects,
+        attribute_prefix,
+        timestamp=timestamp,
+        limit=limit,
+        token=token)
+
+    def Count(item):
+      values = item[1]
+      return len(values), sum(_ValueSize(value) for _, value, _ in values)
+
+    return self._RecordIterator("MultiResolvePrefix",
+                                self._CommonFamily(subjects),
+                                time.time() - start, results, Count)
+
+  def ResolveMulti(self,
+                   subject,
+                   attributes,
+                   timestamp=None,
+                   limit=None,
+                   token=None):
+    start = time.time()
+    self._Sample(subject)
+    results = list(
+        super(InstrumentedDataStore, self).ResolveMulti(
+            subject,
+            attributes,
+            timestamp=timestamp,
+            limit=limit,
+            token=token))
+    self._Record(
+        "ResolveMulti",
+        self._Family(subject),
+        start,
+        rows=len(results),
+        size=sum(_ValueSize(value) for _, value, _ in results))
+    return results
+
+  def Resolve(self, subject, attribute, token=None):
+    start = time.time()
+    self._Sample(subject)
+    value, timestamp = super(InstrumentedDataStore, self).Resolve(
+        subject, attribute, token=token)
+    if value is None:
+      self._Record("Resolve", self._Family(subject), start)
+    else:
+      self._Record(
+          "Resolve",
+          self._Family(subject),
+          start,
+          rows=1,
+          size=_ValueSize(value))
+    return value, timestamp
+
+  def ScanAttributes(self,
+                     subject_prefix,
+                     attributes,
+                     after_urn=None,
+                     max_records=None,
+                     token=None,
+                     relaxed_order=False):
+    start = time.time()
+    results = super(InstrumentedDataStore, self).ScanAttributes(
+        subject_prefix,
+        attributes,
+        after_urn=after_urn,
+        max_records=max_records,
+        token=token,
+        relaxed_order=relaxed_order)
+
+    def Count(item):
+      values = item[1]
+      return len(values), sum(_ValueSize(value) for _, value in
+                              values.itervalues())
+
+    return self._RecordIterator("ScanAttributes",
+                                self._Family(subject_prefix),
+                                time.time() - start, results, Count)
+
+  def DBSubjectLock(self, subject, lease_time=None, token=None):
+    start = time.time()
+    self._Sample(subject)
+    try:
+      return super(InstrumentedDataStore, self).DBSubjectLock(
+          subject, lease_time=lease_time, token=token)
+    finally:
+      self._Record("DBSubjectLock", self._Family(subject), start)
+
+  def Set(self,
+          subject,
+          attribute,
+          value,
+          timestamp=None,
+          token=None,
+          replace=True,
+          sync=True):
+    start = time.time()
+    self._Sample(subject)
+    super(InstrumentedDataStore, self).Set(
+        subject,
+        attribute,
+        value,
+        timestamp=timestamp,
+        token=token,
+        replace=replace,
+        sync=sync)
+    self._Record(
+        "Set", self._Family(subject), start, rows=1, size=_ValueSize(value))
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None,
+               token=None):
+    start = time.time()
+    self._Sample(subject)
+    super(InstrumentedDataStore, self).MultiSet(
+        subject,
+        values,
+        timestamp=timestamp,
+        replace=replace,
+        sync=sync,
+        to_delete=to_delete,
+        token=token)
+
+    rows = size = 0
+    for attribute_values in values.itervalues():
+      for value in attribute_values:
+        # Values may be given along with their timestamp.
+        if isinstance(value, (list, tuple)):
+          value = value[0]
+        rows += 1
+        size += _ValueSize(value)
+    self._Record("MultiSet", self._Family(subject), start, rows=rows, size=size)
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True,
+                       token=None):
+    call_start = time.time()
+    self._Sample(subject)
+    super(InstrumentedDataStore, self).DeleteAttributes(
+        subject, attributes, start=start, end=end, sync=sync, token=token)
+    self._Record(
+        "DeleteAttributes",
+        self._Family(subject),
+        call_start,
+        rows=len(attributes))
+
+  def MultiDeleteAttributes(self,
+                            subjects,
+                            attributes,
+                            start=None,
+                            end=None,
+                            sync=True,
+                            token=None):
+    call_start = time.time()
+    subjects = list(subjects)
+    for subject in subjects:
+      self._Sample(subject)
+    super(InstrumentedDataStore, self).MultiDeleteAttributes(
+        subjects, attributes, start=start, end=end, sync=sync, token=token)
+    self._Record(
+        "MultiDeleteAttributes",
+        self._CommonFamily(subjects),
+        call_start,
+        rows=len(subjects) * len(attributes))
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    start = time.time()
+    self._Sample(subject)
+    super(InstrumentedDataStore, self).DeleteSubject(
+        subject, sync=sync, token=token)
+    self._Record("DeleteSubject", self._Family(subject), start, rows=1)
+
+  def DeleteSubjects(self, subjects, sync=False, token=None):
+    start = time.time()
+    subjects = list(subjects)
+    for subject in subjects:
+      self._Sample(subject)
+    super(InstrumentedDataStore, self).DeleteSubjects(
+        subjects, sync=sync, token=token)
+    self._Record(
+        "DeleteSubjects",
+        self._CommonFamily(subjects),
+        start,
+        rows=len(subjects))
+
+  def ReadBlobs(self, identifiers, token=None):
+    start = time.time()
+    results = super(InstrumentedDataStore, self).ReadBlobs(
+        identifiers, token=token)
+    self._Record(
+        "ReadBlobs",
+        "blob",
+        start,
+        rows=len(results),
+        size=sum(len(blob or "") for blob in results.itervalues()))
+    return results
+
+  def StoreBlobs(self, contents, token=None):
+    start = time.time()
+    results = super(InstrumentedDataStore, self).StoreBlobs(
+        contents, token=token)
+    self._Record(
+        "StoreBlobs",
+        "blob",
+        start,
+        rows=len(contents),
+        size=sum(len(content) for content in contents))
+    return results
+
+  def BlobsExist(self, identifiers, token=None):
+    start = time.time()
+    results = super(InstrumentedDataStore, self).BlobsExist(
+        identifiers, token=token)
+    self._Record("BlobsExist", "blob", start, rows=len(identifiers))
+    return results
+
+  def DeleteBlobs(self, identifiers, token=None):
+    start = time.time()
+    results = super(InstrumentedDataStore, self).DeleteBlobs(
+        identifiers, token=token)
+    self._Record("DeleteBlobs", "blob", start, rows=len(identifiers))
+    return results
+
+
+class InstrumentedDataStoreInit(registry.InitHook):
+
+  def RunOnce(self):
+    fields = [("method", str), ("family", str)]
+    stats.STATS.RegisterEventMetric(
+        "datastore_latency",
+        bins=LATENCY_BINS,
+        fields=fields,
+        docstring="Latency of data store calls.",
+        units=stats.MetricUnits.SECONDS)
+    stats.STATS.RegisterCounterMetric(
+        "datastore_rows",
+        fields=fields,
+        docstring="Number of values read, written or deleted.")
+    stats.STATS.RegisterCounterMetric(
+        "datastore_bytes",
+        fields=fields,
+        docstring="Size of the values read or written.",
+        units=stats.MetricUnits.BYTES)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Tests the instrumented data store."""
+
+
+
+import json
+
+
+from grr.lib import access_control
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import stats
+from grr.lib import test_lib
+
+from grr.lib.data_stores import fake_data_store
+from grr.lib.data_stores import instrumented_data_store
+
+from grr.server import stats_server
+
+# pylint: mode=test
+
+
+class InstrumentedDataStoreTest(data_store_test._DataStoreTest):
+  """Test the instrumented data store."""
+
+  def InitDatastore(self):
+    self.token = access_control.ACLToken(
+        username="test", reason="Running tests")
+    with test_lib.ConfigOverrider({
+        "InstrumentedDataStore.implementation": "FakeDataStore",
+        "InstrumentedDataStore.hot_subjects_sample_rate": 1.0
+    }):
+      data_store.DB = instrumented_data_store.InstrumentedDataStore()
+      data_store.DB.Initialize()
+
+  def testCorrectDataStore(self):
+    self.assertTrue(
+        isinstance(data_store.DB,
+                   instrumented_data_store.InstrumentedDataStore))
+    self.assertTrue(
+        isinstance(data_store.DB.wrapped, fake_data_store.FakeDataStore))
+
+  def testCallsAreMeasured(self):
+    subject = "aff4:/hunts/H:123456"
+    fields = ["MultiSet", "hunt"]
+    rows = stats.STATS.GetMetricValue("datastore_rows", fields=fields)
+    size = stats.STATS.GetMetricValue("datastore_bytes", fields=fields)
+
+    data_store.DB.MultiSet(
+        subject, {"metadata:a": ["12345"],
+                  "metadata:b": ["123", "45"]},
+        replace=False,
+        token=self.token)
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("datastore_rows", fields=fields), rows + 3)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("datastore_bytes", fields=fields),
+        size + 10)
+
+    fields = ["MultiResolvePrefix", "hunt"]
+    latency = stats.STATS.GetMetricValue("datastore_latency", fields=fields)
+    rows = stats.STATS.GetMetricValue("datastore_rows", fields=fields)
+    count = latency.count
+
+    results = list(
+        data_store.DB.MultiResolvePrefix(
+            [subject], "metadata:", token=self.token))
+    self.assertEqual(len(results), 1)
+
+    latency = stats.STATS.GetMetricValue("datastore_latency", fields=fields)
+    self.assertEqual(latency.count, count + 1)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("datastore_rows", fields=fields), rows + 3)
+
+  def testIteratorLatencyExcludesCaller(self):
+    subjects = ["aff4:/hunts/H:%d" % i for i in range(3)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:a", "value", token=self.token)
+
+    fields = ["MultiResolvePrefix", "hunt"]
+    latency = stats.STATS.GetMetricValue("datastore_latency", fields=fields)
+    total = latency.sum
+
+    with test_lib.FakeTime(1000) as fake_time:
+      for _ in data_store.DB.MultiResolvePrefix(
+          subjects, "metadata:", token=self.token):
+        # The caller takes a while to use each result.
+        fake_time.time += 10
+
+    latency = stats.STATS.GetMetricValue("datastore_latency", fields=fields)
+    self.assertLess(latency.sum - total, 10)
+
+  def testHotSubjects(self):
+    for i in range(5):
+      for _ in range(i + 1):
+        data_store.DB.ResolvePrefix(
+            "aff4:/hot/%d" % i, "metadata:", token=self.token)
+
+    hot_subjects = data_store.DB.HotSubjects(count=2)
+    self.assertEqual(hot_subjects, [("aff4:/hot/4", 5), ("aff4:/hot/3", 4)])
+
+    report = json.loads(stats_server.BuildHotSubjectsJsonString())
+    self.assertEqual(report[0], {"subject": "aff4:/hot/4", "accesses": 5})
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,903 @@
+#!/usr/bin/env python
+"""A log structured data store for a single server.
+
+All mutations are appended to a log and applied to an in-memory table of rows
+(the memtable). Once the memtable grows large enough it is written out as an
+immutable segment file which is sorted by subject and read through mmap using
+a sparse index. A background thread merges segments once there are too many of
+them.
+
+Rows are kept in a canonical form: an optional subject tombstone, a set of
+attribute ranges that were deleted and the cells that were written afterwards.
+Reading a row folds the row versions of all segments and memtables, oldest
+first. Since the fold of two canonical rows is again a canonical row, the log,
+the memtables and the segments all use the same row encoding.
+
+The data store directory can only be used by a single process at a time. Use
+the data server to share it between processes.
+"""
+
+
+import bisect
+import fcntl
+import heapq
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+import logging
+
+from grr import config
+from grr.lib import data_store
+from grr.lib import utils
+from grr.lib.data_stores import common
+from grr.lib.rdfvalues import structs
+
+MAX_TIMESTAMP = (2**63) - 1
+
+SEGMENT_MAGIC = "GRRLSS01"
+SEGMENT_EXTENSION = ".seg"
+LOG_EXTENSION = ".log"
+LOCK_FILENAME = "LOCK"
+
+SEGMENT_RE = re.compile(r"^segment-(\d{8})-(\d{8})\.seg$")
+LOG_RE = re.compile(r"^log-(\d{8})\.log$")
+
+INT64 = struct.Struct("<q")
+FOOTER = struct.Struct("<Q8s")
+CRC = struct.Struct("<I")
+
+
+def _EncodeString(data):
+  return structs.VarintEncode(len(data)) + data
+
+
+def _DecodeString(buf, pos):
+  length, pos = structs.VarintReader(buf, pos)
+  return buf[pos:pos + length], pos + length
+
+
+def _EncodeValue(value):
+  """Encodes a data store value, keeping its type."""
+  if isinstance(value, str):
+    return "b" + _EncodeString(value)
+  elif isinstance(value, unicode):
+    return "u" + _EncodeString(value.encode("utf-8"))
+  elif isinstance(value, (int, long)):
+    return "i" + _EncodeString("%d" % value)
+  elif isinstance(value, float):
+    return "f" + _EncodeString(repr(value))
+
+  raise ValueError("Unsupported value type %s." % type(value))
+
+
+def _DecodeValue(buf, pos):
+  tag = buf[pos]
+  data, pos = _DecodeString(buf, pos + 1)
+  if tag == "b":
+    return data, pos
+  elif tag == "u":
+    return data.decode("utf-8"), pos
+  elif tag == "i":
+    return int(data), pos
+  elif tag == "f":
+    return float(data), pos
+
+  raise data_store.Error("Unknown value tag %r." % tag)
+
+
+class Row(object):
+  """A row in canonical form.
+
+  Attributes:
+    tombstone: If True, all older versions of this row are ignored.
+    deletes: A dict mapping attributes to lists of deleted (start, end)
+             timestamp ranges. They apply to older versions of this row.
+    cells: A dict mapping attributes to lists of (timestamp, value) tuples in
+           the order they were written.
+  """
+
+  __slots__ = ("tombstone", "deletes", "cells")
+
+  def __init__(self, tombstone=False, deletes=None, cells=None):
+    self.tombstone = tombstone
+    self.deletes = deletes or {}
+    self.cells = cells or {}
+
+  def Set(self, attribute, timestamp, value):
+    self.cells.setdefault(attribute, []).append((timestamp, value))
+
+  def Delete(self, attribute, start, end):
+    """Deletes the cells of attribute within a timestamp range."""
+    values = self.cells.get(attribute)
+    if values:
+      values = [(ts, v) for ts, v in values if not start <= ts <= end]
+      if values:
+        self.cells[attribute] = values
+      else:
+        del self.cells[attribute]
+
+    if self.tombstone:
+      # There is nothing older left to delete from.
+      return
+
+    ranges = self.deletes.setdefault(attribute, [])
+    for range_start, range_end in ranges:
+      if range_start <= start and end <= range_end:
+        return
+    ranges.append((start, end))
+
+  def DeleteSubject(self):
+    self.tombstone = True
+    self.deletes = {}
+    self.cells = {}
+
+  def Apply(self, newer):
+    """Applies a newer version of the row to this one."""
+    if newer.tombstone:
+      self.DeleteSubject()
+    else:
+      for attribute, ranges in newer.deletes.iteritems():
+        for start, end in ranges:
+          self.Delete(attribute, start, end)
+
+    for attribute, values in newer.cells.iteritems():
+      self.cells.setdefault(attribute, []).extend(values)
+
+  def Encode(self):
+    """Serializes the row."""
+    result = ["\x01" if self.tombstone else "\x00"]
+
+    result.append(structs.VarintEncode(len(self.deletes)))
+    for attribute, ranges in self.deletes.iteritems():
+      result.append(_EncodeString(utils.SmartStr(attribute)))
+      result.append(structs.VarintEncode(len(ranges)))
+      for start, end in ranges:
+        result.append(INT64.pack(start))
+        result.append(INT64.pack(end))
+
+    result.append(structs.VarintEncode(len(self.cells)))
+    for attribute, values in self.cells.iteritems():
+      result.append(_EncodeString(utils.SmartStr(attribute)))
+      result.append(structs.VarintEncode(len(values)))
+      for timestamp, value in values:
+        result.append(INT64.pack(timestamp))
+        result.append(_EncodeValue(value))
+
+    return "".join(result)
+
+  @classmethod
+  def Decode(cls, buf):
+    """Parses a row serialized with Encode()."""
+    row = cls(tombstone=buf[0] == "\x01")
+    pos = 1
+
+    count, pos = structs.VarintReader(buf, pos)
+    for _ in xrange(count):
+      attribute, pos = _DecodeString(buf, pos)
+      num_ranges, pos = structs.VarintReader(buf, pos)
+      ranges = []
+      for _ in xrange(num_ranges):
+        start, end = INT64.unpack_from(buf, pos)[0], INT64.unpack_from(
+            buf, pos + 8)[0]
+        ranges.append((start, end))
+        pos += 16
+      row.deletes[attribute.decode("utf-8")] = ranges
+
+    count, pos = structs.VarintReader(buf, pos)
+    for _ in xrange(count):
+      attribute, pos = _DecodeString(buf, pos)
+      num_values, pos = structs.VarintReader(buf, pos)
+      values = []
+      for _ in xrange(num_values):
+        timestamp = INT64.unpack_from(buf, pos)[0]
+        value, pos = _DecodeValue(buf, pos + 8)
+        values.append((timestamp, value))
+      row.cells[attribute.decode("utf-8")] = values
+
+    return row
+
+
+class Memtable(object):
+  """The rows written since the last segment was created."""
+
+  def __init__(self, log_numbers):
+    self.rows = {}
+    # All subjects in this memtable, sorted for scanning.
+    self.subjects = []
+    self.size = 0
+    # The logs that have to be replayed to recreate this memtable.
+    self.log_numbers = log_numbers
+
+  def Apply(self, subject, delta, size):
+    row = self.rows.get(subject)
+    if row is None:
+      self.rows[subject] = row = Row()
+      bisect.insort(self.subjects, subject)
+    row.Apply(delta)
+    self.size += size
+
+  def Get(self, subject):
+    return self.rows.get(subject)
+
+  def SubjectRange(self, start, end):
+    """Returns the sorted subjects in the range [start, end)."""
+    return self.subjects[bisect.bisect_left(self.subjects, start):
+                         bisect.bisect_left(self.subjects, end)]
+
+
+class Segment(object):
+  """An immutable file of rows sorted by subject.
+
+  The file consists of a magic header, the (subject, row) records, the sparse
+  index, and a footer holding the offset of the index.
+  """
+
+  def __init__(self, path, first_log, last_log):
+    self.path = path
+    self.first_log = first_log
+    self.last_log = last_log
+
+    with open(path, "rb") as fd:
+      self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    index_offset, magic = FOOTER.unpack_from(self.data,
+                                             len(self.data) - FOOTER.size)
+    if magic != SEGMENT_MAGIC or self.data[:len(SEGMENT_MAGIC)] != magic:
+      raise data_store.Error("%s is not a valid segment." % path)
+    self.data_end = index_offset
+
+    self.index_subjects = []
+    self.index_offsets = []
+    count, pos = structs.VarintReader(self.data, index_offset)
+    for _ in xrange(count):
+      subject, pos = _DecodeString(self.data, pos)
+      offset, pos = structs.VarintReader(self.data, pos)
+      self.index_subjects.append(subject)
+      self.index_offsets.append(offset)
+
+  @classmethod
+  def Write(cls, path, rows, first_log, last_log, index_interval):
+    """Writes a segment from (subject, Row) tuples sorted by subject."""
+    tmp_path = path + ".tmp"
+    index = []
+    with open(tmp_path, "wb") as fd:
+      fd.write(SEGMENT_MAGIC)
+      offset = len(SEGMENT_MAGIC)
+      for i, (subject, row) in enumerate(rows):
+        if i % index_interval == 0:
+          index.append((subject, offset))
+        record = _EncodeString(subject) + _EncodeString(row.Encode())
+        fd.write(record)
+        offset += len(record)
+
+      index_data = [structs.VarintEncode(len(index))]
+      for subject, subject_offset in index:
+        index_data.append(_EncodeString(subject))
+        index_data.append(structs.VarintEncode(subject_offset))
+      fd.write("".join(index_data))
+      fd.write(FOOTER.pack(offset, SEGMENT_MAGIC))
+
+      fd.flush()
+      os.fsync(fd.fileno())
+
+    os.rename(tmp_path, path)
+    return cls(path, first_log, last_log)
+
+  def Iterate(self, start=""):
+    """Yields (subject, serialized row) for subjects >= start."""
+    i = bisect.bisect_right(self.index_subjects, start) - 1
+    pos = self.index_offsets[max(i, 0)] if self.index_offsets else self.data_end
+
+    data = self.data
+    while pos < self.data_end:
+      subject, pos = _DecodeString(data, pos)
+      length, pos = structs.VarintReader(data, pos)
+      if subject >= start:
+        yield subject, data[pos:pos + length]
+      pos += length
+
+  def Get(self, subject):
+    """Returns the row of subject or None."""
+    i = bisect.bisect_right(self.index_subjects, subject) - 1
+    if i < 0:
+      return None
+
+    end = self.data_end
+    if i + 1 < len(self.index_offsets):
+      end = self.index_offsets[i + 1]
+
+    data = self.data
+    pos = self.index_offsets[i]
+    while pos < end:
+      current, pos = _DecodeString(data, pos)
+      length, pos = structs.VarintReader(data, pos)
+      if current == subject:
+        return Row.Decode(data[pos:pos + length])
+      elif current > subject:
+        return None
+      pos += length
+
+    return None
+
+  def Size(self):
+    return len(self.data)
+
+
+class LogStructuredDBSubjectLock(data_store.DBSubjectLock):
+  """A subject lock held in memory by the process owning the data store."""
+
+  def _Acquire(self, lease_time):
+    self.expires = int((time.time() + lease_time) * 1e6)
+    with self.store.lock:
+      expires = self.store.transactions.get(self.subject)
+      if expires and (time.time() * 1e6) < expires:
+        raise data_store.DBSubjectLockError("Subject %s is locked" %
+                                            self.subject)
+      self.store.transactions[self.subject] = self.expires
+      self.locked = True
+
+  def UpdateLease(self, duration):
+    with self.store.lock:
+      self.expires = int((time.time() + duration) * 1e6)
+      self.store.transactions[self.subject] = self.expires
+
+  def Release(self):
+    with self.store.lock:
+      if self.locked:
+        # Only remove the lock if it has not expired and been taken over.
+        if self.store.transactions.get(self.subject) == self.expires:
+          del self.store.transactions[self.subject]
+        self.locked = False
+
+
+class LogStructuredDataStore(data_store.DataStore):
+  """A data store using an append only log and sorted segment files."""
+
+  def __init__(self, path=None):
+    # All access to the memtables and the list of segments must hold this
+    # lock. Segments themselves are immutable.
+    self.lock = threading.RLock()
+    # Serializes writing memtables to segments.
+    self.flush_lock = threading.Lock()
+    self.compaction_lock = threading.Lock()
+    # The set of all transactions in flight.
+    self.transactions = {}
+
+    self.memtable_size = config.CONFIG["LogStructuredDatastore.memtable_size"]
+    self.index_interval = config.CONFIG[
+        "LogStructuredDatastore.index_interval"]
+    self.max_segments = config.CONFIG["LogStructuredDatastore.max_segments"]
+
+    self.log_file = None
+    self._Open(path or config.CONFIG["Datastore.location"])
+
+    super(LogStructuredDataStore, self).__init__()
+
+    self.compaction_thread = utils.InterruptableThread(
+        name="LogStructuredDataStore compaction thread",
+        target=self.Compact,
+        sleep_time=1)
+    self.compaction_thread.start()
+
+  def _Open(self, root_path):
+    """Opens the data store directory and replays the logs."""
+    self.root_path = root_path
+    if not os.path.isdir(root_path):
+      os.makedirs(root_path)
+
+    self.lock_file = open(os.path.join(root_path, LOCK_FILENAME), "a")
+    try:
+      fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      self.lock_file.close()
+      raise data_store.Error("Data store %s is used by another process." %
+                             root_path)
+
+    segments = []
+    logs = []
+    for filename in os.listdir(root_path):
+      path = os.path.join(root_path, filename)
+      if filename.endswith(".tmp"):
+        # Left over from an interrupted segment write.
+        os.unlink(path)
+        continue
+
+      match = SEGMENT_RE.match(filename)
+      if match:
+        segments.append((int(match.group(1)), int(match.group(2)), path))
+        continue
+
+      match = LOG_RE.match(filename)
+      if match:
+        logs.append((int(match.group(1)), path))
+
+    # A compaction might have been interrupted after writing its output but
+    # before removing its inputs, drop segments covered by larger ones.
+    live_segments = []
+    for first, last, path in sorted(segments, key=lambda x: (x[1], -x[0])):
+      while live_segments and live_segments[-1][0] >= first:
+        os.unlink(live_segments.pop()[2])
+      live_segments.append((first, last, path))
+
+    self.segments = [
+        Segment(path, first, last) for first, last, path in live_segments
+    ]
+
+    last_segment_log = self.segments[-1].last_log if self.segments else 0
+
+    replayed = []
+    self.memtable = Memtable(replayed)
+    for log_number, path in sorted(logs):
+      if log_number <= last_segment_log:
+        os.unlink(path)
+        continue
+      self._ReplayLog(path)
+      replayed.append(log_number)
+
+    # Memtables waiting to be written to segments, oldest first.
+    self.immutable_memtables = []
+
+    self.next_log_number = max([last_segment_log] + replayed) + 1
+    self._OpenLog()
+
+  def _LogPath(self, log_number):
+    return os.path.join(self.root_path, "log-%08d%s" % (log_number,
+                                                        LOG_EXTENSION))
+
+  def _SegmentPath(self, first_log, last_log):
+    return os.path.join(self.root_path, "segment-%08d-%08d%s" %
+                        (first_log, last_log, SEGMENT_EXTENSION))
+
+  def _OpenLog(self):
+    log_number = self.next_log_number
+    self.next_log_number += 1
+    self.log_file = open(self._LogPath(log_number), "ab")
+    self.memtable.log_numbers.append(log_number)
+
+  def _ReplayLog(self, path):
+    """Applies all complete records of a log to the memtable."""
+    with open(path, "rb") as fd:
+      data = fd.read()
+
+    pos = 0
+    while pos < len(data):
+      try:
+        length, start = structs.VarintReader(data, pos)
+        end = start + CRC.size + length
+        if end > len(data):
+          raise ValueError("Truncated record.")
+        (crc,) = CRC.unpack_from(data, start)
+        payload = data[start + CRC.size:end]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+          raise ValueError("Checksum mismatch.")
+      except (IndexError, ValueError) as e:
+        # The process probably died while writing this record.
+        logging.warning("Ignoring the tail of log %s: %s", path, e)
+        break
+
+      subject, row_start = _DecodeString(payload, 0)
+      self.memtable.Apply(subject, Row.Decode(payload[row_start:]), length)
+      pos = end
+
+  def _Write(self, subject, delta, sync=True):
+    """Logs a row delta and applies it to the memtable."""
+    subject = utils.SmartStr(subject)
+    payload = _EncodeString(subject) + delta.Encode()
+    record = "".join((structs.VarintEncode(len(payload)),
+                      CRC.pack(zlib.crc32(payload) & 0xffffffff), payload))
+
+    with self.lock:
+      self.log_file.write(record)
+      if sync:
+        self.log_file.flush()
+      self.memtable.Apply(subject, delta, len(payload))
+
+      if self.memtable.size >= self.memtable_size:
+        # The flusher thread writes the memtable to a segment.
+        self.log_file.close()
+        self.immutable_memtables.append(self.memtable)
+        self.memtable = Memtable([])
+        self._OpenLog()
+
+  def _Encode(self, attribute, value):
+    """Encodes a value to one of the types supported by the data store."""
+    if not isinstance(value, (basestring, int, long, float)):
+      try:
+        value = value.SerializeToDataStore()
+      except AttributeError:
+        try:
+          value = value.SerializeToString()
+        except AttributeError:
+          value = utils.SmartStr(value)
+
+    if isinstance(value, str):
+      return self.compressor.Compress(attribute, value)
+    return value
+
+  def _Decode(self, value):
+    if isinstance(value, str):
+      return self.compressor.Decompress(value)
+    return value
+
+  def _ReadRow(self, subject):
+    """Returns the current Row of subject."""
+    subject = utils.SmartStr(subject)
+    with self.lock:
+      segments = list(self.segments)
+      memtables = self.immutable_memtables + [self.memtable]
+
+    row = Row()
+    for segment in segments:
+      version = segment.Get(subject)
+      if version is not None:
+        row.Apply(version)
+
+    for memtable in memtables:
+      # Only the last memtable is still changing.
+      with self.lock:
+        version = memtable.Get(subject)
+        if version is not None:
+          row.Apply(version)
+
+    return row
+
+  def _GetStartEndTimestamp(self, timestamp):
+    if timestamp == self.ALL_TIMESTAMPS or timestamp is None:
+      return 0, MAX_TIMESTAMP
+    elif timestamp == self.NEWEST_TIMESTAMP:
+      return 0, MAX_TIMESTAMP
+    elif isinstance(timestamp, (list, tuple)):
+      start, end = timestamp
+      return int(start), int(end)
+    else:
+      return int(timestamp), int(timestamp)
+
+  def _SelectValues(self, values, timestamp, start, end):
+    """Returns (timestamp, value) in decreasing timestamp order."""
+    if timestamp == self.NEWEST_TIMESTAMP:
+      newest = None
+      for value in values:
+        if newest is None or value[0] >= newest[0]:
+          newest = value
+      return [newest] if newest else []
+
+    return sorted(
+        [v for v in values if start <= v[0] <= end],
+        key=lambda v: v[0],
+        reverse=True)
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None,
+               token=None):
+    """Set multiple values at once."""
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      timestamp = time.time() * 1000000
+
+    delta = Row()
+    for attribute in to_delete or []:
+      delta.Delete(utils.SmartUnicode(attribute), 0, MAX_TIMESTAMP)
+
+    for attribute, seq in values.items():
+      attribute = utils.SmartUnicode(attribute)
+      if replace:
+        delta.Delete(attribute, 0, MAX_TIMESTAMP)
+
+      for v in seq:
+        element_timestamp = None
+        if isinstance(v, (list, tuple)):
+          v, element_timestamp = v
+        if element_timestamp is None:
+          element_timestamp = timestamp
+
+        delta.Set(attribute, int(element_timestamp),
+                  self._Encode(attribute, v))
+
+    self._Write(subject, delta, sync=sync)
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True,
+                       token=None):
+    """Remove some attributes from a subject."""
+    if isinstance(attributes, basestring):
+      raise ValueError(
+          "String passed to DeleteAttributes (non string iterable expected).")
+
+    start = int(start or 0)
+    if end is None:
+      end = MAX_TIMESTAMP
+    end = min(int(end), MAX_TIMESTAMP)
+
+    delta = Row()
+    for attribute in attributes:
+      delta.Delete(utils.SmartUnicode(attribute), start, end)
+
+    self._Write(subject, delta, sync=sync)
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    self._Write(subject, Row(tombstone=True), sync=sync)
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None,
+                         token=None):
+    """Result multiple subjects using one or more attribute prefixes."""
+    result = {}
+
+    remaining_limit = limit
+    for subject in subjects:
+      values = self.ResolvePrefix(
+          subject,
+          attribute_prefix,
+          token=token,
+          timestamp=timestamp,
+          limit=remaining_limit)
+
+      if values:
+        if limit:
+          if len(values) >= remaining_limit:
+            result[subject] = values[:remaining_limit]
+            return result.iteritems()
+          remaining_limit -= len(values)
+        result[subject] = values
+
+    return result.iteritems()
+
+  def ResolvePrefix(self,
+                    subject,
+                    attribute_prefix,
+                    timestamp=None,
+                    limit=None,
+                    token=None):
+    """Resolve all attributes for a subject matching a prefix."""
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+
+    start, end = self._GetStartEndTimestamp(timestamp)
+    cells = self._ReadRow(subject).cells
+
+    results = []
+    for prefix in attribute_prefix:
+      for attribute in sorted(a for a in cells if a.startswith(prefix)):
+        for ts, value in self._SelectValues(cells[attribute], timestamp, start,
+                                            end):
+          results.append((attribute, self._Decode(value), ts))
+          if limit and len(results) >= limit:
+            return results
+
+    return results
+
+  def ResolveMulti(self,
+                   subject,
+                   attributes,
+                   timestamp=None,
+                   limit=None,
+                   token=None):
+    """Resolve multiple attributes for a subject."""
+    if isinstance(attributes, basestring):
+      attributes = [attributes]
+
+    start, end = self._GetStartEndTimestamp(timestamp)
+    cells = self._ReadRow(subject).cells
+
+    results = []
+    for attribute in attributes:
+      attribute = utils.SmartUnicode(attribute)
+      for ts, value in self._SelectValues(
+          cells.get(attribute, []), timestamp, start, end):
+        results.append((attribute, self._Decode(value), ts))
+        if limit and len(results) >= limit:
+          return results
+
+    return results
+
+  def _ScanRows(self, start, end):
+    """Yields (subject, Row) for all subjects in [start, end) in order."""
+    with self.lock:
+      segments = list(self.segments)
+      memtables = self.immutable_memtables + [self.memtable]
+      memtable_subjects = [m.SubjectRange(start, end) for m in memtables]
+
+    # Sources are ranked by age so the heap yields versions oldest first.
+    def SegmentRows(rank, segment):
+      for subject, data in segment.Iterate(start):
+        if subject >= end:
+          return
+        yield subject, rank, data
+
+    def MemtableRows(rank, subjects):
+      for subject in subjects:
+        yield subject, rank, None
+
+    sources = [SegmentRows(i, s) for i, s in enumerate(segments)]
+    for i, subjects in enumerate(memtable_subjects):
+      sources.append(MemtableRows(len(segments) + i, subjects))
+
+    current_subject = None
+    row = None
+    for subject, rank, data in heapq.merge(*sources):
+      if subject != current_subject:
+        if row is not None and row.cells:
+          yield current_subject, row
+        current_subject = subject
+        row = Row()
+
+      if data is not None:
+        row.Apply(Row.Decode(data))
+      else:
+        with self.lock:
+          row.Apply(memtables[rank - len(segments)].Get(subject))
+
+    if row is not None and row.cells:
+      yield current_subject, row
+
+  def ScanAttributes(self,
+                     subject_prefix,
+                     attributes,
+                     after_urn=None,
+                     max_records=None,
+                     token=None,
+                     relaxed_order=False):
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = self._CleanAfterURN(after_urn, subject_prefix)
+
+    start = subject_prefix
+    if after_urn:
+      # The smallest subject sorting after after_urn.
+      start = after_urn + "\x00"
+    end = subject_prefix[:-1] + chr(ord(subject_prefix[-1]) + 1)
+
+    attributes = [utils.SmartUnicode(a) for a in attributes]
+
+    return_count = 0
+    for subject, row in self._ScanRows(start, end):
+      if max_records and return_count >= max_records:
+        break
+
+      results = {}
+      for attribute in attributes:
+        values = self._SelectValues(
+            row.cells.get(attribute, []), self.NEWEST_TIMESTAMP, 0,
+            MAX_TIMESTAMP)
+        if values:
+          ts, value = values[0]
+          results[attribute] = (ts, self._Decode(value))
+
+      if results:
+        return_count += 1
+        yield utils.SmartUnicode(subject), results
+
+  def ScanSubjects(self,
+                   subject_prefix,
+                   after_urn=None,
+                   max_records=None,
+                   token=None):
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = self._CleanAfterURN(after_urn, subject_prefix)
+
+    start = subject_prefix
+    if after_urn:
+      start = after_urn + "\x00"
+    end = subject_prefix[:-1] + chr(ord(subject_prefix[-1]) + 1)
+
+    return_count = 0
+    for subject, _ in self._ScanRows(start, end):
+      if max_records and return_count >= max_records:
+        break
+      return_count += 1
+      yield utils.SmartUnicode(subject)
+
+  def DBSubjectLock(self, subject, lease_time=None, token=None):
+    return LogStructuredDBSubjectLock(
+        self, subject, lease_time=lease_time, token=token)
+
+  def Flush(self):
+    """Flushes the log and writes full memtables to segments."""
+    with self.lock:
+      if self.log_file is None:
+        return
+      self.log_file.flush()
+
+    with self.flush_lock:
+      while True:
+        with self.lock:
+          if not self.immutable_memtables:
+            return
+          memtable = self.immutable_memtables[0]
+
+        rows = [(subject, memtable.rows[subject])
+                for subject in memtable.subjects]
+        segment = Segment.Write(
+            self._SegmentPath(memtable.log_numbers[0],
+                              memtable.log_numbers[-1]), rows,
+            memtable.log_numbers[0], memtable.log_numbers[-1],
+            self.index_interval)
+
+        with self.lock:
+          self.segments.append(segment)
+          self.immutable_memtables.pop(0)
+
+        for log_number in memtable.log_numbers:
+          os.unlink(self._LogPath(log_number))
+
+  def Compact(self):
+    """Merges all segments into one once there are too many of them."""
+    with self.compaction_lock:
+      self._Compact()
+
+  def _Compact(self):
+    with self.lock:
+      if self.log_file is None or len(self.segments) < self.max_segments:
+        return
+      segments = list(self.segments)
+
+    def SegmentRows(rank, segment):
+      for subject, data in segment.Iterate():
+        yield subject, rank, data
+
+    def MergedRows():
+      current_subject = None
+      row = None
+      for subject, _, data in heapq.merge(
+          *[SegmentRows(i, s) for i, s in enumerate(segments)]):
+        if subject != current_subject:
+          if row is not None and row.cells:
+            yield current_subject, Row(cells=row.cells)
+          current_subject = subject
+          row = Row()
+        row.Apply(Row.Decode(data))
+
+      if row is not None and row.cells:
+        yield current_subject, Row(cells=row.cells)
+
+    # Tombstones and deletes only mask older segments. We merge the oldest
+    # segments, so only the cells need to be kept.
+    first_log, last_log = segments[0].first_log, segments[-1].last_log
+    logging.debug("Compacting %d segments.", len(segments))
+    merged = Segment.Write(
+        self._SegmentPath(first_log, last_log), MergedRows(), first_log,
+        last_log, self.index_interval)
+
+    with self.lock:
+      # Segments are only ever appended while we were merging.
+      self.segments = [merged] + self.segments[len(segments):]
+
+    for segment in segments:
+      os.unlink(segment.path)
+
+  def Close(self):
+    """Flushes all data and releases the data store directory."""
+    self.compaction_thread.Stop()
+    self.flusher_thread.Stop()
+    with self.lock:
+      if self.log_file is None:
+        return
+      self.log_file.close()
+      self.log_file = None
+
+    fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+    self.lock_file.close()
+
+  def Size(self):
+    size, _ = common.DatabaseDirectorySize(self.root_path, SEGMENT_EXTENSION)
+    log_size, _ = common.DatabaseDirectorySize(self.root_path, LOG_EXTENSION)
+    return size + log_size
+
+  def Location(self):
+    """Get location of the data store."""
+    return self.root_path
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""Benchmark tests for the log structured data store."""
+
+
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+
+from grr.lib.data_stores import log_structured_data_store_test
+
+
+class LogStructuredDataStoreBenchmarks(
+    log_structured_data_store_test.LogStructuredTestMixin,
+    data_store_test.DataStoreBenchmarks):
+  """Benchmark the log structured data store abstraction."""
+
+
+class LogStructuredDataStoreCSVBenchmarks(
+    log_structured_data_store_test.LogStructuredTestMixin,
+    data_store_test.DataStoreCSVBenchmarks):
+  """Benchmark the log structured data store abstraction."""
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Tests the log structured data store."""
+
+import shutil
+
+
+from grr.lib import access_control
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+
+from grr.lib.data_stores import log_structured_data_store
+
+# pylint: mode=test
+
+
+class LogStructuredTestMixin(object):
+
+  def InitDatastore(self):
+    self.token = access_control.ACLToken(
+        username="test", reason="Running tests")
+    self.root_path = utils.SmartStr("%s/log_structured_test/" % self.temp_dir)
+
+    self.DestroyDatastore()
+
+    data_store.DB = log_structured_data_store.LogStructuredDataStore(
+        self.root_path)
+    data_store.DB.Initialize()
+
+  def testCorrectDataStore(self):
+    self.assertTrue(
+        isinstance(data_store.DB,
+                   log_structured_data_store.LogStructuredDataStore))
+
+  def DestroyDatastore(self):
+    try:
+      data_store.DB.Close()
+    except AttributeError:
+      pass
+    try:
+      if self.root_path:
+        shutil.rmtree(self.root_path)
+    except (OSError, IOError):
+      pass
+
+
+class LogStructuredDataStoreTest(LogStructuredTestMixin,
+                                 data_store_test._DataStoreTest):
+  """Test the log structured data store."""
+
+  def _Reopen(self):
+    data_store.DB.Close()
+    data_store.DB = log_structured_data_store.LogStructuredDataStore(
+        self.root_path)
+    data_store.DB.Initialize()
+
+  def testDataSurvivesReopen(self):
+    data_store.DB.Set(
+        self.test_row, "metadata:1", "logged", timestamp=1000, token=self.token)
+    self._Reopen()
+
+    self.assertEqual(
+        data_store.DB.Resolve(self.test_row, "metadata:1", token=self.token),
+        ("logged", 1000))
+
+  def testSegmentsAndCompaction(self):
+    data_store.DB.memtable_size = 1
+    data_store.DB.max_segments = 100
+
+    for i in range(5):
+      data_store.DB.Set(
+          "aff4:/C/%d" % i, "aff4:foo", "value %d" % i, token=self.token)
+    data_store.DB.DeleteSubject("aff4:/C/1", token=self.token)
+    data_store.DB.DeleteAttributes(
+        "aff4:/C/2", ["aff4:foo"], sync=True, token=self.token)
+    data_store.DB.Flush()
+    self.assertGreaterEqual(len(data_store.DB.segments), 3)
+
+    data_store.DB.max_segments = 3
+    data_store.DB.Compact()
+    self.assertEqual(len(data_store.DB.segments), 1)
+
+    self._Reopen()
+    results = list(
+        data_store.DB.ScanAttribute("aff4:/C", "aff4:foo", token=self.token))
+    self.assertEqual([(subject, value) for subject, _, value in results],
+                     [("aff4:/C/0", "value 0"), ("aff4:/C/3", "value 3"),
+                      ("aff4:/C/4", "value 4")])
+
+  def testDirectoryIsLocked(self):
+    with self.assertRaises(data_store.Error):
+      log_structured_data_store.LogStructuredDataStore(self.root_path)
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -377,6 +377,37 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       if max_records and result_count >= max_records:
         return
 
+  def ScanSubjects(self,
+                   subject_prefix,
+                   after_urn=None,
+                   max_records=None,
+                   token=None):
+    subject_prefix = utils.SmartStr(rdfvalue.RDFURN(subject_prefix))
+    if subject_prefix[-1] != "/":
+      subject_prefix += "/"
+
+    # Deleting all the attributes of a subject leaves it in the subjects table.
+    query = """
+    SELECT subjects.subject
+      FROM subjects
+      WHERE subjects.subject like %s
+            AND subjects.subject > %s
+            AND EXISTS (SELECT 1 FROM aff4
+                        WHERE aff4.subject_hash=subjects.hash)
+      ORDER BY subjects.subject
+    """
+    args = [subject_prefix + "%", utils.SmartStr(after_urn or "")]
+
+    if max_records:
+      query += " LIMIT %s"
+      args.append(max_records)
+
+    results, _ = self.ExecuteQuery(query, args)
+    for row in results:
+      # LIKE ignores case.
+      if utils.SmartStr(row["subject"]).startswith(subject_prefix):
+        yield row["subject"]
+
   def MultiSet(self,
                subject,
                values,
@@ -410,7 +441,7 @@ class MySQLAdvancedDataStore(data_store.DataStore):
           entry_timestamp = int(entry_timestamp)
 
         attribute = utils.SmartUnicode(attribute)
-        data = self._Encode(value)
+        data = self._Encode(attribute, value)
 
         # Replacing means to delete all versions of the attribute first.
         if replace or attribute in to_delete:
@@ -618,21 +649,24 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       self.attribute_types[attribute.predicate] = (
           attribute.attribute_type.data_store_type)
 
-  def _Encode(self, value):
+  def _Encode(self, attribute, value):
     """Encode the value for the attribute."""
     try:
-      return value.SerializeToString().encode("hex")
+      data = value.SerializeToString()
     except AttributeError:
       if isinstance(value, (int, long)):
         return str(value).encode("hex")
       else:
         # Types "string" and "bytes" are stored as strings here.
-        return utils.SmartStr(value).encode("hex")
+        data = utils.SmartStr(value)
+    return self.compressor.Compress(attribute, data).encode("hex")
 
   def _Decode(self, attribute, value):
     required_type = self.attribute_types.get(attribute, "bytes")
     if isinstance(value, buffer):
       value = str(value)
+    if isinstance(value, str):
+      value = self.compressor.Decompress(value)
     if required_type in ("integer", "unsigned_integer"):
       return int(value)
     elif required_type == "string":
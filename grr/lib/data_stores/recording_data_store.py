@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""Recording of data store traffic, and its replay against any data store.
+
+RecordingDataStore passes all calls on to another data store and logs them to
+a trace file: the method called, its arguments, when it was called, by which
+thread and how long it took. Traces are sequences of marshalled tuples, which
+are compact and can be read back without running any code from the file.
+
+TraceReplayer issues the calls of one or more traces against a data store,
+from as many threads as were recorded and with the recorded timing, and
+reports the throughput and latencies it saw. This is how changes to a data
+store are evaluated against real traffic.
+"""
+
+
+import marshal
+import os
+import random
+import threading
+import time
+
+from grr import config
+from grr.lib import data_store
+from grr.lib import rdfvalue
+from grr.lib import utils
+
+TRACE_MAGIC = "GRR data store trace"
+TRACE_VERSION = 1
+
+
+def _Plain(value):
+  """Converts value into something which can be marshalled."""
+  if value is None or isinstance(value, (basestring, bool, int, long, float)):
+    return value
+  if isinstance(value, list):
+    return [_Plain(v) for v in value]
+  if isinstance(value, tuple):
+    return tuple(_Plain(v) for v in value)
+  if isinstance(value, dict):
+    return {_Plain(k): _Plain(v) for k, v in value.iteritems()}
+  if isinstance(value, rdfvalue.RDFURN):
+    return utils.SmartUnicode(value)
+  if isinstance(value, rdfvalue.RDFInteger):
+    return long(value)
+  if isinstance(value, rdfvalue.RDFValue):
+    return value.SerializeToString()
+  return utils.SmartStr(value)
+
+
+def _Redact(value):
+  """Replaces a value by a string of the same size."""
+  if isinstance(value, basestring):
+    return "x" * len(value)
+  if isinstance(value, rdfvalue.RDFValue) and not isinstance(
+      value, rdfvalue.RDFInteger):
+    return "x" * len(value.SerializeToString())
+  return value
+
+
+class TraceRecord(object):
+  """A single recorded data store call."""
+
+  __slots__ = ("start", "thread", "method", "args", "kwargs", "duration")
+
+  def __init__(self, start, thread, method, args, kwargs, duration):
+    self.start = start
+    self.thread = thread
+    self.method = method
+    self.args = args
+    self.kwargs = kwargs
+    self.duration = duration
+
+
+def ReadTrace(path):
+  """Yields the TraceRecords stored in a trace file."""
+  with open(path, "rb") as fd:
+    try:
+      header = marshal.load(fd)
+    except EOFError:
+      return
+    if header[:2] != (TRACE_MAGIC, TRACE_VERSION):
+      raise ValueError("%s is not a data store trace." % path)
+
+    while True:
+      try:
+        record = marshal.load(fd)
+      except (EOFError, ValueError):
+        # The last record of the trace of a process which was killed may have
+        # been cut short.
+        return
+      yield TraceRecord(*record)
+
+
+class RecordingDataStore(data_store.WrappingDataStore):
+  """Logs all the calls made to another data store."""
+
+  implementation_option = "RecordingDataStore.implementation"
+
+  def __init__(self):
+    self.sample_rate = config.CONFIG["RecordingDataStore.sample_rate"]
+    self.redact_values = config.CONFIG["RecordingDataStore.redact_values"]
+    self.max_trace_size = config.CONFIG["RecordingDataStore.max_trace_size"]
+
+    # Each process records to its own trace.
+    self.trace_path = "%s.%d" % (
+        config.CONFIG["RecordingDataStore.trace_path"], os.getpid())
+    self.trace = open(self.trace_path, "wb")
+    marshal.dump((TRACE_MAGIC, TRACE_VERSION, os.getpid()), self.trace)
+    self.trace_lock = threading.Lock()
+
+    super(RecordingDataStore, self).__init__()
+
+  def _Record(self, method, start, args, kwargs):
+    duration = time.time() - start
+    record = (start, threading.current_thread().ident, method, _Plain(args),
+              _Plain(kwargs), duration)
+    with self.trace_lock:
+      if self.trace.closed or self.trace.tell() >= self.max_trace_size:
+        return
+      marshal.dump(record, self.trace)
+
+  def _Sampled(self):
+    return random.random() < self.sample_rate
+
+  def _RecordIterator(self, method, start, args, kwargs, iterator):
+    try:
+      for item in iterator:
+        yield item
+    finally:
+      self._Record(method, start, args, kwargs)
+
+  def ResolvePrefix(self,
+                    subject,
+                    attribute_prefix,
+                    timestamp=None,
+                    limit=None,
+                    token=None):
+    start = time.time()
+    results = super(RecordingDataStore, self).ResolvePrefix(
+        subject,
+        attribute_prefix,
+        timestamp=timestamp,
+        limit=limit,
+        token=token)
+    if self._Sampled():
+      self._Record("ResolvePrefix", start, (subject, attribute_prefix),
+                   dict(timestamp=timestamp, limit=limit))
+    return results
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None,
+                         token=None):
+    start = time.time()
+    subjects = list(subjects)
+    results = super(RecordingDataStore, self).MultiResolvePrefix(
+        subjects,
+        attribute_prefix,
+        timestamp=timestamp,
+        limit=limit,
+        token=token)
+    if not self._Sampled():
+      return results
+    return self._RecordIterator("MultiResolvePrefix", start,
+                                (subjects, attribute_prefix),
+                                dict(timestamp=timestamp, limit=limit),
+                                results)
+
+  def ResolveMulti(self,
+                   subject,
+                   attributes,
+                   timestamp=None,
+                   limit=None,
+                   token=None):
+    start = time.time()
+    results = list(
+        super(RecordingDataStore, self).ResolveMulti(
+            subject,
+            attributes,
+            timestamp=timestamp,
+            limit=limit,
+            token=token))
+    if self._Sampled():
+      self._Record("ResolveMulti", start, (subject, attributes),
+                   dict(timestamp=timestamp, limit=limit))
+    return results
+
+  def Resolve(self, subject, attribute, token=None):
+    start = time.time()
+    result = super(RecordingDataStore, self).Resolve(
+        subject, attribute, token=token)
+    if self._Sampled():
+      self._Record("Resolve", start, (subject, attribute), {})
+    return result
+
+  def ScanAttributes(self,
+                     subject_prefix,
+                     attributes,
+                     after_urn=None,
+                     max_records=None,
+                     token=None,
+                     relaxed_order=False):
+    start = time.time()
+    results = super(RecordingDataStore, self).ScanAttributes(
+        subject_prefix,
+        attributes,
+        after_urn=after_urn,
+        max_records=max_records,
+        token=token,
+        relaxed_order=relaxed_order)
+    if not self._Sampled():
+      return results
+    return self._RecordIterator(
+        "ScanAttributes", start, (subject_prefix, attributes),
+        dict(
+            after_urn=after_urn,
+            max_records=max_records,
+            relaxed_order=relaxed_order), results)
+
+  def DBSubjectLock(self, subject, lease_time=None, token=None):
+    start = time.time()
+    try:
+      return super(RecordingDataStore, self).DBSubjectLock(
+          subject, lease_time=lease_time, token=token)
+    finally:
+      if self._Sampled():
+        self._Record("DBSubjectLock", start, (subject,),
+                     dict(lease_time=lease_time))
+
+  def Set(self,
+          subject,
+          attribute,
+          value,
+          timestamp=None,
+          token=None,
+          replace=True,
+          sync=True):
+    start = time.time()
+    super(RecordingDataStore, self).Set(
+        subject,
+        attribute,
+        value,
+        timestamp=timestamp,
+        token=token,
+        replace=replace,
+        sync=sync)
+    if self._Sampled():
+      if self.redact_values:
+        value = _Redact(value)
+      self._Record("Set", start, (subject, attribute, value),
+                   dict(timestamp=timestamp, replace=replace, sync=sync))
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None,
+               token=None):
+    start = time.time()
+    super(RecordingDataStore, self).MultiSet(
+        subject,
+        values,
+        timestamp=timestamp,
+        replace=replace,
+        sync=sync,
+        to_delete=to_delete,
+        token=token)
+    if not self._Sampled():
+      return
+
+    if self.redact_values:
+      redacted = {}
+      for attribute, attribute_values in values.iteritems():
+        redacted[attribute] = []
+        for value in attribute_values:
+          # Values may be given along with their timestamp.
+          if isinstance(value, (list, tuple)):
+            value = (_Redact(value[0]), value[1])
+          else:
+            value = _Redact(value)
+          redacted[attribute].append(value)
+      values = redacted
+
+    self._Record("MultiSet", start, (subject, values),
+                 dict(
+                     timestamp=timestamp,
+                     replace=replace,
+                     sync=sync,
+                     to_delete=to_delete))
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True,
+                       token=None):
+    call_start = time.time()
+    super(RecordingDataStore, self).DeleteAttributes(
+        subject, attributes, start=start, end=end, sync=sync, token=token)
+    if self._Sampled():
+      self._Record("DeleteAttributes", call_start, (subject, attributes),
+                   dict(start=start, end=end, sync=sync))
+
+  def MultiDeleteAttributes(self,
+                            subjects,
+                            attributes,
+                            start=None,
+                            end=None,
+                            sync=True,
+                            token=None):
+    call_start = time.time()
+    subjects = list(subjects)
+    super(RecordingDataStore, self).MultiDeleteAttributes(
+        subjects, attributes, start=start, end=end, sync=sync, token=token)
+    if self._Sampled():
+      self._Record("MultiDeleteAttributes", call_start, (subjects, attributes),
+                   dict(start=start, end=end, sync=sync))
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    start = time.time()
+    super(RecordingDataStore, self).DeleteSubject(
+        subject, sync=sync, token=token)
+    if self._Sampled():
+      self._Record("DeleteSubject", start, (subject,), dict(sync=sync))
+
+  def DeleteSubjects(self, subjects, sync=False, token=None):
+    start = time.time()
+    subjects = list(subjects)
+    super(RecordingDataStore, self).DeleteSubjects(
+        subjects, sync=sync, token=token)
+    if self._Sampled():
+      self._Record("DeleteSubjects", start, (subjects,), dict(sync=sync))
+
+  def Flush(self):
+    super(RecordingDataStore, self).Flush()
+    with self.trace_lock:
+      if not self.trace.closed:
+        self.trace.flush()
+
+  def CloseTrace(self):
+    """Stops recording, writing out what was recorded so far."""
+    with self.trace_lock:
+      self.trace.close()
+
+
+class ReplayReport(object):
+  """Throughput and latencies seen while replaying traces."""
+
+  def __init__(self, elapsed, latencies, errors):
+    self.elapsed = elapsed
+    # Maps method names to the sorted latencies of their calls.
+    self.latencies = latencies
+    # Maps method names to the number of calls which raised.
+    self.errors = errors
+
+  @property
+  def calls(self):
+    return sum(len(latencies) for latencies in self.latencies.itervalues())
+
+  def Throughput(self):
+    if not self.elapsed:
+      return 0.0
+    return self.calls / self.elapsed
+
+  @staticmethod
+  def Percentile(latencies, percentile):
+    if not latencies:
+      return 0.0
+    index = min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))
+    return latencies[index]
+
+  def __str__(self):
+    lines = [
+        "Replayed %d calls in %.2fs (%.1f calls/s)." %
+        (self.calls, self.elapsed, self.Throughput()),
+        "%-25s %8s %8s %10s %10s %10s %10s" %
+        ("Method", "Calls", "Errors", "p50 (ms)", "p90 (ms)", "p99 (ms)",
+         "max (ms)")
+    ]
+    for method in sorted(self.latencies):
+      latencies = self.latencies[method]
+      lines.append("%-25s %8d %8d %10.2f %10.2f %10.2f %10.2f" % (
+          method, len(latencies), self.errors.get(method, 0),
+          self.Percentile(latencies, 50) * 1e3,
+          self.Percentile(latencies, 90) * 1e3,
+          self.Percentile(latencies, 99) * 1e3,
+          self.Percentile(latencies, 100) * 1e3))
+    return "\n".join(lines)
+
+
+class TraceReplayer(object):
+  """Issues recorded data store calls against a data store."""
+
+  def __init__(self, store, trace_paths, speed=1.0, token=None):
+    """Constructor.
+
+    Args:
+      store: The data store to replay the calls against.
+      trace_paths: The traces to replay. Traces recorded at the same time, by
+          different processes, are replayed together.
+      speed: How much faster than recorded the calls are issued. 0 issues them
+          as fast as possible, still in order within each recorded thread.
+      token: The token used for all the calls.
+    """
+    self.store = store
+    self.speed = speed
+    self.token = token
+
+    # Calls of each recorded thread, in the order they were made.
+    self.threads = {}
+    for index, path in enumerate(trace_paths):
+      for record in ReadTrace(path):
+        self.threads.setdefault((index, record.thread), []).append(record)
+    for records in self.threads.itervalues():
+      records.sort(key=lambda r: r.start)
+
+    self.lock = threading.Lock()
+    self.latencies = {}
+    self.errors = {}
+
+  def _Call(self, record):
+    kwargs = dict(record.kwargs)
+    kwargs["token"] = self.token
+    result = getattr(self.store, record.method)(*record.args, **kwargs)
+    if record.method == "DBSubjectLock":
+      result.Release()
+    elif record.method in ("MultiResolvePrefix", "ScanAttributes"):
+      for _ in result:
+        pass
+
+  def _ReplayThread(self, records, trace_start, replay_start):
+    latencies = {}
+    errors = {}
+    for record in records:
+      if self.speed:
+        delay = (replay_start + (record.start - trace_start) / self.speed -
+                 time.time())
+        if delay > 0:
+          time.sleep(delay)
+
+      start = time.time()
+      try:
+        self._Call(record)
+      except Exception:  # pylint: disable=broad-except
+        errors[record.method] = errors.get(record.method, 0) + 1
+      latencies.setdefault(record.method, []).append(time.time() - start)
+
+    with self.lock:
+      for method, method_latencies in latencies.iteritems():
+        self.latencies.setdefault(method, []).extend(method_latencies)
+      for method, count in errors.iteritems():
+        self.errors[method] = self.errors.get(method, 0) + count
+
+  def Run(self):
+    """Replays the traces and returns a ReplayReport."""
+    if not self.threads:
+      return ReplayReport(0, {}, {})
+
+    trace_start = min(records[0].start for records in self.threads.values())
+    replay_start = time.time()
+    threads = [
+        threading.Thread(
+            target=self._ReplayThread,
+            args=(records, trace_start, replay_start))
+        for records in self.threads.itervalues()
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.store.Flush()
+    elapsed = time.time() - replay_start
+
+    for latencies in self.latencies.itervalues():
+      latencies.sort()
+    return ReplayReport(elapsed, self.latencies, self.errors)
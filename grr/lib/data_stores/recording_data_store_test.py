@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Tests the recording data store and the replay of its traces."""
+
+
+
+import os
+import threading
+
+
+from grr.lib import access_control
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+
+from grr.lib.data_stores import fake_data_store
+from grr.lib.data_stores import recording_data_store
+
+# pylint: mode=test
+
+
+class RecordingDataStoreTest(data_store_test._DataStoreTest):
+  """Test the recording data store."""
+
+  def InitDatastore(self):
+    self.token = access_control.ACLToken(
+        username="test", reason="Running tests")
+    self.trace_path = os.path.join(self.temp_dir, "trace")
+    with test_lib.ConfigOverrider({
+        "RecordingDataStore.implementation": "FakeDataStore",
+        "RecordingDataStore.trace_path": self.trace_path,
+        "RecordingDataStore.redact_values": False
+    }):
+      data_store.DB = recording_data_store.RecordingDataStore()
+      data_store.DB.Initialize()
+
+  def DestroyDatastore(self):
+    data_store.DB.CloseTrace()
+
+  def testCorrectDataStore(self):
+    self.assertTrue(
+        isinstance(data_store.DB, recording_data_store.RecordingDataStore))
+    self.assertTrue(
+        isinstance(data_store.DB.wrapped, fake_data_store.FakeDataStore))
+
+  def testRecordAndReplay(self):
+
+    # Threads only get distinct ids while they all run.
+    started = threading.Event()
+
+    def Write(thread):
+      started.wait()
+      for i in range(10):
+        subject = "aff4:/replay/%d/%d" % (thread, i)
+        data_store.DB.MultiSet(
+            subject, {"metadata:value": [str(i)]}, token=self.token)
+        data_store.DB.ResolvePrefix(subject, "metadata:", token=self.token)
+
+    threads = [threading.Thread(target=Write, args=(i,)) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    started.set()
+    for thread in threads:
+      thread.join()
+    data_store.DB.CloseTrace()
+
+    # The trace also holds the calls made while setting up the test.
+    records = [
+        record
+        for record in recording_data_store.ReadTrace(data_store.DB.trace_path)
+        if record.args[0].startswith("aff4:/replay/")
+    ]
+    self.assertEqual(len(records), 80)
+    self.assertEqual(len(set(record.thread for record in records)), 4)
+
+    store = fake_data_store.FakeDataStore()
+    replayer = recording_data_store.TraceReplayer(
+        store, [data_store.DB.trace_path], speed=0, token=self.token)
+    report = replayer.Run()
+
+    self.assertGreaterEqual(report.calls, 80)
+    self.assertEqual(len(report.latencies["MultiSet"]), 40)
+    self.assertEqual(len(report.latencies["ResolvePrefix"]), 40)
+    self.assertFalse(report.errors)
+    self.assertIn("MultiSet", str(report))
+
+    for thread in range(4):
+      for i in range(10):
+        values = store.ResolvePrefix(
+            "aff4:/replay/%d/%d" % (thread, i), "metadata:", token=self.token)
+        self.assertEqual(values[0][1], str(i))
+
+  def testRedaction(self):
+    data_store.DB.redact_values = True
+    data_store.DB.Set(
+        "aff4:/redacted", "metadata:value", "secret", token=self.token)
+    data_store.DB.CloseTrace()
+
+    record, = [
+        record
+        for record in recording_data_store.ReadTrace(data_store.DB.trace_path)
+        if record.method == "Set"
+    ]
+    self.assertEqual(record.args,
+                     ("aff4:/redacted", "metadata:value", "xxxxxx"))
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
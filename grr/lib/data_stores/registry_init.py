@@ -22,11 +22,26 @@ try:
 except ImportError:
   pass
 
+# Log structured data store for a single server.
+try:
+  from grr.lib.data_stores import log_structured_data_store
+except ImportError:
+  pass
+
 # HTTP remote data store.
 try:
   from grr.lib.data_stores import http_data_store
 except ImportError:
   pass
 
+# Read-through cache in front of any other data store.
+from grr.lib.data_stores import caching_data_store
+
+# Metrics about the calls made to any other data store.
+from grr.lib.data_stores import instrumented_data_store
+
+# Recording of the calls made to any other data store.
+from grr.lib.data_stores import recording_data_store
+
 # Site specific data stores.
 from grr.lib.data_stores import local
@@ -6,6 +6,8 @@ SQLite database files are created by taking the root of each AFF4 object.
 
 
 
+import collections
+import heapq
 import itertools
 import os
 import re
@@ -33,6 +35,8 @@ SQLITE_DETECT_TYPES = 0
 SQLITE_FACTORY = sqlite3.Connection
 SQLITE_CACHED_STATEMENTS = 20
 SQLITE_PAGE_SIZE = 1024
+# Maximum number of host parameters in a single SQLite statement.
+SQLITE_MAX_VARIABLES = 999
 
 
 class SqliteConnectionCache(utils.FastStore):
@@ -157,6 +161,32 @@ class SqliteConnectionCache(utils.FastStore):
   def KillObject(self, conn):
     conn.Close()
 
+  def CommitPending(self):
+    """Commits the pending writes of all cached connections."""
+    for _, connection in self:
+      # Reads execute pending writes without committing them.
+      if connection.pending or connection.dirty:
+        connection.CommitPending()
+
+  def GroupByDatabase(self, subjects):
+    """Groups subjects by the database file they are stored in.
+
+    Args:
+      subjects: An iterable of subjects.
+
+    Returns:
+      A list of lists of subjects, one for each database file, sorted by the
+      key of the database file.
+    """
+    groups = {}
+    for subject in subjects:
+      filename, directory = common.ResolveSubjectDestination(
+          subject, self.path_regexes)
+      key = common.MakeDestinationKey(directory, filename)
+      groups.setdefault(key, []).append(subject)
+
+    return [groups[key] for key in sorted(groups)]
+
   @utils.Synchronized
   def Get(self, subject):
     """This will create the connection if needed so should not fail."""
@@ -250,6 +280,12 @@ class SqliteConnectionCache(utils.FastStore):
 class SqliteConnection(object):
   """A wrapper around the raw SQLite connection."""
 
+  DELETE_ATTRIBUTE_QUERY = "DELETE FROM tbl WHERE subject = ? AND predicate = ?"
+  DELETE_ATTRIBUTE_RANGE_QUERY = """DELETE FROM tbl
+      WHERE subject = ? AND predicate = ? AND timestamp >= ? AND timestamp <= ?"""
+  DELETE_SUBJECT_QUERY = "DELETE FROM tbl WHERE subject = ?"
+  SET_ATTRIBUTE_QUERY = "INSERT INTO tbl VALUES (?, ?, ?, ?)"
+
   def __init__(self, filename):
     self.filename = filename
     self.conn = sqlite3.connect(filename, SQLITE_TIMEOUT, SQLITE_DETECT_TYPES,
@@ -267,6 +303,28 @@ class SqliteConnection(object):
     self.deleted = 0
     self.next_vacuum_check = config.CONFIG["SqliteDatastore.vacuum_check"]
 
+    # Idle read only connections. WAL mode allows them to read concurrently
+    # with each other and with the writes on self.conn.
+    self.readers_lock = threading.Lock()
+    self.readers = []
+    self.reader_pool_size = config.CONFIG["SqliteDatastore.reader_pool_size"]
+
+    # Writes waiting to be committed in one transaction, see QueueWrites().
+    # Queued writes are numbered by the batch they will be executed in.
+    self.pending_lock = threading.Lock()
+    self.pending = []
+    self.pending_since = None
+    self.next_batch = 1
+    self.executed_batch = 0
+    self.committed_batch = 0
+    # Number of writers waiting for each batch to be committed and the errors
+    # of the batches that could not be.
+    self.waiters = collections.Counter()
+    self.batch_errors = {}
+    self.group_commit_size = config.CONFIG["SqliteDatastore.group_commit_size"]
+    self.group_commit_latency = config.CONFIG[
+        "SqliteDatastore.group_commit_latency"]
+
   def Filename(self):
     return self.filename
 
@@ -278,6 +336,56 @@ class SqliteConnection(object):
                         args)
       raise
 
+  def _GetReader(self):
+    """Returns an idle read only connection, opening one if needed."""
+    with self.readers_lock:
+      if self.readers:
+        return self.readers.pop()
+
+    reader = sqlite3.connect(self.filename, SQLITE_TIMEOUT, SQLITE_DETECT_TYPES,
+                             SQLITE_ISOLATION, False, SQLITE_FACTORY,
+                             SQLITE_CACHED_STATEMENTS)
+    reader.text_factory = str
+    reader.execute("PRAGMA query_only = ON")
+    reader.execute("PRAGMA cache_size = 10000")
+    return reader
+
+  def _ReleaseReader(self, reader):
+    with self.readers_lock:
+      # Readers are closed with the connection, e.g. on cache eviction.
+      if self.conn is not None and len(self.readers) < self.reader_pool_size:
+        self.readers.append(reader)
+        return
+    reader.close()
+
+  def _PrepareRead(self):
+    """Makes sure readers see all writes made through this connection."""
+    if self.pending or self.dirty:
+      self.CommitPending()
+
+  @utils.Synchronized
+  def _ExecuteReadOnWriter(self, query, args):
+    """Runs a query on the connection holding the uncommitted writes."""
+    self._ExecutePending()
+    return self.Execute(query, args).fetchall()
+
+  def ExecuteRead(self, query, args):
+    """Runs a query on a read only connection and returns all rows."""
+    if self.pending or self.dirty:
+      # Committing the writes for the readers to see them would cost a sync
+      # for every read, they are left to the group commit instead.
+      return self._ExecuteReadOnWriter(query, args)
+
+    reader = self._GetReader()
+    try:
+      return reader.execute(query, args).fetchall()
+    except sqlite3.DatabaseError:
+      logging.exception("DB error in file: %s for query: %s", self.filename,
+                        query)
+      raise
+    finally:
+      self._ReleaseReader(reader)
+
   @utils.Synchronized
   def GetLock(self, subject):
     """Gets the expiration time for a given subject."""
@@ -309,7 +417,6 @@ class SqliteConnection(object):
     self.Execute(query, args)
     self.dirty = True
 
-  @utils.Synchronized
   def GetNewestValue(self, subject, attribute):
     """Returns the newest value for subject/attribute."""
     subject = utils.SmartStr(subject)
@@ -319,14 +426,13 @@ class SqliteConnection(object):
                ORDER BY timestamp DESC
                LIMIT 1"""
     args = (subject, attribute)
-    data = self.Execute(query, args).fetchone()
+    data = self.ExecuteRead(query, args)
 
     if data:
-      return (data[0], data[1])
+      return (data[0][0], data[0][1])
     else:
       return None
 
-  @utils.Synchronized
   def GetNewestFromPrefix(self, subject, prefix, limit=None):
     """Returns the newest values for attributes that match 'prefix'.
 
@@ -351,10 +457,9 @@ class SqliteConnection(object):
       args = (subject, pattern)
 
     # Reorder columns.
-    data = self.Execute(query, args).fetchall()
+    data = self.ExecuteRead(query, args)
     return [(pred, val, ts) for pred, ts, val in data]
 
-  @utils.Synchronized
   def GetValuesFromPrefix(self, subject, prefix, start, end, limit=None):
     """Returns the values of the attributes that match 'prefix'.
 
@@ -380,10 +485,63 @@ class SqliteConnection(object):
     else:
       args = (subject, pattern, start, end)
 
-    data = self.Execute(query, args).fetchall()
+    data = self.ExecuteRead(query, args)
     return data
 
-  @utils.Synchronized
+  def MultiGetFromPrefix(self, subjects, prefixes, start, end, newest=False):
+    """Returns the values of several subjects' attributes matching prefixes.
+
+    Subjects are queried in chunks, using a single statement for each chunk
+    that covers all the prefixes.
+
+    Args:
+     subjects: A list of subjects stored in this database file.
+     prefixes: A list of attribute prefixes.
+     start: The start timestamp.
+     end: The end timestamp.
+     newest: If True, only the newest value of each attribute is returned and
+       start and end are ignored.
+
+    Yields:
+     Tuples of the form (subject, prefix index, attribute, value, timestamp),
+     ordered by subject, then by prefix index. For each prefix, values are
+     ordered by timestamp (newest first) or, if newest is set, by attribute.
+    """
+    subjects = sorted(set(utils.SmartStr(subject) for subject in subjects))
+    prefix_args = []
+    for i, prefix in enumerate(prefixes):
+      prefix_args.extend((i, utils.SmartStr(prefix) + "%"))
+    prefix_values = ", ".join(["(?, ?)"] * len(prefixes))
+
+    chunk_size = max(1, SQLITE_MAX_VARIABLES - len(prefix_args) - 2)
+    for i in xrange(0, len(subjects), chunk_size):
+      chunk = subjects[i:i + chunk_size]
+      subject_values = ", ".join(["?"] * len(chunk))
+      if newest:
+        query = """WITH prefixes(idx, pattern) AS (VALUES %s)
+                   SELECT tbl.subject, prefixes.idx, tbl.predicate, tbl.value,
+                          MAX(tbl.timestamp)
+                   FROM tbl JOIN prefixes ON tbl.predicate LIKE prefixes.pattern
+                   WHERE tbl.subject IN (%s)
+                   GROUP BY tbl.subject, prefixes.idx, tbl.predicate
+                   ORDER BY tbl.subject, prefixes.idx, tbl.predicate""" % (
+                       prefix_values, subject_values)
+        args = prefix_args + chunk
+      else:
+        query = """WITH prefixes(idx, pattern) AS (VALUES %s)
+                   SELECT tbl.subject, prefixes.idx, tbl.predicate, tbl.value,
+                          tbl.timestamp
+                   FROM tbl JOIN prefixes ON tbl.predicate LIKE prefixes.pattern
+                   WHERE tbl.subject IN (%s)
+                         AND tbl.timestamp >= ? AND tbl.timestamp <= ?
+                   ORDER BY tbl.subject, prefixes.idx,
+                            tbl.timestamp DESC""" % (prefix_values,
+                                                        subject_values)
+        args = prefix_args + chunk + [start, end]
+
+      for row in self.ExecuteRead(query, args):
+        yield row
+
   def GetValues(self, subject, attribute, start, end, limit=None):
     """Returns the values of the attribute between 'start' and 'end'.
 
@@ -408,7 +566,7 @@ class SqliteConnection(object):
       args = (subject, attribute, start, end, limit)
     else:
       args = (subject, attribute, start, end)
-    data = self.Execute(query, args).fetchall()
+    data = self.ExecuteRead(query, args)
     return data
 
   def ScanAttributes(self,
@@ -430,10 +588,8 @@ class SqliteConnection(object):
     """
 
     # A generator cannot really be synchronized, and in any case, this might be
-    # long running. So we just make our own cursor.
-    cursor = self.conn.cursor()
-    cursor.execute("PRAGMA synchronous = OFF")
-    cursor.execute("PRAGMA cache_size = 10000")
+    # long running. So we use a read only connection.
+    self._PrepareRead()
 
     query = """SELECT t1.subject, t1.predicate, t1.timestamp, t1.value
                FROM tbl AS t1,
@@ -459,19 +615,46 @@ class SqliteConnection(object):
       query += " LIMIT ?"
       args.append(max_records * len(attributes))
 
-    cursor.execute(query, args)
+    reader = self._GetReader()
+    try:
+      for r in reader.execute(query, args):
+        yield r
+    finally:
+      self._ReleaseReader(reader)
 
-    for r in cursor:
-      yield r
+  def ScanSubjects(self, subject_prefix, after_urn=None, max_records=None):
+    """Returns the sorted subjects which begin with subject_prefix."""
+    self._PrepareRead()
+
+    query = """SELECT DISTINCT subject FROM tbl
+               WHERE subject LIKE ? AND subject > ?
+               ORDER BY subject"""
+    subject_prefix = utils.SmartStr(subject_prefix)
+    args = [subject_prefix + "%", utils.SmartStr(after_urn or "")]
+
+    if max_records:
+      query += " LIMIT ?"
+      args.append(max_records)
+
+    reader = self._GetReader()
+    try:
+      subjects = [
+          utils.SmartStr(subject)
+          for subject, in reader.execute(query, args)
+      ]
+    finally:
+      self._ReleaseReader(reader)
+
+    # LIKE ignores case.
+    return [s for s in subjects if s.startswith(subject_prefix)]
 
   @utils.Synchronized
   def DeleteAttribute(self, subject, attribute):
     """Deletes all values for the given subject/attribute."""
     subject = utils.SmartStr(subject)
     attribute = utils.SmartStr(attribute)
-    query = "DELETE FROM tbl WHERE subject = ? AND predicate = ?"
     args = (subject, attribute)
-    self.Execute(query, args)
+    self.Execute(self.DELETE_ATTRIBUTE_QUERY, args)
     self.dirty = True
     self.deleted += self.cursor.rowcount
 
@@ -480,9 +663,8 @@ class SqliteConnection(object):
     """Sets subject's attribute value with the given timestamp."""
     subject = utils.SmartStr(subject)
     attribute = utils.SmartStr(attribute)
-    query = "INSERT INTO tbl VALUES (?, ?, ?, ?)"
     args = (subject, attribute, timestamp, value)
-    self.Execute(query, args)
+    self.Execute(self.SET_ATTRIBUTE_QUERY, args)
     self.dirty = True
     self.deleted = max(0, self.deleted - self.cursor.rowcount)
 
@@ -491,10 +673,8 @@ class SqliteConnection(object):
     """Deletes all values of a attribute within the range [start, end]."""
     subject = utils.SmartStr(subject)
     attribute = utils.SmartStr(attribute)
-    query = """DELETE FROM tbl WHERE subject = ? AND predicate = ?
-               AND timestamp >= ? AND timestamp <= ?"""
     args = (subject, attribute, int(start), int(end))
-    self.Execute(query, args)
+    self.Execute(self.DELETE_ATTRIBUTE_RANGE_QUERY, args)
     self.dirty = True
     self.deleted += self.cursor.rowcount
 
@@ -502,12 +682,133 @@ class SqliteConnection(object):
   def DeleteSubject(self, subject):
     """Deletes subject information."""
     subject = utils.SmartStr(subject)
-    query = "DELETE FROM tbl WHERE subject = ?"
     args = (subject,)
-    self.Execute(query, args)
+    self.Execute(self.DELETE_SUBJECT_QUERY, args)
     self.dirty = True
     self.deleted += self.cursor.rowcount
 
+  def QueueWrites(self, writes, sync=True):
+    """Queues writes to be committed in one transaction with other writes.
+
+    Writes from all threads are collected until one of them needs them to be
+    committed because it passed sync=True, or until there are too many or too
+    old pending writes. The thread committing executes all pending writes.
+
+    Args:
+      writes: A list of (query, args) tuples.
+      sync: If True, only return once the writes are committed.
+
+    Raises:
+      sqlite3.DatabaseError: If sync is set and the writes could not be
+        committed.
+    """
+    with self.pending_lock:
+      if not self.pending:
+        self.pending_since = time.time()
+      self.pending.extend(writes)
+      batch = self.next_batch
+      if sync:
+        self.waiters[batch] += 1
+      commit = (sync or len(self.pending) >= self.group_commit_size or
+                time.time() - self.pending_since >= self.group_commit_latency)
+
+    if not commit:
+      return
+
+    try:
+      self.CommitPending(batch)
+    finally:
+      if sync:
+        with self.pending_lock:
+          self.waiters[batch] -= 1
+          if not self.waiters[batch]:
+            del self.waiters[batch]
+            self.batch_errors.pop(batch, None)
+
+  def _ExecutePending(self):
+    """Executes the pending writes in the current transaction."""
+    with self.pending_lock:
+      writes = self.pending
+      self.pending = []
+      self.executed_batch = self.next_batch
+      self.next_batch += 1
+
+    # Consecutive writes using the same statement are executed together.
+    for query, group in itertools.groupby(writes, key=lambda w: w[0]):
+      try:
+        self.cursor.executemany(query, [args for _, args in group])
+      except sqlite3.DatabaseError as e:
+        logging.exception("DB error in file: %s for query: %s", self.filename,
+                          query)
+        self._AbortPending(e)
+        raise
+
+      if query == self.SET_ATTRIBUTE_QUERY:
+        self.deleted = max(0, self.deleted - self.cursor.rowcount)
+      else:
+        self.deleted += self.cursor.rowcount
+      self.dirty = True
+
+  def _AbortPending(self, error):
+    """Rolls back the writes executed since the last commit.
+
+    The writers waiting for these writes to be committed get the error instead.
+
+    Args:
+      error: The exception that made the transaction fail.
+    """
+    try:
+      self.conn.rollback()
+    except sqlite3.DatabaseError:
+      logging.exception("Rollback failed in file: %s", self.filename)
+
+    with self.pending_lock:
+      for batch in self.waiters:
+        if self.committed_batch < batch <= self.executed_batch:
+          self.batch_errors[batch] = error
+    self.dirty = False
+    self.committed_batch = self.executed_batch
+
+  def _Commit(self):
+    """Commits the current transaction."""
+    try:
+      self.conn.commit()
+    except sqlite3.DatabaseError as e:
+      logging.exception("DB error committing file: %s", self.filename)
+      self._AbortPending(e)
+      raise
+
+    self.Flush()
+    self.dirty = False
+    self.committed_batch = self.executed_batch
+
+  @utils.Synchronized
+  def CommitPending(self, batch=None):
+    """Commits all pending writes.
+
+    Args:
+      batch: If given, only commit if this batch has not been committed yet.
+
+    Raises:
+      sqlite3.DatabaseError: If the writes could not be committed, or if batch
+        was part of a transaction that failed.
+    """
+    if batch is not None:
+      with self.pending_lock:
+        error = self.batch_errors.get(batch)
+      if error is not None:
+        # Another thread failed to commit our writes.
+        raise error
+      if self.committed_batch >= batch:
+        # Another thread committed our writes while we waited for the lock.
+        return
+
+    self._ExecutePending()
+    if self.dirty:
+      self._Commit()
+    else:
+      self.committed_batch = self.executed_batch
+
   def PrettyPrint(self):
     """Print the SQLite database."""
     query = "SELECT subject, predicate, timestamp, value FROM tbl"
@@ -517,13 +818,21 @@ class SqliteConnection(object):
 
   def __enter__(self):
     self.lock.acquire()
+    # Reads need to see the pending writes.
+    if self.pending:
+      try:
+        self._ExecutePending()
+      except sqlite3.DatabaseError:
+        self.lock.release()
+        raise
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
-    if self.dirty:
-      self.Flush()
-    self.dirty = False
-    self.lock.release()
+    try:
+      if self.dirty:
+        self._Commit()
+    finally:
+      self.lock.release()
 
   @utils.Synchronized
   def Flush(self):
@@ -597,12 +906,21 @@ class SqliteConnection(object):
   @utils.Synchronized
   def Close(self):
     """Flush and close connection."""
-    if self.dirty:
-      self.Flush()
-    self.cursor.close()
-    self.conn.close()
-    self.conn = None
-    self.cursor = None
+    try:
+      self._ExecutePending()
+      if self.dirty:
+        self._Commit()
+    finally:
+      self.cursor.close()
+      self.conn.close()
+      self.conn = None
+      self.cursor = None
+
+    with self.readers_lock:
+      readers = self.readers
+      self.readers = []
+    for reader in readers:
+      reader.close()
 
 
 class SqliteDataStore(data_store.DataStore):
@@ -628,21 +946,22 @@ class SqliteDataStore(data_store.DataStore):
       self._attribute_types[attribute.predicate] = (
           attribute.attribute_type.data_store_type)
 
-  def _Encode(self, value):
+  def _Encode(self, attribute, value):
     """Encode the value for the attribute."""
     try:
-      return buffer(value.SerializeToString())
+      data = value.SerializeToString()
     except AttributeError:
       if isinstance(value, (int, long)):
         return value
       else:
         # Types "string" and "bytes" are stored as strings here.
-        return buffer(utils.SmartStr(value))
+        data = utils.SmartStr(value)
+    return buffer(self.compressor.Compress(attribute, data))
 
   def _Decode(self, attribute, value):
     required_type = self._attribute_types.get(attribute, "bytes")
     if isinstance(value, buffer):
-      value = str(value)
+      value = self.compressor.Decompress(str(value))
     if required_type in ("integer", "unsigned_integer"):
       return int(value)
     elif required_type == "string":
@@ -659,34 +978,36 @@ class SqliteDataStore(data_store.DataStore):
                to_delete=None,
                token=None):
     """Set multiple values at once."""
-    # All operations are synchronized.
-    _ = sync
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       timestamp = time.time() * 1000000
 
     to_delete = set(to_delete or [])
+    if replace:
+      to_delete.update(values.keys())
 
-    with self.cache.Get(subject) as sqlite_connection:
-      if replace:
-        to_delete.update(values.keys())
+    str_subject = utils.SmartStr(subject)
+    writes = []
 
-      # Delete attribute if needed.
-      if to_delete:
-        for attribute in to_delete:
-          sqlite_connection.DeleteAttribute(subject, attribute)
+    # Delete attribute if needed.
+    for attribute in to_delete:
+      writes.append((SqliteConnection.DELETE_ATTRIBUTE_QUERY,
+                     (str_subject, utils.SmartStr(attribute))))
 
-      for attribute, seq in values.items():
-        for v in seq:
-          element_timestamp = None
-          if isinstance(v, (list, tuple)):
-            v, element_timestamp = v
-          if element_timestamp is None:
-            element_timestamp = timestamp
+    for attribute, seq in values.items():
+      attribute = utils.SmartStr(attribute)
+      for v in seq:
+        element_timestamp = None
+        if isinstance(v, (list, tuple)):
+          v, element_timestamp = v
+        if element_timestamp is None:
+          element_timestamp = timestamp
 
-          element_timestamp = long(element_timestamp)
-          value = self._Encode(v)
-          sqlite_connection.SetAttribute(subject, attribute, value,
-                                         element_timestamp)
+        element_timestamp = long(element_timestamp)
+        value = self._Encode(attribute, v)
+        writes.append((SqliteConnection.SET_ATTRIBUTE_QUERY,
+                       (str_subject, attribute, element_timestamp, value)))
+
+    self.cache.Get(subject).QueueWrites(writes, sync=sync)
 
   def DeleteAttributes(self,
                        subject,
@@ -696,31 +1017,34 @@ class SqliteDataStore(data_store.DataStore):
                        sync=True,
                        token=None):
     """Remove some attributes from a subject."""
-    _ = sync
-
     if isinstance(attributes, basestring):
       raise ValueError(
           "String passed to DeleteAttributes (non string iterable expected).")
 
-    with self.cache.Get(subject) as sqlite_connection:
-      if start is None and end is None:
-        # This is done when we delete all attributes at once without
-        # caring about timestamps.
-        for attribute in list(attributes):
-          sqlite_connection.DeleteAttribute(subject, attribute)
-      else:
-        # This code path is taken when we have a timestamp range.
-        start = start or 0
-        if end is None:
-          end = (2**63) - 1  # sys.maxint
-        for attribute in list(attributes):
-          sqlite_connection.DeleteAttributeRange(subject, attribute, start, end)
+    str_subject = utils.SmartStr(subject)
+    writes = []
+    if start is None and end is None:
+      # This is done when we delete all attributes at once without
+      # caring about timestamps.
+      for attribute in list(attributes):
+        writes.append((SqliteConnection.DELETE_ATTRIBUTE_QUERY,
+                       (str_subject, utils.SmartStr(attribute))))
+    else:
+      # This code path is taken when we have a timestamp range.
+      start = int(start or 0)
+      if end is None:
+        end = (2**63) - 1  # sys.maxint
+      for attribute in list(attributes):
+        writes.append((SqliteConnection.DELETE_ATTRIBUTE_RANGE_QUERY,
+                       (str_subject, utils.SmartStr(attribute), start,
+                        int(end))))
 
-  def DeleteSubject(self, subject, sync=False, token=None):
-    _ = sync
+    self.cache.Get(subject).QueueWrites(writes, sync=sync)
 
-    with self.cache.Get(subject) as sqlite_connection:
-      sqlite_connection.DeleteSubject(subject)
+  def DeleteSubject(self, subject, sync=False, token=None):
+    self.cache.Get(subject).QueueWrites(
+        [(SqliteConnection.DELETE_SUBJECT_QUERY, (utils.SmartStr(subject),))],
+        sync=sync)
 
   def MultiResolvePrefix(self,
                          subjects,
@@ -729,26 +1053,54 @@ class SqliteDataStore(data_store.DataStore):
                          limit=None,
                          token=None):
     """Result multiple subjects using one or more attribute prefixes."""
-    result = {}
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
 
-    remaining_limit = limit
+    # Subjects are matched with the rows returned by SQLite by their string
+    # form but results are keyed by the subjects we were given.
+    subjects_by_str = {}
+    ordered_subjects = []
     for subject in subjects:
-      values = self.ResolvePrefix(
-          subject,
-          attribute_prefix,
-          token=token,
-          timestamp=timestamp,
-          limit=remaining_limit)
+      str_subject = utils.SmartStr(subject)
+      if str_subject not in subjects_by_str:
+        subjects_by_str[str_subject] = subject
+        ordered_subjects.append(str_subject)
+
+    results = self._MultiResolvePrefix(ordered_subjects, attribute_prefix,
+                                       timestamp)
+    if not limit:
+      for str_subject, values in results:
+        yield subjects_by_str[str_subject], values
+      return
 
+    # The limit is applied to subjects in the order they were given so all
+    # the results have to be known first.
+    results = dict(results)
+    remaining_limit = limit
+    for str_subject in ordered_subjects:
+      values = results.get(str_subject)
       if values:
-        if limit:
-          if len(values) >= remaining_limit:
-            result[subject] = values[:remaining_limit]
-            return result.iteritems()
-          remaining_limit -= len(values)
-        result[subject] = values
+        values = values[:remaining_limit]
+        yield subjects_by_str[str_subject], values
+        remaining_limit -= len(values)
+        if remaining_limit <= 0:
+          return
+
+  def _MultiResolvePrefix(self, subjects, attribute_prefix, timestamp):
+    """Yields (subject, values) using one query per database file chunk."""
+    if not attribute_prefix:
+      return
 
-    return result.iteritems()
+    start, end = self._GetStartEndTimestamp(timestamp)
+    newest = timestamp == self.NEWEST_TIMESTAMP
+
+    for group in self.cache.GroupByDatabase(subjects):
+      sqlite_connection = self.cache.Get(group[0])
+      rows = sqlite_connection.MultiGetFromPrefix(
+          group, attribute_prefix, start, end, newest=newest)
+      for subject, subject_rows in itertools.groupby(rows, lambda r: r[0]):
+        yield subject, [(attribute, self._Decode(attribute, value), ts)
+                        for _, _, attribute, value, ts in subject_rows]
 
   def _GetStartEndTimestamp(self, timestamp):
     if timestamp == self.ALL_TIMESTAMPS or timestamp is None:
@@ -781,28 +1133,28 @@ class SqliteDataStore(data_store.DataStore):
     # are lists of timestamped data.
     results = []
 
-    with self.cache.Get(subject) as sqlite_connection:
-      for prefix in attribute_prefix:
-        nr_results = len(results)
-        if limit and nr_results >= limit:
-          break
-        new_limit = limit
-        if new_limit:
-          new_limit -= nr_results
-        if timestamp == self.NEWEST_TIMESTAMP:
-          data = sqlite_connection.GetNewestFromPrefix(subject, prefix,
-                                                       new_limit)
-          for attribute, value, ts in data:
-            value = self._Decode(attribute, value)
-            results.append((attribute, value, ts))
-        else:
-          data = sqlite_connection.GetValuesFromPrefix(subject, prefix, start,
-                                                       end, new_limit)
-          for attribute, value, ts in data:
-            value = self._Decode(attribute, value)
-            results.append((attribute, value, ts))
-
-      return results
+    sqlite_connection = self.cache.Get(subject)
+    for prefix in attribute_prefix:
+      nr_results = len(results)
+      if limit and nr_results >= limit:
+        break
+      new_limit = limit
+      if new_limit:
+        new_limit -= nr_results
+      if timestamp == self.NEWEST_TIMESTAMP:
+        data = sqlite_connection.GetNewestFromPrefix(subject, prefix,
+                                                     new_limit)
+        for attribute, value, ts in data:
+          value = self._Decode(attribute, value)
+          results.append((attribute, value, ts))
+      else:
+        data = sqlite_connection.GetValuesFromPrefix(subject, prefix, start,
+                                                     end, new_limit)
+        for attribute, value, ts in data:
+          value = self._Decode(attribute, value)
+          results.append((attribute, value, ts))
+
+    return results
 
   def _GroupSubjects(self, collection, max_records):
     """Group results by subject and convert to ScanAttribute output format."""
@@ -833,18 +1185,21 @@ class SqliteDataStore(data_store.DataStore):
     subject_prefix = self._CleanSubjectPrefix(subject_prefix)
     after_urn = self._CleanAfterURN(after_urn, subject_prefix)
 
+    # Scans may use connections other than the cached ones, so pending writes
+    # need to be committed first.
+    self.cache.CommitPending()
+
     connection_iter = self.cache.GetPrefix(subject_prefix)
     if relaxed_order:
       for sqlite_connection in connection_iter:
-        with sqlite_connection:
-          for r in self._GroupSubjects(
-              list(
-                  sqlite_connection.ScanAttributes(
-                      subject_prefix,
-                      attributes,
-                      after_urn=after_urn,
-                      max_records=max_records)), max_records):
-            yield r
+        for r in self._GroupSubjects(
+            list(
+                sqlite_connection.ScanAttributes(
+                    subject_prefix,
+                    attributes,
+                    after_urn=after_urn,
+                    max_records=max_records)), max_records):
+          yield r
       return
     first_connections = []
     try:
@@ -855,15 +1210,15 @@ class SqliteDataStore(data_store.DataStore):
     if not first_connections:
       return
     if len(first_connections) == 1:
-      with first_connections[0] as sqlite_connection:
-        for r in self._GroupSubjects(
-            list(
-                sqlite_connection.ScanAttributes(
-                    subject_prefix,
-                    attributes,
-                    after_urn=after_urn,
-                    max_records=max_records)), max_records):
-          yield r
+      sqlite_connection = first_connections[0]
+      for r in self._GroupSubjects(
+          list(
+              sqlite_connection.ScanAttributes(
+                  subject_prefix,
+                  attributes,
+                  after_urn=after_urn,
+                  max_records=max_records)), max_records):
+        yield r
       return
     raw_results = []
     for sqlite_connection in itertools.chain(first_connections,
@@ -878,6 +1233,29 @@ class SqliteDataStore(data_store.DataStore):
         sorted(raw_results, key=lambda x: x[0]), max_records):
       yield r
 
+  def ScanSubjects(self,
+                   subject_prefix,
+                   after_urn=None,
+                   max_records=None,
+                   token=None):
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = self._CleanAfterURN(after_urn, subject_prefix)
+
+    self.cache.CommitPending()
+
+    # Each file is asked for up to max_records subjects, the first ones of
+    # all of them are listed.
+    subjects = []
+    for sqlite_connection in self.cache.GetPrefix(subject_prefix):
+      subjects.append(
+          sqlite_connection.ScanSubjects(
+              subject_prefix, after_urn=after_urn, max_records=max_records))
+
+    merged = heapq.merge(*subjects)
+    if max_records:
+      merged = itertools.islice(merged, max_records)
+    return (utils.SmartUnicode(subject) for subject in merged)
+
   def ResolveMulti(self,
                    subject,
                    attributes,
@@ -890,27 +1268,27 @@ class SqliteDataStore(data_store.DataStore):
     results = []
     start, end = self._GetStartEndTimestamp(timestamp)
 
-    with self.cache.Get(subject) as sqlite_connection:
-      for attribute in attributes:
-        if timestamp == self.NEWEST_TIMESTAMP:
-          ret = sqlite_connection.GetNewestValue(subject, attribute)
-          if ret:
-            value, ts = ret
-            value = self._Decode(attribute, value)
-            results.append((attribute, value, ts))
-            if limit and len(results) >= limit:
-              break
-        else:
-          new_limit = limit
-          if new_limit:
-            new_limit = limit - len(results)
-          values = sqlite_connection.GetValues(subject, attribute, start, end,
-                                               new_limit)
-          for value, ts in values:
-            value = self._Decode(attribute, value)
-            results.append((attribute, value, ts))
-        if limit and len(results) >= limit:
-          break
+    sqlite_connection = self.cache.Get(subject)
+    for attribute in attributes:
+      if timestamp == self.NEWEST_TIMESTAMP:
+        ret = sqlite_connection.GetNewestValue(subject, attribute)
+        if ret:
+          value, ts = ret
+          value = self._Decode(attribute, value)
+          results.append((attribute, value, ts))
+          if limit and len(results) >= limit:
+            break
+      else:
+        new_limit = limit
+        if new_limit:
+          new_limit = limit - len(results)
+        values = sqlite_connection.GetValues(subject, attribute, start, end,
+                                             new_limit)
+        for value, ts in values:
+          value = self._Decode(attribute, value)
+          results.append((attribute, value, ts))
+      if limit and len(results) >= limit:
+        break
 
     return results
 
@@ -939,7 +1317,9 @@ class SqliteDataStore(data_store.DataStore):
     return self.cache.RootPath()
 
   def Flush(self):
-    pass
+    # The flusher thread starts before the cache is created.
+    if self.cache is not None:
+      self.cache.CommitPending()
 
   def ChangeLocation(self, location):
     self.cache.ChangePath(location)
@@ -2,6 +2,9 @@
 """Tests the SQLite data store."""
 
 import shutil
+import sqlite3
+import threading
+import time
 
 
 from grr.lib import access_control
@@ -49,6 +52,161 @@ class SqliteTestMixin(object):
 class SqliteDataStoreTest(SqliteTestMixin, data_store_test._DataStoreTest):
   """Test the sqlite data store."""
 
+  def testGroupCommit(self):
+    subject = "aff4:/group_commit"
+
+    def Write(i):
+      data_store.DB.Set(
+          subject,
+          "metadata:%d" % i,
+          str(i),
+          replace=False,
+          sync=i % 2 == 0,
+          token=self.token)
+
+    threads = [threading.Thread(target=Write, args=(i,)) for i in range(20)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # Reads see pending writes.
+    results = data_store.DB.ResolvePrefix(
+        subject, "metadata:", token=self.token)
+    self.assertEqual(len(results), 20)
+
+    data_store.DB.Flush()
+    connection = data_store.DB.cache.Get(subject)
+    self.assertFalse(connection.pending)
+    self.assertEqual(connection.committed_batch, connection.executed_batch)
+
+  def testGroupCommitError(self):
+    subject = "aff4:/group_commit_error"
+    connection = data_store.DB.cache.Get(subject)
+    errors = []
+
+    def Write():
+      try:
+        data_store.DB.Set(
+            subject, "metadata:waiting", "1", sync=True, token=self.token)
+      except sqlite3.DatabaseError as e:
+        errors.append(e)
+
+    # Holding the lock makes the other thread wait for our commit.
+    with connection.lock:
+      thread = threading.Thread(target=Write)
+      thread.start()
+      while not connection.pending:
+        time.sleep(0.01)
+
+      connection.QueueWrites(
+          [("INSERT INTO missing VALUES (?)", (1,))], sync=False)
+      self.assertRaises(sqlite3.DatabaseError, connection.CommitPending)
+
+    thread.join()
+    # The waiting writer gets the error instead of returning successfully.
+    self.assertEqual(len(errors), 1)
+    self.assertFalse(connection.waiters)
+    self.assertFalse(connection.batch_errors)
+    self.assertFalse(
+        data_store.DB.ResolvePrefix(subject, "metadata:", token=self.token))
+
+    # The connection can be written to again.
+    data_store.DB.Set(subject, "metadata:next", "2", sync=True, token=self.token)
+    self.assertEqual(
+        len(data_store.DB.ResolvePrefix(subject, "metadata:",
+                                        token=self.token)), 1)
+
+  def testReadsDoNotCommitPendingWrites(self):
+    subject = "aff4:/read_pending"
+    connection = data_store.DB.cache.Get(subject)
+    commits = []
+    commit = sqlite_data_store.SqliteConnection._Commit
+
+    def RecordingCommit(connection):
+      # The flusher thread commits too.
+      if threading.current_thread().name == "MainThread":
+        commits.append(connection)
+      return commit(connection)
+
+    with utils.Stubber(connection, "group_commit_latency", 1000):
+      with utils.Stubber(sqlite_data_store.SqliteConnection, "_Commit",
+                         RecordingCommit):
+        for i in range(10):
+          data_store.DB.Set(
+              subject,
+              "metadata:%d" % i,
+              str(i),
+              replace=False,
+              sync=False,
+              token=self.token)
+          results = data_store.DB.ResolvePrefix(
+              subject, "metadata:", token=self.token)
+          self.assertEqual(len(results), i + 1)
+
+    self.assertFalse(commits)
+
+  def testConcurrentReaders(self):
+    subject = "aff4:/concurrent_readers"
+    for i in range(10):
+      data_store.DB.Set(
+          subject, "metadata:%d" % i, str(i), replace=False, token=self.token)
+
+    results = []
+
+    def Read():
+      results.append(
+          len(
+              data_store.DB.ResolvePrefix(
+                  subject, "metadata:", token=self.token)))
+
+    threads = [threading.Thread(target=Read) for _ in range(10)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(results, [10] * 10)
+
+    connection = data_store.DB.cache.Get(subject)
+    self.assertTrue(connection.readers)
+    self.assertLessEqual(
+        len(connection.readers), connection.reader_pool_size)
+
+    # Evicting the connection from the cache closes its readers.
+    readers = list(connection.readers)
+    data_store.DB.cache.Flush()
+    self.assertFalse(connection.readers)
+    for reader in readers:
+      self.assertRaises(Exception, reader.execute, "SELECT 1")
+
+  def testMultiResolvePrefixQueriesOncePerDatabase(self):
+    subjects = ["aff4:/multi_resolve/%d" % i for i in range(100)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.MultiSet(
+          subject, {"metadata:%d" % i: [str(i)],
+                    "aff4:size": [i]},
+          token=self.token)
+
+    queries = []
+    execute_read = sqlite_data_store.SqliteConnection.ExecuteRead
+
+    def CountingExecuteRead(connection, query, args):
+      queries.append(query)
+      return execute_read(connection, query, args)
+
+    with utils.Stubber(sqlite_data_store.SqliteConnection, "ExecuteRead",
+                       CountingExecuteRead):
+      results = dict(
+          data_store.DB.MultiResolvePrefix(
+              subjects, ["metadata:", "aff4:size"], token=self.token))
+
+    self.assertEqual(len(queries), 1)
+    self.assertEqual(len(results), 100)
+    for i, subject in enumerate(subjects):
+      self.assertEqual([(a, v) for a, v, _ in results[subject]],
+                       [("metadata:%d" % i, str(i)), ("aff4:size", i)])
+
 
 def main(args):
   test_lib.main(args)
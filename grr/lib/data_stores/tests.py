@@ -8,7 +8,10 @@ This module loads and registers all the data store tests.
 # These need to register plugins so,
 # pylint: disable=unused-import,g-import-not-at-top
 
+from grr.lib.data_stores import caching_data_store_test
 from grr.lib.data_stores import fake_data_store_test
+from grr.lib.data_stores import instrumented_data_store_test
+from grr.lib.data_stores import recording_data_store_test
 
 try:
   from grr.lib.data_stores import cloud_bigtable_data_store_test
@@ -25,6 +28,11 @@ try:
 except ImportError:
   pass
 
+try:
+  from grr.lib.data_stores import log_structured_data_store_test
+except ImportError:
+  pass
+
 try:
   from grr.lib.data_stores import http_data_store_test
 except ImportError:
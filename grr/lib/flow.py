@@ -45,6 +45,7 @@ self.runner_args: The flow runners args. This is an instance of
 
 import functools
 import operator
+import urllib
 
 
 import logging
@@ -327,6 +328,343 @@ class AttributedDict(dict):
     self.__dict__ = self
 
 
+class LazyRecordDict(dict):
+  """A dict whose values are decoded from serialized records when first used.
+
+  Only the values which were used can have changed, so only those need to be
+  encoded again to find out what to write back.
+
+  Note that dict(d) only copies the values decoded so far, use ToDict().
+  """
+
+  # The bookkeeping lives in slots since the instance __dict__ of a FlowState
+  # is the dict.
+  __slots__ = ("_records", "_undecoded")
+
+  def __init__(self, records=None):
+    """Constructor.
+
+    Args:
+      records: A dict mapping keys to the stored records of their values.
+    """
+    super(LazyRecordDict, self).__init__()
+    # The records as they are stored in the data store.
+    self._records = records if records is not None else {}
+    self._undecoded = set(self._records)
+
+  @staticmethod
+  def EncodeValue(value):
+    return rdf_protodict.DataBlob().SetValue(value).SerializeToString()
+
+  @staticmethod
+  def DecodeValue(record):
+    value = rdf_protodict.DataBlob.FromSerializedString(record).GetValue()
+    try:
+      # Unpack nested dicts just like rdf_protodict.Dict.ToDict() does.
+      return value.ToDict()
+    except AttributeError:
+      return value
+
+  def _DecodeRecord(self, record):
+    return self.DecodeValue(record)
+
+  def _Decode(self, key):
+    value = self._DecodeRecord(self._records[key])
+    self._undecoded.discard(key)
+    dict.__setitem__(self, key, value)
+    return value
+
+  def _DecodeAll(self):
+    for key in list(self._undecoded):
+      self._Decode(key)
+
+  def __missing__(self, key):
+    if key in self._undecoded:
+      return self._Decode(key)
+    raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    self._undecoded.discard(key)
+    super(LazyRecordDict, self).__setitem__(key, value)
+
+  def __delitem__(self, key):
+    if key in self._undecoded:
+      self._undecoded.discard(key)
+    else:
+      super(LazyRecordDict, self).__delitem__(key)
+
+  def __contains__(self, key):
+    return (key in self._undecoded or
+            super(LazyRecordDict, self).__contains__(key))
+
+  has_key = __contains__
+
+  def __len__(self):
+    return super(LazyRecordDict, self).__len__() + len(self._undecoded)
+
+  def __iter__(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).__iter__()
+
+  def __eq__(self, other):
+    self._DecodeAll()
+    if isinstance(other, LazyRecordDict):
+      other._DecodeAll()  # pylint: disable=protected-access
+    return super(LazyRecordDict, self).__eq__(other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).__repr__()
+
+  def get(self, key, default=None):
+    if key in self:
+      return self[key]
+    return default
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def pop(self, key, *default):
+    if key in self._undecoded:
+      self._Decode(key)
+    return super(LazyRecordDict, self).pop(key, *default)
+
+  def popitem(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).popitem()
+
+  def clear(self):
+    self._undecoded.clear()
+    super(LazyRecordDict, self).clear()
+
+  def update(self, *args, **kwargs):
+    for key, value in dict(*args, **kwargs).iteritems():
+      self[key] = value
+
+  def copy(self):
+    return self.ToDict()
+
+  def keys(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).keys()
+
+  def values(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).values()
+
+  def items(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).items()
+
+  def iterkeys(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).iterkeys()
+
+  def itervalues(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).itervalues()
+
+  def iteritems(self):
+    self._DecodeAll()
+    return super(LazyRecordDict, self).iteritems()
+
+  def ToDict(self):
+    """Returns a plain dict with all the values."""
+    return dict(self.iteritems())
+
+
+class FlowStateDict(LazyRecordDict):
+  """A dict in the flow state, stored as one data store record per entry.
+
+  Flows keep their large containers, e.g. the files pending download, in
+  dicts. Entries which are not used by a state method are neither decoded nor
+  written again.
+  """
+
+  __slots__ = ()
+
+  @staticmethod
+  def EncodeKey(key):
+    """Encodes a key of the dict for use in a predicate."""
+    if isinstance(key, (int, long)) and not isinstance(key, bool):
+      return str(key)
+    return "_" + FlowStateDict.EncodeValue(key).encode("hex")
+
+  @staticmethod
+  def DecodeKey(encoded_key):
+    if encoded_key.startswith("_"):
+      return FlowStateDict.DecodeValue(encoded_key[1:].decode("hex"))
+    return int(encoded_key)
+
+  def GetRecords(self):
+    """Returns the records of all entries, encoding the decoded ones."""
+    records = dict((key, self._records[key]) for key in self._undecoded)
+    for key, value in dict.iteritems(self):
+      records[key] = self.EncodeValue(value)
+    return records
+
+
+class FlowState(LazyRecordDict, AttributedDict):
+  """The state of a flow, stored as data store records.
+
+  Each key is stored in its own record, named after the key. Dicts are stored
+  as a marker record named "<key>/" and one record per entry, named
+  "<key>/<encoded entry key>", see FlowStateDict.
+
+  Values are only decoded from their records when they are first used, and
+  GetChanges() only encodes the values which were used and only reports the
+  records which actually changed. Flows with large state therefore do not pay
+  for decoding and rewriting all of it after every state method.
+  """
+
+  # Stored as the marker record of dicts.
+  DICT_RECORD = "dict"
+
+  def __init__(self, records=None):
+    """Constructor.
+
+    Args:
+      records: A dict mapping record names to the records as stored in the
+          data store.
+    """
+    stored = {}
+    for name, record in (records or {}).iteritems():
+      key, is_dict, encoded_key = name.partition("/")
+      key = urllib.unquote(key)
+      if not is_dict:
+        stored.setdefault(key, record)
+        continue
+
+      entries = stored.get(key)
+      if not isinstance(entries, dict):
+        entries = stored[key] = {}
+      if encoded_key:
+        entries[FlowStateDict.DecodeKey(encoded_key)] = record
+
+    super(FlowState, self).__init__(stored)
+
+  def __getattr__(self, name):
+    # Only called if the value is not decoded yet.
+    if name not in LazyRecordDict.__slots__ and name in self._undecoded:
+      return self._Decode(name)
+    raise AttributeError(name)
+
+  def __setattr__(self, name, value):
+    if name != "__dict__" and name not in LazyRecordDict.__slots__:
+      self._undecoded.discard(name)
+    super(FlowState, self).__setattr__(name, value)
+
+  def __delattr__(self, name):
+    if name in self._undecoded:
+      self._undecoded.discard(name)
+    else:
+      super(FlowState, self).__delattr__(name)
+
+  def _DecodeRecord(self, record):
+    if isinstance(record, dict):
+      return FlowStateDict(record)
+    return self.DecodeValue(record)
+
+  def ToDict(self):
+    """Returns a plain dict with all the values."""
+    result = {}
+    for key, value in self.iteritems():
+      if isinstance(value, FlowStateDict):
+        value = value.ToDict()
+      result[key] = value
+    return result
+
+  @staticmethod
+  def _RecordName(key, entry_key=None):
+    name = urllib.quote(utils.SmartStr(key), safe="")
+    if entry_key is None:
+      return name
+    return "%s/%s" % (name, FlowStateDict.EncodeKey(entry_key))
+
+  def _RecordNames(self, key, stored):
+    if not isinstance(stored, dict):
+      return [self._RecordName(key)]
+    return [self._RecordName(key) + "/"] + [
+        self._RecordName(key, entry_key) for entry_key in stored
+    ]
+
+  def GetChanges(self):
+    """Returns the records which need to be written.
+
+    Only values which were used are encoded again. Once the changes are
+    written, they must be passed to CommitChanges().
+
+    Returns:
+      A tuple of a dict mapping record names to their new records and a list of
+      the names of the records to delete.
+    """
+    changed = {}
+    deleted = []
+    for key, value in dict.iteritems(self):
+      stored = self._records.get(key)
+      if not isinstance(value, dict):
+        if isinstance(stored, dict):
+          deleted.extend(self._RecordNames(key, stored))
+        record = self.EncodeValue(value)
+        if stored != record:
+          changed[self._RecordName(key)] = record
+        continue
+
+      if isinstance(value, FlowStateDict):
+        entries = value.GetRecords()
+      else:
+        entries = dict((entry_key, self.EncodeValue(entry))
+                       for entry_key, entry in value.iteritems())
+
+      if not isinstance(stored, dict):
+        if stored is not None:
+          deleted.append(self._RecordName(key))
+        changed[self._RecordName(key) + "/"] = self.DICT_RECORD
+        stored = {}
+
+      for entry_key, record in entries.iteritems():
+        if stored.get(entry_key) != record:
+          changed[self._RecordName(key, entry_key)] = record
+      for entry_key in stored:
+        if entry_key not in entries:
+          deleted.append(self._RecordName(key, entry_key))
+
+    for key, stored in self._records.iteritems():
+      if key not in self:
+        deleted.extend(self._RecordNames(key, stored))
+
+    return changed, deleted
+
+  def CommitChanges(self, changed, deleted):
+    """Records that the changes returned by GetChanges() were written."""
+    for name in deleted:
+      key, is_dict, encoded_key = name.partition("/")
+      key = urllib.unquote(key)
+      entries = self._records.get(key)
+      if is_dict and encoded_key and isinstance(entries, dict):
+        entries.pop(FlowStateDict.DecodeKey(encoded_key), None)
+      else:
+        self._records.pop(key, None)
+
+    for name, record in changed.iteritems():
+      key, is_dict, encoded_key = name.partition("/")
+      key = urllib.unquote(key)
+      if not is_dict:
+        self._records[key] = record
+        continue
+
+      entries = self._records.get(key)
+      if not isinstance(entries, dict):
+        entries = self._records[key] = {}
+      if encoded_key:
+        entries[FlowStateDict.DecodeKey(encoded_key)] = record
+
+
 class PendingFlowTermination(rdf_structs.RDFProtoStruct):
   """Descriptor of a pending flow termination."""
   protobuf = jobs_pb2.PendingFlowTermination
@@ -765,6 +1103,8 @@ class GRRFlow(FlowBase):
   class SchemaCls(aff4.AFF4Volume.SchemaCls):
     """Attributes specific to GRRFlow."""
 
+    # Only read for flows written before the state was stored per key, see
+    # STATE_RECORD_PREFIX.
     FLOW_STATE_DICT = aff4.Attribute(
         "aff4:flow_state_dict",
         rdf_protodict.AttributedDict,
@@ -815,6 +1155,13 @@ class GRRFlow(FlowBase):
         "states are called.",
         creates_new_object_version=False)
 
+  # The records of the flow state are stored in attributes with this prefix,
+  # see FlowState.
+  STATE_RECORD_PREFIX = "aff4:flow_state/"
+
+  # Set if the state was read from the FLOW_STATE_DICT attribute.
+  legacy_state = False
+
   # This is used to arrange flows into a tree view
   category = ""
   friendly_name = None
@@ -842,15 +1189,22 @@ class GRRFlow(FlowBase):
       if args:
         self.args = args.payload
 
+      prefix_length = len(self.STATE_RECORD_PREFIX)
+      self.state = FlowState({
+          predicate[prefix_length:]: record
+          for predicate, record in self.raw_attributes.iteritems()
+          if predicate.startswith(self.STATE_RECORD_PREFIX)
+      })
       if state:
-        self.state = AttributedDict(state.ToDict())
-      else:
-        self.state = AttributedDict()
+        # Flows written before the state was stored per key. All values are
+        # written as records on the next flush.
+        self.state.update(state.ToDict())
+        self.legacy_state = True
 
       self.Load()
 
     if self.state is None:
-      self.state = AttributedDict()
+      self.state = FlowState()
 
   def CreateRunner(self, **kw):
     """Make a new runner."""
@@ -893,8 +1247,32 @@ class GRRFlow(FlowBase):
       self.Set(self.Schema.FLOW_ARGS(self.args))
       self.Set(self.Schema.FLOW_CONTEXT(self.context))
       self.Set(self.Schema.FLOW_RUNNER_ARGS(self.runner_args))
-      protodict = rdf_protodict.AttributedDict().FromDict(self.state)
-      self.Set(self.Schema.FLOW_STATE_DICT(protodict))
+      self._WriteStateRecords()
+
+  def _WriteStateRecords(self):
+    """Writes the state values which changed since they were last written."""
+    changed, deleted = self.state.GetChanges()
+    if self.legacy_state:
+      self.DeleteAttribute(self.Schema.FLOW_STATE_DICT)
+      self.legacy_state = False
+
+    if not changed and not deleted:
+      return
+
+    values = {}
+    for name, record in changed.iteritems():
+      values[self.STATE_RECORD_PREFIX + name] = [record]
+    to_delete = [self.STATE_RECORD_PREFIX + name for name in deleted]
+
+    if self.mutation_pool:
+      self.mutation_pool.MultiSet(self.urn, values, to_delete=to_delete)
+    else:
+      data_store.DB.MultiSet(
+          self.urn, values, to_delete=to_delete, token=self.token)
+
+    # Only written changes are forgotten, failed writes are retried on the next
+    # flush.
+    self.state.CommitChanges(changed, deleted)
 
   def Status(self, format_str, *args):
     """Flows can call this method to set a status message visible to users."""
@@ -428,10 +428,13 @@ class FlowRunner(object):
     # First ensure that client messages are all removed. NOTE: We make a new
     # queue manager here because we want only the client messages to be removed
     # ASAP. This must happen before we actually run the flow to ensure the
-    # client requests are removed from the client queues.
+    # client requests are removed from the client queues. The requests are
+    # read through our own queue manager which might have them prefetched.
+    completed_requests = list(
+        self.queue_manager.FetchCompletedRequests(
+            self.session_id, timestamp=(0, notification.timestamp)))
     with queue_manager.QueueManager(token=self.token) as manager:
-      for request, _ in manager.FetchCompletedRequests(
-          self.session_id, timestamp=(0, notification.timestamp)):
+      for request, _ in completed_requests:
         # Requests which are not destined to clients have no embedded request
         # message.
         if request.HasField("request"):
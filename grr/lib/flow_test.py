@@ -4,6 +4,7 @@
 
 import time
 
+import mock
 
 from grr.client import vfs
 from grr.client.client_actions import standard
@@ -215,6 +216,161 @@ class FlowCreationTest(BasicFlowTest):
         client_id=self.client_id):
       pass
 
+  def testFlowStateIsStoredPerKey(self):
+    session_id = flow.GRRFlow.StartFlow(
+        client_id=self.client_id, flow_name="FlowOrderTest", token=self.token)
+
+    with aff4.FACTORY.OpenWithLock(session_id, token=self.token) as flow_obj:
+      flow_obj.state.small = 1
+      flow_obj.state.large = {"values": range(100)}
+
+    predicates = [
+        predicate
+        for predicate, _, _ in data_store.DB.ResolvePrefix(
+            session_id, flow.GRRFlow.STATE_RECORD_PREFIX, token=self.token)
+    ]
+    self.assertIn("aff4:flow_state/small", predicates)
+    # Dicts are stored with one record per entry.
+    self.assertIn("aff4:flow_state/large/", predicates)
+    self.assertIn("aff4:flow_state/large/" + flow.FlowStateDict.EncodeKey(
+        "values"), predicates)
+
+    # Values which are not used are neither decoded nor written again.
+    with mock.patch.object(
+        flow.FlowState, "EncodeValue",
+        wraps=flow.FlowState.EncodeValue) as encode_value:
+      with mock.patch.object(
+          flow.FlowState, "DecodeValue",
+          wraps=flow.FlowState.DecodeValue) as decode_value:
+        with aff4.FACTORY.OpenWithLock(
+            session_id, token=self.token) as flow_obj:
+          flow_obj.state.small += 1
+
+    self.assertEqual(encode_value.call_count, 1)
+    self.assertEqual(decode_value.call_count, 1)
+
+    flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+    self.assertEqual(flow_obj.state.small, 2)
+    self.assertEqual(flow_obj.state.large, {"values": range(100)})
+
+  def testFlowStateIsReadFromFlowStateDict(self):
+    session_id = flow.GRRFlow.StartFlow(
+        client_id=self.client_id, flow_name="FlowOrderTest", token=self.token)
+
+    # Flows used to store their whole state in a single attribute.
+    legacy_state = rdf_protodict.AttributedDict().FromDict({"foo": "bar"})
+    data_store.DB.Set(
+        session_id,
+        flow.GRRFlow.SchemaCls.FLOW_STATE_DICT,
+        legacy_state.SerializeToDataStore(),
+        token=self.token)
+
+    with aff4.FACTORY.OpenWithLock(session_id, token=self.token) as flow_obj:
+      self.assertEqual(flow_obj.state.foo, "bar")
+
+    values = dict((predicate, value)
+                  for predicate, value, _ in data_store.DB.ResolvePrefix(
+                      session_id, "aff4:flow_state", token=self.token))
+    self.assertNotIn("aff4:flow_state_dict", values)
+    self.assertIn("aff4:flow_state/foo", values)
+
+    flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+    self.assertEqual(flow_obj.state.foo, "bar")
+
+  def testFlowStateDecodesValuesLazily(self):
+    state = flow.FlowState()
+    state.number = 1
+    state["values"] = [1, 2]
+    records, deleted = state.GetChanges()
+    self.assertEqual(sorted(records), ["number", "values"])
+    self.assertEqual(deleted, [])
+
+    state = flow.FlowState(records)
+    self.assertEqual(len(state), 2)
+    self.assertIn("values", state)
+    self.assertEqual(dict.keys(state), [])
+
+    self.assertEqual(state.number, 1)
+    self.assertEqual(dict.keys(state), ["number"])
+    self.assertEqual(state.GetChanges(), ({}, []))
+
+    state["values"].append(3)
+    del state.number
+    records, deleted = state.GetChanges()
+    self.assertEqual(records.keys(), ["values"])
+    self.assertEqual(deleted, ["number"])
+    self.assertEqual(state.ToDict(), {"values": [1, 2, 3]})
+
+  def testFlowStateDictIsStoredPerEntry(self):
+    state = flow.FlowState()
+    state.pending = {1: {"size": 1}, 2: {"size": 2}, "name": "foo"}
+    records, deleted = state.GetChanges()
+    self.assertEqual(
+        sorted(records), [
+            "pending/", "pending/1", "pending/2",
+            "pending/" + flow.FlowStateDict.EncodeKey("name")
+        ])
+    self.assertEqual(deleted, [])
+    state.CommitChanges(records, deleted)
+    self.assertEqual(state.GetChanges(), ({}, []))
+
+    state = flow.FlowState(records)
+    self.assertEqual(len(state.pending), 3)
+    self.assertIn("name", state.pending)
+    self.assertEqual(dict.keys(state.pending), [])
+
+    # Only the entries which were used are encoded again, and only the ones
+    # which changed are written.
+    with mock.patch.object(
+        flow.LazyRecordDict, "EncodeValue",
+        wraps=flow.LazyRecordDict.EncodeValue) as encode_value:
+      state.pending[1]["size"] += 10
+      state.pending.pop(2)
+      state.pending[3] = {"size": 3}
+      self.assertEqual(state.pending["name"], "foo")
+      records, deleted = state.GetChanges()
+
+    self.assertEqual(encode_value.call_count, 3)
+    self.assertEqual(sorted(records), ["pending/1", "pending/3"])
+    self.assertEqual(deleted, ["pending/2"])
+
+    # Nothing is forgotten until the changes are committed.
+    self.assertEqual(state.GetChanges(), (records, deleted))
+    state.CommitChanges(records, deleted)
+    self.assertEqual(state.GetChanges(), ({}, []))
+    self.assertEqual(state.ToDict(), {
+        "pending": {1: {"size": 11}, 3: {"size": 3}, "name": "foo"}
+    })
+
+    # Replacing the dict with another value removes all its records.
+    state.pending = [1, 2]
+    records, deleted = state.GetChanges()
+    self.assertEqual(records.keys(), ["pending"])
+    self.assertEqual(
+        sorted(deleted), [
+            "pending/", "pending/1", "pending/3",
+            "pending/" + flow.FlowStateDict.EncodeKey("name")
+        ])
+
+  def testFlowStateIsWrittenAgainAfterFailedWrite(self):
+    session_id = flow.GRRFlow.StartFlow(
+        client_id=self.client_id, flow_name="FlowOrderTest", token=self.token)
+
+    flow_obj = aff4.FACTORY.Open(session_id, mode="rw", token=self.token)
+    flow_obj.state.files = {1: "foo"}
+
+    def FailingMultiSet(*unused_args, **unused_kwargs):
+      raise IOError("Data store unavailable.")
+
+    with utils.Stubber(data_store.DB, "MultiSet", FailingMultiSet):
+      with self.assertRaises(IOError):
+        flow_obj._WriteStateRecords()
+
+    flow_obj._WriteStateRecords()
+
+    flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+    self.assertEqual(flow_obj.state.files, {1: "foo"})
+
   def testTerminate(self):
     session_id = flow.GRRFlow.StartFlow(
         client_id=self.client_id, flow_name="FlowOrderTest", token=self.token)
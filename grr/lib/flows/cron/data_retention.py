@@ -45,7 +45,8 @@ class CleanHunts(cronjobs.SystemCronFlow):
 
       runner = hunt.GetRunner()
       if runner.context.expires < deadline:
-        aff4.FACTORY.Delete(hunt.urn, token=self.token)
+        aff4.FACTORY.Delete(
+            hunt.urn, token=self.token, progress_callback=self.HeartBeat)
         self.HeartBeat()
 
 
@@ -102,7 +103,8 @@ class CleanTemp(cronjobs.SystemCronFlow):
         if tmp_obj.Get(tmp_obj.Schema.LAST) < deadline:
           expired_tmp_urns.append(tmp_obj.urn)
 
-      aff4.FACTORY.MultiDelete(expired_tmp_urns, token=self.token)
+      aff4.FACTORY.MultiDelete(
+          expired_tmp_urns, token=self.token, progress_callback=self.HeartBeat)
       self.HeartBeat()
 
 
@@ -141,5 +143,8 @@ class CleanInactiveClients(cronjobs.SystemCronFlow):
         if client.Get(client.Schema.LAST) < deadline:
           inactive_client_urns.append(client.urn)
 
-      aff4.FACTORY.MultiDelete(inactive_client_urns, token=self.token)
+      aff4.FACTORY.MultiDelete(
+          inactive_client_urns,
+          token=self.token,
+          progress_callback=self.HeartBeat)
       self.HeartBeat()
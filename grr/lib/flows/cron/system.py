@@ -99,6 +99,10 @@ class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
 
   CLIENT_STATS_URN = rdfvalue.RDFURN("aff4:/stats/ClientFleetStats")
 
+  # The client attributes ProcessClient() uses. Only these are read when the
+  # clients are opened, all of them are if this is None.
+  CLIENT_ATTRIBUTES = None
+
   def BeginProcessing(self):
     pass
 
@@ -139,7 +143,11 @@ class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
 
       processed_count = 0
       for child in aff4.FACTORY.MultiOpen(
-          children_urns, mode="r", token=self.token, age=aff4.NEWEST_TIME):
+          children_urns,
+          mode="r",
+          token=self.token,
+          age=aff4.NEWEST_TIME,
+          projection=self.CLIENT_ATTRIBUTES):
         if isinstance(child, aff4_grr.VFSGRRClient):
           self.ProcessClient(child)
           processed_count += 1
@@ -163,6 +171,12 @@ class GRRVersionBreakDown(AbstractClientStatsCronFlow):
 
   frequency = rdfvalue.Duration("4h")
 
+  CLIENT_ATTRIBUTES = [
+      aff4_grr.VFSGRRClient.SchemaCls.PING,
+      aff4_grr.VFSGRRClient.SchemaCls.CLIENT_INFO,
+      aff4_grr.VFSGRRClient.SchemaCls.LABELS
+  ]
+
   def BeginProcessing(self):
     self.counter = _ActiveCounter(
         aff4_stats.ClientFleetStats.SchemaCls.GRRVERSION_HISTOGRAM)
@@ -187,6 +201,13 @@ class GRRVersionBreakDown(AbstractClientStatsCronFlow):
 class OSBreakDown(AbstractClientStatsCronFlow):
   """Records relative ratios of OS versions in 7 day actives."""
 
+  CLIENT_ATTRIBUTES = [
+      aff4_grr.VFSGRRClient.SchemaCls.PING,
+      aff4_grr.VFSGRRClient.SchemaCls.SYSTEM,
+      aff4_grr.VFSGRRClient.SchemaCls.UNAME,
+      aff4_grr.VFSGRRClient.SchemaCls.LABELS
+  ]
+
   def BeginProcessing(self):
     self.counters = [
         _ActiveCounter(aff4_stats.ClientFleetStats.SchemaCls.OS_HISTOGRAM),
@@ -221,6 +242,11 @@ class LastAccessStats(AbstractClientStatsCronFlow):
   # The number of clients fall into these bins (number of hours ago)
   _bins = [1, 2, 3, 7, 14, 30, 60]
 
+  CLIENT_ATTRIBUTES = [
+      aff4_grr.VFSGRRClient.SchemaCls.PING,
+      aff4_grr.VFSGRRClient.SchemaCls.LABELS
+  ]
+
   def _ValuesForLabel(self, label):
     if label not in self.values:
       self.values[label] = [0] * len(self._bins)
@@ -2,6 +2,7 @@
 """The GRR frontend server."""
 
 import operator
+import threading
 import time
 
 import logging
@@ -29,6 +30,107 @@ from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 
 
+class ClientLastSeenAggregator(object):
+  """Coalesces the CLIENT_IP, CLOCK and PING updates of polling clients.
+
+  Instead of writing the client object on every poll, the newest values for
+  each client are kept in memory and written to the data store in batches
+  by a background thread. Updates that could not be written are kept for the
+  next batch.
+  """
+
+  def __init__(self, flush_interval, max_clocks=100000, token=None):
+    """Constructor.
+
+    Args:
+      flush_interval: How often (in seconds) pending updates are written.
+      max_clocks: How many client clocks to remember for replay protection.
+      token: The token to use for writing.
+    """
+    self.token = token
+    self.lock = threading.RLock()
+    self.pending = {}
+    # The newest clock we have seen for each client. This is authoritative
+    # over the data store since pending clocks might not have been written
+    # yet.
+    self.clocks = utils.FastStore(max_size=max_clocks)
+
+    self.flush_thread = utils.InterruptableThread(
+        name="ClientLastSeenAggregator",
+        target=self._PeriodicFlush,
+        sleep_time=flush_interval)
+    self.flush_thread.start()
+
+  def GetClock(self, client_id):
+    """Returns the newest known clock for the client or None."""
+    try:
+      return self.clocks.Get(str(client_id))
+    except KeyError:
+      return None
+
+  def Update(self, client_id, ip=None, clock=None, ping=None):
+    """Records new values for a client, replacing any pending ones."""
+    client_id = str(client_id)
+    schema = aff4_grr.VFSGRRClient.SchemaCls
+    with self.lock:
+      values = self.pending.setdefault(client_id, {})
+      if ip is not None:
+        values[schema.CLIENT_IP] = schema.CLIENT_IP(ip)
+      if clock is not None:
+        values[schema.CLOCK] = clock
+        self.clocks.Put(client_id, clock)
+      if ping is not None:
+        values[schema.PING] = ping
+
+    stats.STATS.IncrementCounter("grr_client_last_seen_updates")
+
+  def _PeriodicFlush(self):
+    try:
+      self.Flush()
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Failed to write client last seen updates.")
+
+  def Flush(self):
+    """Writes all pending updates to the data store."""
+    with self.lock:
+      pending, self.pending = self.pending, {}
+
+    if not pending:
+      return
+
+    try:
+      self._Write(pending)
+    except Exception:
+      with self.lock:
+        for client_id, values in pending.iteritems():
+          # Values received in the meantime are newer.
+          newer = self.pending.setdefault(client_id, {})
+          for attribute, value in values.iteritems():
+            newer.setdefault(attribute, value)
+      raise
+
+    stats.STATS.IncrementCounter("grr_client_last_seen_writes", len(pending))
+
+  def _Write(self, pending):
+    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+      for client_id, values in pending.iteritems():
+        # These attributes are not versioned so they are stored at age 0.
+        to_set = dict((attribute, [(value.SerializeToDataStore(), 0)])
+                      for attribute, value in values.iteritems())
+        aff4.FACTORY.SetAttributes(
+            rdf_client.ClientURN(client_id),
+            to_set,
+            set(to_set),
+            add_child_index=False,
+            mutation_pool=mutation_pool,
+            token=self.token)
+
+  def Stop(self):
+    """Stops the background thread and writes all pending updates."""
+    self.flush_thread.Stop()
+    self.Flush()
+
+
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
@@ -38,6 +140,19 @@ class ServerCommunicator(communicator.Communicator):
     super(ServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
     self.pub_key_cache = utils.FastStore(max_size=50000)
+    # Outbound session ciphers are reused for a while so we do not have to do
+    # RSA operations for every poll. The AgeBasedCache makes sure that they
+    # get rotated regularly.
+    self.cipher_cache = utils.AgeBasedCache(
+        max_size=config.CONFIG["Frontend.cipher_cache_size"],
+        max_age=config.CONFIG["Frontend.cipher_cache_max_age"])
+
+    self.last_seen_aggregator = None
+    flush_interval = config.CONFIG["Frontend.last_seen_flush_interval"]
+    if flush_interval > 0:
+      self.last_seen_aggregator = ClientLastSeenAggregator(
+          flush_interval, token=token)
+
     # Our common name as an RDFURN.
     self.common_name = rdfvalue.RDFURN(self.certificate.GetCN())
 
@@ -73,6 +188,20 @@ class ServerCommunicator(communicator.Communicator):
     self.pub_key_cache.Put(common_name, pub_key)
     return pub_key
 
+  def _GetRemoteCipher(self, destination):
+    """Returns a (possibly cached) session cipher for the destination."""
+    destination = str(destination)
+    try:
+      cipher = self.cipher_cache.Get(destination)
+      stats.STATS.IncrementCounter("grr_server_cipher_cache", fields=["hits"])
+      return cipher
+    except KeyError:
+      stats.STATS.IncrementCounter("grr_server_cipher_cache", fields=["misses"])
+
+    cipher = super(ServerCommunicator, self)._GetRemoteCipher(destination)
+    self.cipher_cache.Put(destination, cipher)
+    return cipher
+
   def VerifyMessageSignature(self, response_comms, signed_message_list, cipher,
                              cipher_verified, api_version, remote_public_key):
     """Verifies the message list signature.
@@ -114,7 +243,10 @@ class ServerCommunicator(communicator.Communicator):
       client.Set(client.Schema.CLIENT_IP(ip))
 
       # The very first packet we see from the client we do not have its clock
-      remote_time = client.Get(client.Schema.CLOCK) or 0
+      remote_time = None
+      if self.last_seen_aggregator:
+        remote_time = self.last_seen_aggregator.GetClock(client_id)
+      remote_time = remote_time or client.Get(client.Schema.CLOCK) or 0
       client_time = signed_message_list.timestamp or 0
 
       # This used to be a strict check here so absolutely no out of
@@ -137,9 +269,12 @@ class ServerCommunicator(communicator.Communicator):
 
       # Update the client and server timestamps only if the client
       # time moves forward.
+      clock = ping = None
       if client_time > long(remote_time):
-        client.Set(client.Schema.CLOCK, rdfvalue.RDFDatetime(client_time))
-        client.Set(client.Schema.PING, rdfvalue.RDFDatetime.Now())
+        clock = rdfvalue.RDFDatetime(client_time)
+        ping = rdfvalue.RDFDatetime.Now()
+        client.Set(client.Schema.CLOCK, clock)
+        client.Set(client.Schema.PING, ping)
         for label in client.Get(client.Schema.LABELS, []):
           stats.STATS.IncrementCounter(
               "client_pings_by_label", fields=[label.name])
@@ -147,7 +282,11 @@ class ServerCommunicator(communicator.Communicator):
         logging.warning("Out of order message for %s: %s >= %s", client_id,
                         long(remote_time), int(client_time))
 
-      client.Flush(sync=False)
+      if self.last_seen_aggregator:
+        self.last_seen_aggregator.Update(
+            client_id, ip=ip, clock=clock, ping=ping)
+      else:
+        client.Flush(sync=False)
 
     except communicator.UnknownClientCert:
       pass
@@ -502,6 +641,12 @@ class FrontEndServer(object):
       logging.debug("Unable to serve profile %s/%s: %s", version, name, e)
       return None
 
+  def Stop(self):
+    """Writes the client updates that are still pending."""
+    aggregator = self._communicator.last_seen_aggregator
+    if aggregator:
+      aggregator.Stop()
+
 
 class FrontendInit(registry.InitHook):
 
@@ -533,3 +678,7 @@ class FrontendInit(registry.InitHook):
 
     stats.STATS.RegisterCounterMetric(
         "grr_pub_key_cache", fields=[("type", str)])
+    stats.STATS.RegisterCounterMetric(
+        "grr_server_cipher_cache", fields=[("type", str)])
+    stats.STATS.RegisterCounterMetric("grr_client_last_seen_updates")
+    stats.STATS.RegisterCounterMetric("grr_client_last_seen_writes")
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Channels which wake up workers when new notifications are written.
+
+Workers find new work by reading the notification queue shards. Without a
+channel they do this on a fixed polling interval. A channel lets the processes
+which write notifications signal waiting workers, so they read the signalled
+shards right away. Workers keep scanning on a timer as a fallback, so a lost
+signal only costs latency.
+"""
+
+
+import errno
+import os
+import select
+import socket
+import time
+
+import logging
+
+from grr import config
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class NotificationChannel(object):
+  """The default channel which does not signal anything.
+
+  Workers using this channel just sleep for their polling interval.
+  """
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # If set, workers use this polling interval instead of their own since they
+  # expect to be woken up by the channel.
+  fallback_polling_interval = None
+
+  def Publish(self, queue_shards):
+    """Signals that new notifications were written to the queue shards."""
+
+  def Wait(self, timeout):
+    """Waits for a signal or until the timeout expires.
+
+    Args:
+      timeout: The maximum number of seconds to wait.
+
+    Returns:
+      A list of queue shards which were signalled, empty on timeout.
+    """
+    time.sleep(timeout)
+    return []
+
+  def Close(self):
+    """Releases all resources held by this channel."""
+
+
+class LocalSocketNotificationChannel(NotificationChannel):
+  """A channel using unix datagram sockets for single host deployments.
+
+  Every waiting worker binds a socket in a shared directory. Publishers send
+  the names of the signalled queue shards to every socket in that directory.
+  """
+
+  def __init__(self, path=None):
+    super(LocalSocketNotificationChannel, self).__init__()
+    self.path = path or config.CONFIG["Worker.notification_channel_path"]
+    self.fallback_polling_interval = config.CONFIG[
+        "Worker.notification_channel_fallback_interval"]
+    self.listen_socket = None
+    self.listen_path = None
+
+  def _GetListenSocket(self):
+    """Binds the socket this process waits on."""
+    if self.listen_socket is None:
+      utils.EnsureDirExists(self.path)
+      self.listen_path = os.path.join(self.path, "worker.%d.%d" %
+                                      (os.getpid(), id(self)))
+      listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      listen_socket.bind(self.listen_path)
+      listen_socket.setblocking(False)
+      self.listen_socket = listen_socket
+
+    return self.listen_socket
+
+  def Publish(self, queue_shards):
+    try:
+      names = os.listdir(self.path)
+    except OSError:
+      # Nobody is waiting.
+      return
+
+    data = "\n".join(utils.SmartStr(shard) for shard in queue_shards)
+    publish_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    publish_socket.setblocking(False)
+    try:
+      for name in names:
+        socket_path = os.path.join(self.path, name)
+        try:
+          publish_socket.sendto(data, socket_path)
+          stats.STATS.IncrementCounter("notification_channel_signals")
+        except socket.error as e:
+          if e.errno in (errno.ECONNREFUSED, errno.ENOTSOCK):
+            # The worker which bound this socket is gone.
+            logging.debug("Removing stale notification socket %s", socket_path)
+            try:
+              os.unlink(socket_path)
+            except OSError:
+              pass
+          # Other errors (e.g. a full socket buffer) mean the worker has
+          # pending signals already so we can just drop this one.
+    finally:
+      publish_socket.close()
+
+  def Wait(self, timeout):
+    listen_socket = self._GetListenSocket()
+    readable, _, _ = select.select([listen_socket], [], [], timeout)
+    if not readable:
+      return []
+
+    # Drain all pending signals.
+    queue_shards = set()
+    while True:
+      try:
+        data = listen_socket.recv(65536)
+      except socket.error:
+        break
+
+      for shard in data.splitlines():
+        queue_shards.add(shard)
+
+    return [rdfvalue.RDFURN(shard) for shard in sorted(queue_shards)]
+
+  def Close(self):
+    if self.listen_socket is not None:
+      self.listen_socket.close()
+      self.listen_socket = None
+      try:
+        os.unlink(self.listen_path)
+      except OSError:
+        pass
+
+
+CHANNEL = None
+
+
+def Publish(queue_shards):
+  """Signals the workers through the configured channel, if there is one."""
+  if CHANNEL is not None and queue_shards:
+    CHANNEL.Publish(queue_shards)
+
+
+class NotificationChannelInit(registry.InitHook):
+  """Init hook class for the notification channel."""
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("notification_channel_signals")
+    stats.STATS.RegisterCounterMetric("worker_notification_channel_wakeups")
+
+    global CHANNEL  # pylint: disable=global-statement
+
+    channel_name = config.CONFIG["Worker.notification_channel_class"]
+    CHANNEL = NotificationChannel.classes[channel_name]()
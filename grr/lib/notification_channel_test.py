@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Tests for grr.lib.notification_channel."""
+
+import os
+import socket
+
+import mock
+
+from grr.lib import flags
+from grr.lib import notification_channel
+from grr.lib import queue_manager
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+
+
+class LocalSocketNotificationChannelTest(test_lib.GRRBaseTest):
+  """Tests for the LocalSocketNotificationChannel."""
+
+  def setUp(self):
+    super(LocalSocketNotificationChannelTest, self).setUp()
+    self.path = os.path.join(self.temp_dir, "channel")
+    self.listener = notification_channel.LocalSocketNotificationChannel(
+        path=self.path)
+    self.publisher = notification_channel.LocalSocketNotificationChannel(
+        path=self.path)
+
+  def tearDown(self):
+    self.listener.Close()
+    self.publisher.Close()
+    super(LocalSocketNotificationChannelTest, self).tearDown()
+
+  def testWaitTimesOutWithoutSignals(self):
+    self.assertEqual(self.listener.Wait(0), [])
+
+  def testPublishWakesUpWaitingWorkers(self):
+    # Bind the listening socket.
+    self.listener.Wait(0)
+
+    shard_1 = rdfvalue.RDFURN("aff4:/W.1")
+    shard_2 = rdfvalue.RDFURN("aff4:/W.2")
+    self.publisher.Publish([shard_2])
+    self.publisher.Publish([shard_1, shard_2])
+
+    self.assertEqual(self.listener.Wait(1), [shard_1, shard_2])
+    # All signals were consumed.
+    self.assertEqual(self.listener.Wait(0), [])
+
+  def testPublishWithoutListenersDoesNothing(self):
+    self.publisher.Publish([rdfvalue.RDFURN("aff4:/W")])
+    self.assertFalse(os.path.exists(self.path))
+
+  def testStaleSocketsAreRemoved(self):
+    self.listener.Wait(0)
+
+    # A socket left behind by a worker which did not shut down cleanly.
+    stale_path = os.path.join(self.path, "worker.0.0")
+    stale_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale_socket.bind(stale_path)
+    stale_socket.close()
+
+    self.publisher.Publish([rdfvalue.RDFURN("aff4:/W")])
+
+    self.assertFalse(os.path.exists(stale_path))
+    self.assertEqual(self.listener.Wait(1), [rdfvalue.RDFURN("aff4:/W")])
+
+  def testNotificationsArePublished(self):
+    session_id = rdfvalue.SessionID(queue=queues.FLOWS, flow_name="123456")
+
+    with mock.patch.object(notification_channel, "CHANNEL",
+                           self.publisher) as channel:
+      with mock.patch.object(channel, "Publish") as publish:
+        with queue_manager.QueueManager(token=self.token) as manager:
+          manager.QueueNotification(session_id=session_id)
+
+    self.assertEqual(publish.call_count, 1)
+    published_shards = list(publish.call_args[0][0])
+    self.assertEqual(len(published_shards), 1)
+    self.assertIn(published_shards[0],
+                  queue_manager.QueueManager(
+                      token=self.token).GetAllNotificationShards(queues.FLOWS))
+
+
+def main(argv):
+  # Run the full test suite
+  test_lib.GrrTestProgram(argv=argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
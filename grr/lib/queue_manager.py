@@ -54,6 +54,13 @@ def _GetClientIdFromQueue(q):
   return str_client_id
 
 
+# Completed requests and responses of a flow which were read ahead of time.
+# completed_requests is a list of (request, status) tuples, responses maps
+# request ids to the lists of their responses.
+PrefetchedResponses = collections.namedtuple(
+    "PrefetchedResponses", ["timestamp", "completed_requests", "responses"])
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -116,7 +123,12 @@ class QueueManager(object):
     self.prev_frozen_timestamps = []
     self.frozen_timestamp = None
 
+    # PrefetchedResponses keyed by session id. They are only valid until the
+    # next Flush().
+    self.prefetched = {}
+
     self.num_notification_shards = config.CONFIG["Worker.queue_shards"]
+    self.pack_responses = config.CONFIG["Worker.pack_responses"]
 
   def GetNotificationShard(self, queue):
     queue_name = str(queue)
@@ -190,12 +202,68 @@ class QueueManager(object):
     return self.data_store.CheckRequestsForCompletion(
         requests, token=self.token)
 
+  def MultiFetchCompletedResponses(self, timestamps, limit=10000):
+    """Reads the completed requests and responses of several flows at once.
+
+    This needs two data store queries in total instead of several per flow.
+    The result can be passed to UsePrefetchedResponses() of the queue manager
+    which processes the flow.
+
+    Args:
+      timestamps: A dict mapping session ids to the (start, end) timestamp
+                  range to read for the flow.
+      limit: The maximum number of responses to read. Responses of further
+             requests are read when the flow is processed.
+
+    Returns:
+      A dict mapping session ids to PrefetchedResponses.
+    """
+    completed = self.data_store.MultiReadCompletedRequests(
+        timestamps, limit=self.request_limit, token=self.token)
+
+    request_list = []
+    total_size = 0
+    for session_id in sorted(completed):
+      for request, status in completed[session_id]:
+        total_size += status.response_id
+        if total_size > limit:
+          break
+        request_list.append(request)
+
+      if total_size > limit:
+        break
+
+    responses = {}
+    if request_list:
+      for request, request_responses in self.data_store.ReadResponses(
+          request_list, token=self.token):
+        responses.setdefault(request.session_id,
+                             {})[request.id] = request_responses
+
+    result = {}
+    for session_id, completed_requests in completed.iteritems():
+      result[session_id] = PrefetchedResponses(
+          timestamp=timestamps[session_id],
+          completed_requests=completed_requests,
+          responses=responses.get(session_id, {}))
+    return result
+
+  def UsePrefetchedResponses(self, session_id, prefetched):
+    """Uses the PrefetchedResponses of a flow until the next Flush()."""
+    self.prefetched[session_id] = prefetched
+
   def FetchCompletedRequests(self, session_id, timestamp=None):
     """Fetch all the requests with a status message queued for them."""
 
     if timestamp is None:
       timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now())
 
+    prefetched = self.prefetched.get(session_id)
+    if prefetched is not None and prefetched.timestamp == timestamp:
+      for request, status in prefetched.completed_requests:
+        yield request, status
+      return
+
     for request, status in self.data_store.ReadCompletedRequests(
         session_id,
         timestamp=timestamp,
@@ -233,14 +301,33 @@ class QueueManager(object):
         if projected_total_size > limit:
           break
 
-      for request, responses in self.data_store.ReadResponses(
-          request_list, token=self.token):
+      for request, responses in self._ReadResponses(session_id, request_list):
 
         yield (request, responses)
         total_size += len(responses)
         if total_size > limit:
           raise MoreDataException()
 
+  def _ReadResponses(self, session_id, request_list):
+    """Reads the responses for the requests, prefetched ones if possible."""
+    prefetched = self.prefetched.get(session_id)
+    if prefetched is None:
+      return self.data_store.ReadResponses(request_list, token=self.token)
+
+    result = []
+    to_read = []
+    for request in request_list:
+      if request.id in prefetched.responses:
+        result.append((request, prefetched.responses[request.id]))
+      else:
+        to_read.append(request)
+
+    if to_read:
+      result.extend(
+          self.data_store.ReadResponses(to_read, token=self.token))
+
+    return sorted(result, key=lambda x: x[0].id)
+
   def FetchRequestsAndResponses(self, session_id, timestamp=None):
     """Fetches all outstanding requests and responses for this flow.
 
@@ -301,11 +388,14 @@ class QueueManager(object):
 
   def Flush(self):
     """Writes the changes in this object to the datastore."""
+    # Our own changes make the prefetched data stale.
+    self.prefetched = {}
 
     self.data_store.StoreRequestsAndResponses(
         new_requests=self.request_queue,
         new_responses=self.response_queue,
         requests_to_delete=self.requests_to_delete,
+        pack_responses=self.pack_responses,
         token=self.token)
 
     # We need to make sure that notifications are written after the requests so
@@ -487,6 +577,27 @@ class QueueManager(object):
 
     return self._SortByPriority(output_dict.values(), queue)
 
+  def GetNotificationsByPriorityForShards(self, queue, queue_shards):
+    """Same as GetNotificationsByPriority but for the given shards of queue.
+
+    Used by the worker to read only the shards it was signalled about.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      queue_shards: A list of queue shard urns. Shards which do not belong to
+                    queue are ignored.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
+    output_dict = {}
+    queue_shards = set(queue_shards)
+    for queue_shard in self.GetAllNotificationShards(queue):
+      if queue_shard in queue_shards:
+        self._GetUnsortedNotifications(
+            queue_shard, notifications_by_session_id=output_dict)
+
+    return self._SortByPriority(output_dict.values(), queue)
+
   def GetNotifications(self, queue):
     """Returns all queue notifications sorted by priority."""
     queue_shard = self.GetNotificationShard(queue)
@@ -680,6 +791,13 @@ class QueueManager(object):
       user = self.token.username
     # Do the real work in a transaction
     try:
+      # Most client queues are empty most of the time. Checking for due tasks
+      # without the lock is cheap and saves us locking idle queues. A task
+      # scheduled right after this check will be picked up on the next call.
+      if not self._HasDueTasks(queue):
+        stats.STATS.IncrementCounter("grr_task_queue_idle_count")
+        return []
+
       lock = self.data_store.LockRetryWrapper(queue, token=self.token)
       return self._QueryAndOwn(
           lock.subject, lease_seconds=lease_seconds, limit=limit, user=user)
@@ -692,6 +810,16 @@ class QueueManager(object):
       logging.warning("Datastore exception: %s", e)
       return []
 
+  def _HasDueTasks(self, queue):
+    """Returns True if the queue has tasks which can be leased right now."""
+    return bool(
+        self.data_store.ResolvePrefix(
+            queue,
+            self.TASK_PREDICATE_PREFIX,
+            timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now()),
+            limit=1,
+            token=self.token))
+
   def _QueryAndOwn(self, subject, lease_seconds=100, limit=1, user=""):
     """Does the real work of self.QueryAndOwn()."""
     tasks = []
@@ -779,6 +907,7 @@ class QueueManagerInit(registry.InitHook):
     # Counters used by the QueueManager.
     stats.STATS.RegisterCounterMetric("grr_task_retransmission_count")
     stats.STATS.RegisterCounterMetric("grr_task_ttl_expired_count")
+    stats.STATS.RegisterCounterMetric("grr_task_queue_idle_count")
     stats.STATS.RegisterGaugeMetric(
         "notification_queue_count",
         int,
@@ -13,6 +13,7 @@ from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 
 # pylint: mode=test
@@ -71,6 +72,176 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
       # Responses contain just the status message.
       self.assertEqual(len(responses), 1)
 
+  def testMultiFetchCompletedResponses(self):
+    session_ids = [rdfvalue.SessionID(flow_name="test%d" % i) for i in range(3)]
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for session_id in session_ids:
+        for i in range(2):
+          manager.QueueRequest(
+              rdf_flows.RequestState(
+                  id=i,
+                  client_id=self.client_id,
+                  next_state="TestState",
+                  session_id=session_id))
+          manager.QueueResponse(
+              rdf_flows.GrrMessage(
+                  session_id=session_id, request_id=i, response_id=1))
+          manager.QueueResponse(
+              rdf_flows.GrrMessage(
+                  session_id=session_id,
+                  request_id=i,
+                  response_id=2,
+                  type=rdf_flows.GrrMessage.Type.STATUS))
+
+    now = rdfvalue.RDFDatetime.Now()
+    manager = queue_manager.QueueManager(token=self.token)
+    prefetched = manager.MultiFetchCompletedResponses(
+        dict((session_id, (0, now)) for session_id in session_ids))
+    self.assertEqual(sorted(prefetched), sorted(session_ids))
+
+    reader = queue_manager.QueueManager(token=self.token)
+    for session_id in session_ids:
+      expected = list(reader.FetchCompletedResponses(session_id,
+                                                     timestamp=(0, now)))
+      self.assertEqual(len(expected), 2)
+
+      with mock.patch.object(data_store.DB, "ReadCompletedRequests") as read:
+        with mock.patch.object(data_store.DB, "ReadResponses") as responses:
+          manager.UsePrefetchedResponses(session_id, prefetched[session_id])
+          self.assertEqual(
+              list(manager.FetchCompletedResponses(session_id,
+                                                   timestamp=(0, now))),
+              expected)
+
+      self.assertFalse(read.called)
+      self.assertFalse(responses.called)
+
+    # Prefetched data is only used until the next flush.
+    manager.Flush()
+    self.assertEqual(manager.prefetched, {})
+
+  def testMultiReadCompletedRequestsLimit(self):
+    session_ids = [
+        rdfvalue.SessionID(flow_name="testlimit%d" % i) for i in range(3)
+    ]
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for session_id in session_ids:
+        for i in range(2):
+          manager.QueueRequest(
+              rdf_flows.RequestState(
+                  id=i,
+                  client_id=self.client_id,
+                  next_state="TestState",
+                  session_id=session_id))
+          manager.QueueResponse(
+              rdf_flows.GrrMessage(
+                  session_id=session_id,
+                  request_id=i,
+                  response_id=1,
+                  type=rdf_flows.GrrMessage.Type.STATUS))
+
+    now = rdfvalue.RDFDatetime.Now()
+    timestamps = dict((session_id, (0, now)) for session_id in session_ids)
+
+    # The limit cuts some of the flows short, none of them may be returned
+    # partially.
+    completed = data_store.DB.MultiReadCompletedRequests(
+        timestamps, limit=5, token=self.token)
+    self.assertEqual(sorted(completed), sorted(session_ids))
+    for session_id in session_ids:
+      expected = list(
+          data_store.DB.ReadCompletedRequests(
+              session_id, timestamp=(0, now), limit=5, token=self.token))
+      self.assertEqual(len(expected), 2)
+      self.assertEqual(completed[session_id], expected)
+
+  def testPackedResponses(self):
+    session_id = rdfvalue.SessionID(flow_name="testpacked")
+    request = rdf_flows.RequestState(
+        id=1,
+        client_id=self.client_id,
+        next_state="TestState",
+        session_id=session_id)
+
+    with test_lib.ConfigOverrider({"Worker.pack_responses": True}):
+      with queue_manager.QueueManager(token=self.token) as manager:
+        manager.QueueRequest(request)
+        for i in range(1, 6):
+          manager.QueueResponse(
+              rdf_flows.GrrMessage(
+                  session_id=session_id, request_id=1, response_id=i))
+
+      # Make the packed chunks small so several of them are written.
+      with utils.Stubber(data_store.DB, "FLOW_PACKED_RESPONSES_CHUNK_SIZE",
+                         100):
+        with queue_manager.QueueManager(token=self.token) as manager:
+          manager.QueueResponse(
+              rdf_flows.GrrMessage(
+                  session_id=session_id, request_id=1, response_id=6))
+          manager.QueueResponse(
+              rdf_flows.GrrMessage(
+                  session_id=session_id,
+                  request_id=1,
+                  response_id=7,
+                  type=rdf_flows.GrrMessage.Type.STATUS))
+
+    predicates = [
+        predicate
+        for predicate, _, _ in data_store.DB.ResolveRow(
+            session_id.Add("state/request:00000001"), token=self.token)
+    ]
+    self.assertGreater(len(predicates), 1)
+    for predicate in predicates:
+      self.assertTrue(predicate.startswith("flow:packed_responses:00000001:"))
+
+    # A response arriving after the status is stored as usual.
+    with queue_manager.QueueManager(token=self.token) as manager:
+      manager.QueueResponse(
+          rdf_flows.GrrMessage(
+              session_id=session_id, request_id=1, response_id=8))
+
+    completed = list(manager.FetchCompletedResponses(session_id))
+    self.assertEqual(len(completed), 1)
+    self.assertEqual(completed[0][0], request)
+    self.assertEqual([response.response_id for response in completed[0][1]],
+                     range(1, 9))
+
+    all_requests = list(manager.FetchRequestsAndResponses(session_id))
+    self.assertEqual(completed, all_requests)
+
+  def testPackedResponsesLimit(self):
+    session_id = rdfvalue.SessionID(flow_name="testpackedlimit")
+    request = rdf_flows.RequestState(
+        id=1,
+        client_id=self.client_id,
+        next_state="TestState",
+        session_id=session_id)
+
+    with test_lib.ConfigOverrider({"Worker.pack_responses": True}):
+      with queue_manager.QueueManager(token=self.token) as manager:
+        manager.QueueRequest(request)
+        for i in range(1, 6):
+          manager.QueueResponse(
+              rdf_flows.GrrMessage(
+                  session_id=session_id, request_id=1, response_id=i))
+        manager.QueueResponse(
+            rdf_flows.GrrMessage(
+                session_id=session_id,
+                request_id=1,
+                response_id=6,
+                type=rdf_flows.GrrMessage.Type.STATUS))
+
+    # All responses are stored in a single packed chunk, but the limit still
+    # counts responses.
+    results = list(
+        data_store.DB.ReadRequestsAndResponses(
+            session_id, response_limit=3, token=self.token))
+    self.assertEqual(len(results), 1)
+    self.assertEqual([response.response_id for response in results[0][1]],
+                     [1, 2, 3])
+
   def testDeleteRequest(self):
     """Check that we can efficiently destroy a single flow request."""
     session_id = rdfvalue.SessionID(flow_name="test3")
@@ -235,6 +406,30 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
         stats.STATS.GetMetricValue("grr_task_retransmission_count"),
         self.retransmission_metric_value + 1)
 
+  def testIdleQueuesAreNotLocked(self):
+    test_queue = rdfvalue.RDFURN("fooIdle")
+    manager = queue_manager.QueueManager(token=self.token)
+
+    with mock.patch.object(
+        data_store.DB, "LockRetryWrapper",
+        wraps=data_store.DB.LockRetryWrapper) as lock_mock:
+      tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=100)
+      self.assertEqual(len(tasks), 0)
+      self.assertEqual(lock_mock.call_count, 0)
+
+      task = rdf_flows.GrrMessage(
+          queue=test_queue, session_id="aff4:/Test", generate_task_id=True)
+      manager.Schedule([task])
+
+      tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=100)
+      self.assertEqual(len(tasks), 1)
+      self.assertEqual(lock_mock.call_count, 1)
+
+      # The task is leased now so the queue is idle again.
+      tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=100)
+      self.assertEqual(len(tasks), 0)
+      self.assertEqual(lock_mock.call_count, 1)
+
   def testDelete(self):
     """Test that we can delete tasks."""
 
@@ -12,6 +12,7 @@ from grr.proto import data_server_pb2
 class DataStoreCommand(rdf_structs.RDFProtoStruct):
   protobuf = data_server_pb2.DataStoreCommand
   rdf_deps = [
+      "DataStoreCommand",  # Recursive definition.
       data_store.DataStoreRequest,
   ]
 
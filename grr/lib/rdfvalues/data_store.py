@@ -71,5 +71,6 @@ class DataStoreResponse(structs.RDFProtoStruct):
   protobuf = data_store_pb2.DataStoreResponse
   rdf_deps = [
       DataStoreRequest,
+      "DataStoreResponse",  # Recursive definition.
       ResultSet,
   ]
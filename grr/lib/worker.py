@@ -2,7 +2,12 @@
 """Module with GRRWorker implementation."""
 
 
+import math
 import pdb
+import signal
+import subprocess
+import sys
+import threading
 import time
 import traceback
 
@@ -11,11 +16,14 @@ import logging
 
 from grr import config
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import master
+from grr.lib import notification_channel
 from grr.lib import queue_manager as queue_manager_lib
 from grr.lib import queues as queues_config
+from grr.lib import rdfvalue
 from grr.lib import registry
 # pylint: disable=unused-import
 from grr.lib import server_stubs
@@ -34,6 +42,172 @@ class FlowProcessingError(Error):
   """Raised when flow requests/responses can't be processed."""
 
 
+class NotificationShardLeases(object):
+  """Leases a share of the notification shards to one of several workers.
+
+  Every notification queue is split into Worker.queue_shards shards. When
+  several worker processes cooperate, each of them holds a renewable data store
+  lease on a disjoint subset of the shard indexes and only reads the
+  notifications in those shards. Each worker also holds a lease on its own
+  index, which lets the others count the live workers. When a worker dies, its
+  leases expire and the remaining workers take over its shards. When it comes
+  back, they give them up again.
+  """
+
+  LEASE_ROOT = rdfvalue.RDFURN("aff4:/worker_shard_leases")
+
+  def __init__(self, owner_index, num_owners, lease_time=None, token=None):
+    """Constructor.
+
+    Args:
+      owner_index: The index of this worker, 0 <= owner_index < num_owners.
+      num_owners: The number of workers sharing the shards.
+      lease_time: The lease time in seconds, leases are renewed three times
+                  per lease period.
+      token: The token to use for the data store.
+    """
+    self.owner_index = owner_index
+    self.num_owners = num_owners
+    self.num_shards = config.CONFIG["Worker.queue_shards"]
+    self.lease_time = lease_time or config.CONFIG["Worker.shard_lease_time"]
+    self.token = token
+
+    self.owner_lease = None
+    # Maps shard indexes to the leases we hold on them.
+    self.leases = {}
+    self.lock = threading.RLock()
+    self.renewal_thread = None
+    self.first_renewal = None
+
+  def _OwnerSubject(self, index):
+    return self.LEASE_ROOT.Add("owners").Add(str(index))
+
+  def _ShardSubject(self, index):
+    return self.LEASE_ROOT.Add("shards").Add(str(index))
+
+  def _Lease(self, subject):
+    """Tries to lease the subject, returns None if it is leased already."""
+    try:
+      return data_store.DB.DBSubjectLock(
+          subject, lease_time=self.lease_time, token=self.token)
+    except data_store.DBSubjectLockError:
+      return None
+
+  def _Renew(self, lease):
+    """Extends the lease, returns False if we lost it already."""
+    # Once a lease has expired another worker might hold it now.
+    if not lease.CheckLease():
+      return False
+    lease.UpdateLease(self.lease_time)
+    return True
+
+  def _CountLiveOwners(self):
+    live_owners = 1
+    for index in xrange(self.num_owners):
+      if index == self.owner_index:
+        continue
+
+      lease = self._Lease(self._OwnerSubject(index))
+      if lease is None:
+        live_owners += 1
+      else:
+        lease.Release()
+
+    return live_owners
+
+  def _PreferredShards(self):
+    """All shard indexes, the ones assigned to us if all workers live first."""
+    share = int(math.ceil(float(self.num_shards) / self.num_owners))
+    start = (self.owner_index * share) % self.num_shards
+    return [(start + i) % self.num_shards for i in xrange(self.num_shards)]
+
+  def Renew(self):
+    """Renews our leases and takes or gives up shards to balance the load."""
+    with self.lock:
+      if self.owner_lease is None or not self._Renew(self.owner_lease):
+        self.owner_lease = self._Lease(self._OwnerSubject(self.owner_index))
+
+      for index, lease in self.leases.items():
+        if not self._Renew(lease):
+          logging.info("Lost lease on notification shard %d.", index)
+          del self.leases[index]
+
+      now = time.time()
+      if self.first_renewal is None:
+        self.first_renewal = now
+
+      # Right after startup the other workers might not have taken their
+      # owner leases yet so we only take our own share.
+      if now - self.first_renewal < self.lease_time:
+        live_owners = self.num_owners
+      else:
+        live_owners = self._CountLiveOwners()
+      share = int(math.ceil(float(self.num_shards) / live_owners))
+
+      preferred_shards = self._PreferredShards()
+      # Give up the shards we would pick last.
+      for index in reversed(preferred_shards):
+        if len(self.leases) <= share:
+          break
+        if index in self.leases:
+          self.leases.pop(index).Release()
+
+      for index in preferred_shards:
+        if len(self.leases) >= share:
+          break
+        if index not in self.leases:
+          lease = self._Lease(self._ShardSubject(index))
+          if lease is not None:
+            self.leases[index] = lease
+
+      stats.STATS.SetGaugeValue("worker_notification_shard_leases",
+                                len(self.leases))
+
+  def GetQueueShards(self, queues):
+    """Returns the notification shards of the queues we hold leases for."""
+    with self.lock:
+      indexes = sorted(self.leases)
+
+    result = []
+    for queue in queues:
+      for index in indexes:
+        if index == 0:
+          result.append(queue)
+        else:
+          result.append(queue.Add(str(index)))
+    return result
+
+  def _RenewInBackground(self):
+    try:
+      self.Renew()
+    except Exception as e:  # pylint: disable=broad-except
+      # Keep renewing, leases we could not renew are dropped next time.
+      logging.error("Error renewing notification shard leases: %s", e)
+
+  def Start(self):
+    """Takes the initial leases and keeps renewing them in the background."""
+    self.Renew()
+    self.renewal_thread = utils.InterruptableThread(
+        name="NotificationShardLeases",
+        target=self._RenewInBackground,
+        sleep_time=self.lease_time / 3.0)
+    self.renewal_thread.start()
+
+  def Stop(self):
+    """Stops renewing and releases all leases."""
+    if self.renewal_thread is not None:
+      self.renewal_thread.Stop()
+      self.renewal_thread = None
+
+    with self.lock:
+      for lease in self.leases.values():
+        lease.Release()
+      self.leases = {}
+      if self.owner_lease is not None:
+        self.owner_lease.Release()
+        self.owner_lease = None
+
+
 class GRRWorker(object):
   """A GRR worker."""
 
@@ -53,6 +227,7 @@ class GRRWorker(object):
                queues=queues_config.WORKER_LIST,
                threadpool_prefix="grr_threadpool",
                threadpool_size=None,
+               shard_leases=None,
                token=None):
     """Constructor.
 
@@ -60,6 +235,9 @@ class GRRWorker(object):
       queues: The queues we use to fetch new messages from.
       threadpool_prefix: A name for the thread pool used by this worker.
       threadpool_size: The number of workers to start in this thread pool.
+      shard_leases: If given, a started NotificationShardLeases object. The
+                    worker then only reads the notification shards it holds
+                    leases for.
       token: The token to use for the worker.
 
     Raises:
@@ -87,6 +265,7 @@ class GRRWorker(object):
       self.__class__.thread_pool.Start()
 
     self.token = token
+    self.shard_leases = shard_leases
     self.last_active = 0
 
     # Well known flows are just instantiated.
@@ -94,46 +273,69 @@ class GRRWorker(object):
     self.flow_lease_time = config.CONFIG["Worker.flow_lease_time"]
     self.well_known_flow_lease_time = config.CONFIG[
         "Worker.well_known_flow_lease_time"]
+    self.prefetch_batch_size = config.CONFIG["Worker.prefetch_batch_size"]
 
   def Run(self):
     """Event loop."""
+    channel = notification_channel.CHANNEL
     try:
+      signalled_shards = None
       while 1:
         if master.MASTER_WATCHER.IsMaster():
-          processed = self.RunOnce()
+          processed = self.RunOnce(queue_shards=signalled_shards)
         else:
           processed = 0
 
+        signalled_shards = None
         if processed == 0:
           logger = logging.getLogger()
           for h in logger.handlers:
             h.flush()
 
-          if time.time() - self.last_active > self.SHORT_POLL_TIME:
+          if channel.fallback_polling_interval:
+            interval = channel.fallback_polling_interval
+          elif time.time() - self.last_active > self.SHORT_POLL_TIME:
             interval = self.POLLING_INTERVAL
           else:
             interval = self.SHORT_POLLING_INTERVAL
 
-          time.sleep(interval)
+          # Wait until we are told about new notifications. On timeout we scan
+          # the notification shards as usual.
+          signalled_shards = channel.Wait(interval) or None
+          if signalled_shards:
+            stats.STATS.IncrementCounter("worker_notification_channel_wakeups")
         else:
           self.last_active = time.time()
 
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
       self.__class__.thread_pool.Join()
+      if self.shard_leases is not None:
+        self.shard_leases.Stop()
 
-  def RunOnce(self):
+  def RunOnce(self, queue_shards=None):
     """Processes one set of messages from Task Scheduler.
 
     The worker processes new jobs from the task master. For each job
     we retrieve the session from the Task Scheduler.
 
+    Args:
+        queue_shards: If given, only these notification shards are read
+                      instead of the next shard of every queue.
+
     Returns:
         Total number of messages processed by this call.
     """
     start_time = time.time()
     processed = 0
 
+    if self.shard_leases is not None:
+      leased_shards = self.shard_leases.GetQueueShards(self.queues)
+      if queue_shards is None:
+        queue_shards = leased_shards
+      else:
+        queue_shards = [s for s in queue_shards if s in leased_shards]
+
     queue_manager = queue_manager_lib.QueueManager(token=self.token)
     for queue in self.queues:
       # Freezeing the timestamp used by queue manager to query/delete
@@ -141,8 +343,13 @@ class GRRWorker(object):
       queue_manager.FreezeTimestamp()
 
       fetch_messages_start = time.time()
-      notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+      if queue_shards is None:
+        notifications_by_priority = queue_manager.GetNotificationsByPriority(
+            queue)
+      else:
+        notifications_by_priority = (
+            queue_manager.GetNotificationsByPriorityForShards(
+                queue, queue_shards))
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -227,6 +434,7 @@ class GRRWorker(object):
     """
     now = time.time()
     processed = 0
+    batch = []
     for notification in active_notifications:
       if notification.session_id not in self.queued_flows:
         if time_limit and time.time() - now > time_limit:
@@ -234,13 +442,78 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
+
+        if (self.prefetch_batch_size and
+            notification.session_id.FlowName() not in self.well_known_flows):
+          batch.append(notification)
+          if len(batch) >= self.prefetch_batch_size:
+            self._AddPrefetchTask(batch, queue_manager)
+            batch = []
+          continue
+
         self.__class__.thread_pool.AddTask(
             target=self._ProcessMessages,
             args=(notification, queue_manager.Copy()),
             name=self.__class__.__name__)
 
+    if batch:
+      self._AddPrefetchTask(batch, queue_manager)
+
     return processed
 
+  def _AddPrefetchTask(self, notifications, queue_manager):
+    self.__class__.thread_pool.AddTask(
+        target=self._PrefetchMessages,
+        args=(notifications, queue_manager.Copy()),
+        name=self.__class__.__name__)
+
+  def _PrefetchMessages(self, notifications, queue_manager):
+    """Locks and reads a batch of flows and hands them to the thread pool.
+
+    Opening each flow and reading its completed requests and responses
+    separately takes several data store round trips per flow. Here the flows
+    are read in one query and their requests and responses in two more.
+
+    Args:
+      notifications: The notifications for the flows to process.
+      queue_manager: QueueManager object used to manage notifications,
+                     requests and responses.
+    """
+    notifications = dict((n.session_id, n) for n in notifications)
+    try:
+      flow_objs = aff4.FACTORY.MultiOpenWithLock(
+          list(notifications), lease_time=self.flow_lease_time,
+          token=self.token)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error opening flows: %s", e)
+      stats.STATS.IncrementCounter(
+          "worker_session_errors", fields=[str(type(e))])
+      return
+
+    try:
+      prefetched = queue_manager.MultiFetchCompletedResponses(
+          dict((flow_obj.urn, (0, notifications[flow_obj.urn].timestamp))
+               for flow_obj in flow_objs))
+    except Exception as e:  # pylint: disable=broad-except
+      # The flows are locked already, so they are processed without the
+      # prefetched data.
+      logging.exception("Error prefetching flow responses: %s", e)
+      prefetched = {}
+
+    stats.STATS.IncrementCounter("worker_flow_lock_error",
+                                 len(notifications) - len(flow_objs))
+    stats.STATS.IncrementCounter("worker_prefetched_flows", len(flow_objs))
+
+    for flow_obj in flow_objs:
+      if flow_obj.urn in prefetched and isinstance(flow_obj, flow.FlowBase):
+        flow_obj.GetRunner().queue_manager.UsePrefetchedResponses(
+            flow_obj.urn, prefetched[flow_obj.urn])
+
+      self.__class__.thread_pool.AddTask(
+          target=self._ProcessMessages,
+          args=(notifications[flow_obj.urn], queue_manager.Copy(), flow_obj),
+          name=self.__class__.__name__)
+
   def _ProcessRegularFlowMessages(self, flow_obj, notification):
     """Processes messages for a given flow."""
     session_id = notification.session_id
@@ -262,15 +535,25 @@ class GRRWorker(object):
       logging.error("Flow %s: %s", flow_obj, e)
       raise FlowProcessingError(e)
 
-  def _ProcessMessages(self, notification, queue_manager):
-    """Does the real work with a single flow."""
-    flow_obj = None
+  def _ProcessMessages(self, notification, queue_manager, flow_obj=None):
+    """Does the real work with a single flow.
+
+    Args:
+      notification: The notification for the flow.
+      queue_manager: QueueManager object used to manage notifications,
+                     requests and responses.
+      flow_obj: The flow, if it was already opened with a lock.
+    """
     session_id = notification.session_id
 
     try:
       # Take a lease on the flow:
       flow_name = session_id.FlowName()
-      if flow_name in self.well_known_flows:
+      if flow_obj is not None:
+        # Prefetched flows were locked before they waited in the thread pool
+        # queue, the lease starts again from here. This raises if it expired.
+        flow_obj.UpdateLease(self.flow_lease_time)
+      elif flow_name in self.well_known_flows:
         # Well known flows are not necessarily present in the data store so
         # we need to create them instead of opening.
         expected_flow = self.well_known_flows[flow_name].__class__
@@ -345,6 +628,86 @@ class GRRWorker(object):
       queue_manager.DeleteNotification(session_id)
 
 
+def _RaiseKeyboardInterrupt(unused_signum, unused_frame):
+  raise KeyboardInterrupt()
+
+
+def InterruptOnSigterm():
+  """Makes SIGTERM stop the process like an interrupt does.
+
+  The worker processes release their notification shard leases and the
+  supervisor stops its worker processes on KeyboardInterrupt. By default,
+  SIGTERM would end them right away instead.
+  """
+  signal.signal(signal.SIGTERM, _RaiseKeyboardInterrupt)
+
+
+class WorkerSupervisor(object):
+  """Runs several worker processes and restarts them when they exit.
+
+  Flow processing is CPU bound, so a single worker process can not use more
+  than one core. The supervisor starts Worker.processes copies of the current
+  command line, each with its own --worker_process_index, and the workers
+  divide the notification shards among themselves (see
+  NotificationShardLeases).
+  """
+
+  POLL_INTERVAL = 1
+
+  # Minimum time between two starts of the same worker process.
+  RESTART_DELAY = 5
+
+  def __init__(self, num_processes, command=None):
+    self.num_processes = num_processes
+    self.command = command or [sys.executable] + sys.argv
+    self.processes = {}
+    self.start_times = {}
+
+  def _StartProcess(self, index):
+    self.processes[index] = subprocess.Popen(
+        self.command + ["--worker_process_index=%d" % index])
+    self.start_times[index] = time.time()
+    logging.info("Started worker process %d (pid %d).", index,
+                 self.processes[index].pid)
+
+  def CheckProcesses(self):
+    """Starts all worker processes which are not running."""
+    for index in xrange(self.num_processes):
+      process = self.processes.get(index)
+      if process is None:
+        self._StartProcess(index)
+
+      elif process.poll() is not None:
+        # Do not restart processes which die right away in a tight loop.
+        if time.time() - self.start_times[index] < self.RESTART_DELAY:
+          continue
+
+        logging.warning("Worker process %d exited with %d, restarting.", index,
+                        process.returncode)
+        stats.STATS.IncrementCounter("worker_process_restarts")
+        self._StartProcess(index)
+
+  def Run(self):
+    """Supervises the worker processes until interrupted."""
+    try:
+      while True:
+        self.CheckProcesses()
+        time.sleep(self.POLL_INTERVAL)
+    except KeyboardInterrupt:
+      logging.info("Caught interrupt, stopping worker processes.")
+    finally:
+      self.Stop()
+
+  def Stop(self):
+    for process in self.processes.values():
+      if process.poll() is None:
+        process.terminate()
+
+    for process in self.processes.values():
+      process.wait()
+    self.processes = {}
+
+
 class WorkerInit(registry.InitHook):
   """Registers worker stats variables."""
 
@@ -363,3 +726,6 @@ class WorkerInit(registry.InitHook):
     stats.STATS.RegisterEventMetric(
         "worker_flow_processing_time", fields=[("flow", str)])
     stats.STATS.RegisterEventMetric("worker_time_to_retrieve_notifications")
+    stats.STATS.RegisterGaugeMetric("worker_notification_shard_leases", int)
+    stats.STATS.RegisterCounterMetric("worker_prefetched_flows")
+    stats.STATS.RegisterCounterMetric("worker_process_restarts")
@@ -9,6 +9,7 @@ MAX_RANGE = 2**64
 REBALANCE_DIRECTORY = ".GRR_REBALANCE"
 TRANSACTION_FILENAME = ".TRANSACTION"
 REMOVE_FILENAME = ".TRANSACTION_REMOVE"
+COPY_STARTED_FILENAME = ".TRANSACTION_COPY_STARTED"
 
 # HTTP status codes.
 RESPONSE_OK = 200
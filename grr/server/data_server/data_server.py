@@ -122,7 +122,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     num_components, avg_component = cls.SERVICE.GetComponentInformation()
     stat = rdf_data_server.DataServerState(
         size=cls.SERVICE.Size(),
-        load=0,
+        load=cls.SERVICE.Load(),
         status=ok,
         num_components=num_components,
         avg_component=avg_component)
@@ -194,26 +194,63 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       return ""
     cmd = rdf_data_server.DataStoreCommand.FromSerializedString(cmd_str)
 
+    if cmd.command == rdf_data_server.DataStoreCommand.Command.BATCH:
+      response = self.HandleBatch(cmd, permissions)
+    else:
+      response = self._ExecuteCommand(cmd, permissions)
+      if response is None:
+        return ""
+
+    return sutils.SIZE_PACKER.pack(len(response)) + response
+
+  def _ExecuteCommand(self, cmd, permissions):
+    """Runs a single command and returns the serialized response."""
     request = cmd.request
     op = cmd.command
 
     cmdinfo = self.CMDTABLE.get(op)
     if not cmdinfo:
       logging.error("Unrecognized command %d", op)
-      return ""
+      return None
     method, perm = cmdinfo
     if perm in permissions:
-      response = method(request)
-    else:
-      status_desc = ("Operation not allowed: required %s but only have "
-                     "%s permissions" % (perm, permissions))
-      resp = rdf_data_store.DataStoreResponse(
-          request=cmd.request,
-          status_desc=status_desc,
-          status=rdf_data_store.DataStoreResponse.Status.AUTHORIZATION_DENIED)
-      response = resp.SerializeToString()
+      return method(request)
+
+    status_desc = ("Operation not allowed: required %s but only have "
+                   "%s permissions" % (perm, permissions))
+    resp = rdf_data_store.DataStoreResponse(
+        request=cmd.request,
+        status_desc=status_desc,
+        status=rdf_data_store.DataStoreResponse.Status.AUTHORIZATION_DENIED)
+    return resp.SerializeToString()
+
+  def HandleBatch(self, cmd, permissions):
+    """Runs a batch of commands and returns all their responses at once.
+
+    Commands are run in order and each of them is checked for permissions
+    separately, so a failing command does not affect the others.
+
+    Args:
+      cmd: A DataStoreCommand of type BATCH.
+      permissions: The permissions of the client.
+
+    Returns:
+      A serialized DataStoreResponse with one response per command.
+    """
+    response = rdf_data_store.DataStoreResponse()
+    for subcmd in cmd.commands:
+      serialized = self._ExecuteCommand(subcmd, permissions)
+      if serialized is None:
+        subresponse = rdf_data_store.DataStoreResponse(
+            request=subcmd.request,
+            status_desc="Unrecognized command %d" % subcmd.command,
+            status=rdf_data_store.DataStoreResponse.Status.DATA_STORE_ERROR)
+      else:
+        subresponse = rdf_data_store.DataStoreResponse.FromSerializedString(
+            serialized)
+      response.responses.Append(subresponse)
 
-    return sutils.SIZE_PACKER.pack(len(response)) + response
+    return response.SerializeToString()
 
   def HandleRegister(self):
     """Registers a data server in the master."""
@@ -805,7 +842,8 @@ def Start(db,
       cmd.LOCK_SUBJECT: (reqhandler_cls.SERVICE.LockSubject, "w"),
       cmd.EXTEND_SUBJECT: (reqhandler_cls.SERVICE.ExtendSubject, "w"),
       cmd.UNLOCK_SUBJECT: (reqhandler_cls.SERVICE.UnlockSubject, "w"),
-      cmd.SCAN_ATTRIBUTES: (reqhandler_cls.SERVICE.ScanAttributes, "r")
+      cmd.SCAN_ATTRIBUTES: (reqhandler_cls.SERVICE.ScanAttributes, "r"),
+      cmd.SCAN_SUBJECTS: (reqhandler_cls.SERVICE.ScanSubjects, "r")
   }
 
   # Initialize nonce store for authentication.
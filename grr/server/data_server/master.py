@@ -2,7 +2,9 @@
 """Data master specific classes."""
 
 import threading
+import time
 import urlparse
+import uuid
 
 
 import ipaddr
@@ -151,6 +153,12 @@ class DataMaster(object):
                       " flag --port %i.", self.myself.Port(), myport, myport)
       raise DataMasterError("First server in Dataserver.server_list must be "
                             "the master.")
+    # Holds current rebalance operation.
+    self.rebalance = None
+    self.rebalance_pool = []
+    # Automatic rebalancing, see _MaybeRebalance().
+    self.last_auto_rebalance = time.time()
+    self.auto_rebalance_thread = None
     # Start database measuring thread.
     sleep = config.CONFIG["Dataserver.stats_frequency"]
     self.periodic_thread = utils.InterruptableThread(
@@ -158,9 +166,6 @@ class DataMaster(object):
         target=self._PeriodicThread,
         sleep_time=sleep)
     self.periodic_thread.start()
-    # Holds current rebalance operation.
-    self.rebalance = None
-    self.rebalance_pool = []
 
   def LoadMapping(self):
     return self.mapping
@@ -171,12 +176,78 @@ class DataMaster(object):
     num_components, avg_component = self.service.GetComponentInformation()
     state = rdf_data_server.DataServerState(
         size=self.service.Size(),
-        load=0,
+        load=self.service.Load(),
         status=ok,
         num_components=num_components,
         avg_component=avg_component)
     self.myself.UpdateState(state)
     self.service.SaveServerMapping(self.mapping)
+    self._MaybeRebalance()
+
+  def _MaybeRebalance(self):
+    """Starts rebalancing in the background if some server is overloaded."""
+    if not config.CONFIG["Dataserver.auto_rebalance"]:
+      return
+    if self.IsRebalancing() or not self.AllRegistered():
+      return
+    if (time.time() - self.last_auto_rebalance <
+        config.CONFIG["Dataserver.auto_rebalance_interval"]):
+      return
+    if not sutils.IsUnbalanced(
+        self.mapping, config.CONFIG["Dataserver.auto_rebalance_size_ratio"],
+        config.CONFIG["Dataserver.auto_rebalance_load_ratio"]):
+      return
+
+    new_mapping = rdf_data_server.DataServerMapping(
+        version=self.mapping.version + 1,
+        num_servers=self.mapping.num_servers,
+        pathing=self.mapping.pathing)
+    intervals = sutils.ComputeBalancedIntervals(self.mapping)
+    for server, interval in zip(self.mapping.servers, intervals):
+      new_mapping.servers.Append(
+          index=server.index,
+          address=server.address,
+          port=server.port,
+          state=server.state,
+          interval=interval)
+
+    reb = rdf_data_server.DataServerRebalance(
+        id=str(uuid.uuid4()), mapping=new_mapping)
+    if not self.SetRebalancing(reb):
+      logging.warning("Could not contact servers for rebalancing")
+      return
+    self.last_auto_rebalance = time.time()
+    self.auto_rebalance_thread = threading.Thread(
+        name="DataServer automatic rebalancing",
+        target=self._AutoRebalance)
+    self.auto_rebalance_thread.daemon = True
+    self.auto_rebalance_thread.start()
+
+  def _AutoRebalance(self):
+    """Runs the rebalance operation set by _MaybeRebalance()."""
+    reb = self.rebalance
+    logging.info("Starting automatic rebalance %s", reb.id)
+    if not self.FetchRebalanceInformation():
+      logging.warning("Could not get statistics for rebalance %s", reb.id)
+      return
+    if not sum(reb.moving):
+      logging.info("Rebalance %s does not need to move any data", reb.id)
+      self.CancelRebalancing()
+      return
+
+    # Files are copied while the data servers keep serving requests. The
+    # second copy only sends the files that changed during the first one, so
+    # that the changes missed by the commit are kept to a minimum.
+    for _ in range(2):
+      if not self.CopyRebalanceFiles():
+        logging.warning("Could not copy files for rebalance %s", reb.id)
+        return
+
+    if not self.RebalanceCommit():
+      logging.error("Could not commit rebalance %s, it can be recovered with "
+                    "the manager", reb.id)
+      return
+    logging.info("Automatic rebalance %s fully performed", reb.id)
 
   def _EnsureServerInMapping(self, server):
     """Ensure that the data server exists on the mapping."""
@@ -386,6 +457,7 @@ class DataMaster(object):
     mapping = self.rebalance.mapping
     for i, serv in enumerate(list(self.mapping.servers)):
       serv.interval = mapping.servers[i].interval
+    self.mapping.version = max(self.mapping.version, mapping.version)
     self.rebalance.mapping = self.mapping
     self.service.SaveServerMapping(self.mapping)
     # We can finally delete the temporary file, since we have succeeded.
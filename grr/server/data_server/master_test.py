@@ -43,6 +43,9 @@ class MockDataStoreService(object):
   def Size(self):
     return 0
 
+  def Load(self):
+    return 0
+
 
 class MockResponse(object):
 
@@ -242,6 +245,34 @@ class MasterTest(test_lib.GRRBaseTest):
     self.assertEqual(
         utils._FindServerInMapping(mapping, constants.MAX_RANGE), 3)
 
+  def testBalancedIntervals(self):
+    """Check that hot and oversized ranges get split."""
+    m = master.DataMaster(7000, self.mock_service)
+    mapping = m.LoadMapping()
+    for server, size, load in zip(mapping.servers, [100, 100, 100, 100],
+                                  [10, 10, 10, 10]):
+      server.state.size = size
+      server.state.load = load
+    self.assertFalse(utils.IsUnbalanced(mapping, 1.5, 2.0))
+
+    # Server 1 serves most of the requests.
+    mapping.servers[1].state.load = 90
+    self.assertTrue(utils.IsUnbalanced(mapping, 1.5, 2.0))
+
+    intervals = utils.ComputeBalancedIntervals(mapping)
+    self.assertEqual(len(intervals), 4)
+    self.assertEqual(intervals[0].start, 0)
+    self.assertEqual(intervals[3].end, constants.MAX_RANGE)
+    for previous, interval in zip(intervals, intervals[1:]):
+      self.assertEqual(previous.end, interval.start)
+
+    # The hot range is split between servers 0, 1 and 2.
+    old = mapping.servers[1].interval
+    self.assertGreater(intervals[1].start, old.start)
+    self.assertLess(intervals[1].end, old.end)
+    self.assertGreater(intervals[0].end, old.start)
+    self.assertLess(intervals[2].start, old.end)
+
 
 def main(args):
   test_lib.main(args)
@@ -24,7 +24,10 @@ from grr.server.data_server import utils as sutils
 # Database files that cannot be copied.
 COPY_EXCEPTIONS = [store.BASE_MAP_SUBJECT]
 # Files that cannot be moved from inside the transaction directory.
-MOVE_EXCEPTIONS = [constants.TRANSACTION_FILENAME, constants.REMOVE_FILENAME]
+MOVE_EXCEPTIONS = [
+    constants.TRANSACTION_FILENAME, constants.REMOVE_FILENAME,
+    constants.COPY_STARTED_FILENAME
+]
 # Level of compression when moving Sqlite files.
 COMPRESSION_LEVEL = 3
 
@@ -174,7 +177,7 @@ def _FileWithRemoveList(database_dir, rebalance):
 
 
 def _RecCopyFiles(rebalance, server_id, dspath, subpath, pool_cache,
-                  removed_list):
+                  removed_list, modified_since=None):
   """Recursively send files for moving to the required data server."""
   fulldir = utils.JoinPath(dspath, subpath)
   mapping = rebalance.mapping
@@ -188,7 +191,7 @@ def _RecCopyFiles(rebalance, server_id, dspath, subpath, pool_cache,
     if os.path.isdir(path):
       result = _RecCopyFiles(rebalance, server_id, dspath,
                              utils.JoinPath(subpath, comp), pool_cache,
-                             removed_list)
+                             removed_list, modified_since=modified_since)
       if not result:
         return False
       continue
@@ -197,6 +200,11 @@ def _RecCopyFiles(rebalance, server_id, dspath, subpath, pool_cache,
     key = common.MakeDestinationKey(subpath, name)
     where = sutils.MapKeyToServer(mapping, key)
     if where != server_id:
+      if (modified_since is not None and
+          os.path.getmtime(path) < modified_since):
+        logging.info("File %s was already copied", path)
+        removed_list.append(path)
+        continue
       server = mapping.servers[where]
       addr = server.address
       port = server.port
@@ -216,15 +224,44 @@ def _RecCopyFiles(rebalance, server_id, dspath, subpath, pool_cache,
 
 
 def CopyFiles(rebalance, server_id):
-  """Copies data store files to the corresponding data servers."""
+  """Copies data store files to the corresponding data servers.
+
+  Files can be copied more than once for the same rebalance operation. After
+  the first time, only the files modified since the previous copy started are
+  sent again. This allows copying most of the data while still serving
+  requests and then catching up with the latest changes right before the
+  rebalance is committed.
+
+  Args:
+    rebalance: The DataServerRebalance object.
+    server_id: The index of this data server.
+
+  Returns:
+    True if all the files were copied.
+  """
   loc = data_store.DB.Location()
   if not os.path.exists(loc):
     return True
   if not os.path.isdir(loc):
     return True
+  tempdir = _CreateDirectory(loc, rebalance.id)
+  copy_started = utils.JoinPath(tempdir, constants.COPY_STARTED_FILENAME)
+  modified_since = None
+  if os.path.exists(copy_started):
+    modified_since = os.path.getmtime(copy_started)
+  # Touch the file, its modification time marks the start of this copy.
+  with open(copy_started, "wb"):
+    pass
   pool_cache = {}
   removed_list = []
-  ok = _RecCopyFiles(rebalance, server_id, loc, "", pool_cache, removed_list)
+  ok = _RecCopyFiles(
+      rebalance,
+      server_id,
+      loc,
+      "",
+      pool_cache,
+      removed_list,
+      modified_since=modified_since)
   if not ok:
     return False
   # Write list of removed files to temporary directory
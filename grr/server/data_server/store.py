@@ -43,6 +43,7 @@ def RPCWrapper(f):
   @functools.wraps(f)
   def Wrapper(self, request):
     """Wrap the function can catch exceptions, converting them to status."""
+    self.CountCommand()
     failed = True
     response = rdf_data_store.DataStoreResponse()
     response.status = rdf_data_store.DataStoreResponse.Status.OK
@@ -102,6 +103,33 @@ class DataStoreService(object):
     new_pathing = [r"(?P<path>" + BASE_MAP_SUBJECT + ")"] + old_pathing
     self.pathing = new_pathing
     self.db.RecreatePathing(self.pathing)
+    # Number of commands served, see Load().
+    self.load_lock = threading.Lock()
+    self.commands = 0
+    self.commands_since = time.time()
+    self.load = 0
+
+  def CountCommand(self):
+    with self.load_lock:
+      self.commands += 1
+
+  def Load(self):
+    """Returns the number of commands served per minute.
+
+    The rate is measured over periods of Dataserver.stats_frequency seconds,
+    so calling this more often returns the rate of the last full period.
+
+    Returns:
+      An integer.
+    """
+    with self.load_lock:
+      now = time.time()
+      elapsed = now - self.commands_since
+      if elapsed >= config.CONFIG["Dataserver.stats_frequency"]:
+        self.load = int(self.commands * 60 / elapsed)
+        self.commands = 0
+        self.commands_since = now
+      return self.load
 
   # Every service method must write to the response argument.
   # The response will then be serialized to a string.
@@ -195,6 +223,19 @@ class DataStoreService(object):
         encoded_results.append((attribute, (ts, self._Encode(value))))
       response.results.Append(subject=subject, payload=encoded_results)
 
+  @RPCWrapper
+  def ScanSubjects(self, request, response):
+    subject_prefix = request.subject[0]
+    after_urn = None
+    if len(request.subject) > 1:
+      after_urn = request.subject[1]
+    for subject in self.db.ScanSubjects(
+        subject_prefix,
+        after_urn=after_urn,
+        max_records=request.limit,
+        token=request.token):
+      response.results.Append(subject=subject)
+
   @RPCWrapper
   def DeleteAttributes(self, request, unused_response):
     """Delete attributes from a given subject."""
@@ -53,3 +53,90 @@ def MapKeyToServer(mapping, key):
   """Takes some key and returns the ID of the server."""
   hsh = int(hashlib.sha1(key).hexdigest()[:16], 16)
   return _FindServerInMapping(mapping, hsh)
+
+
+def _RangeCosts(servers):
+  """Estimates the cost of each server range from its size and load."""
+  total_size = sum(server.state.size for server in servers)
+  total_load = sum(server.state.load for server in servers)
+  costs = []
+  for server in servers:
+    cost = 0.0
+    if total_size:
+      cost += server.state.size / float(total_size)
+    if total_load:
+      cost += server.state.load / float(total_load)
+    costs.append(cost)
+  return costs
+
+
+def IsUnbalanced(mapping, size_ratio, load_ratio):
+  """Checks if some server holds too much data or serves too many requests.
+
+  Args:
+    mapping: A DataServerMapping with up to date server states.
+    size_ratio: A server is oversized if its size is over size_ratio times the
+      average size.
+    load_ratio: A server is hot if its load is over load_ratio times the
+      average load.
+
+  Returns:
+    True if there is an oversized or hot server.
+  """
+  servers = list(mapping.servers)
+  if len(servers) < 2:
+    return False
+  sizes = [server.state.size for server in servers]
+  loads = [server.state.load for server in servers]
+  average_size = sum(sizes) / float(len(servers))
+  average_load = sum(loads) / float(len(servers))
+  if average_size and max(sizes) > size_ratio * average_size:
+    return True
+  if average_load and max(loads) > load_ratio * average_load:
+    return True
+  return False
+
+
+def ComputeBalancedIntervals(mapping):
+  """Splits the hash range so that every server gets the same cost.
+
+  The cost of a server is its share of the total size plus its share of the
+  total load. It is assumed to be spread uniformly over the server's current
+  interval, so oversized or hot intervals are split and their parts move to
+  the neighbouring servers.
+
+  Args:
+    mapping: A DataServerMapping with up to date server states.
+
+  Returns:
+    A list of DataServerInterval, one for each server of the mapping.
+  """
+  servers = list(mapping.servers)
+  costs = _RangeCosts(servers)
+  total_cost = sum(costs)
+  if not total_cost:
+    return [server.interval for server in servers]
+
+  target = total_cost / len(servers)
+  boundaries = [0]
+  accumulated = 0.0
+  for server, cost in zip(servers, costs):
+    start = server.interval.start
+    width = server.interval.end - start
+    # Place all the boundaries that fall within this interval.
+    while (len(boundaries) < len(servers) and
+           accumulated + cost >= target * len(boundaries)):
+      needed = target * len(boundaries) - accumulated
+      offset = int(width * (needed / cost)) if cost else 0
+      boundaries.append(max(boundaries[-1], start + offset))
+    accumulated += cost
+
+  while len(boundaries) < len(servers):
+    boundaries.append(constants.MAX_RANGE)
+  boundaries.append(constants.MAX_RANGE)
+
+  return [
+      rdf_data_server.DataServerInterval(
+          start=boundaries[i], end=boundaries[i + 1])
+      for i in range(len(servers))
+  ]
@@ -14,6 +14,7 @@ import threading
 import logging
 
 from grr import config
+from grr.lib import data_store
 from grr.lib import registry
 from grr.lib import stats
 from grr.lib import utils
@@ -64,6 +65,23 @@ def BuildVarzJsonString():
   return encoder.encode(results)
 
 
+def BuildHotSubjectsJsonString():
+  """Builds a JSON string listing the data store subjects accessed the most.
+
+  Returns:
+    The JSON string, or None if the data store doesn't track its subjects.
+  """
+  hot_subjects = getattr(data_store.DB, "HotSubjects", None)
+  if hot_subjects is None:
+    return None
+
+  encoder = json.JSONEncoder()
+  return encoder.encode([
+      dict(subject=subject, accesses=accesses)
+      for subject, accesses in hot_subjects()
+  ])
+
+
 class StatsServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   """Default stats server implementation."""
 
@@ -74,6 +92,17 @@ class StatsServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       self.end_headers()
 
       self.wfile.write(BuildVarzJsonString())
+    elif self.path == "/datastore_hot_subjects":
+      hot_subjects = BuildHotSubjectsJsonString()
+      if hot_subjects is None:
+        self.send_error(404, "Data store is not instrumented.")
+        return
+
+      self.send_response(200)
+      self.send_header("Content-type", "application/json")
+      self.end_headers()
+
+      self.wfile.write(hot_subjects)
     else:
       self.send_error(403, "Access forbidden: %s" % self.path)
 
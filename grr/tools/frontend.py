@@ -374,6 +374,8 @@ def main(unused_argv):
     httpd.serve_forever()
   except KeyboardInterrupt:
     print "Caught keyboard interrupt, stopping"
+  finally:
+    httpd.frontend.Stop()
 
 
 if __name__ == "__main__":
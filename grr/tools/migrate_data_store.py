@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Copies the contents of another data store into the configured data store.
+
+The source data store is read with the same configuration, e.g. copying a
+SqliteDataStore into the HTTPDataStore uses Datastore.location for the source
+and Dataserver.server_list for the destination. An interrupted migration
+resumes from its checkpoint file when run again.
+"""
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import access_control
+from grr.lib import data_store
+from grr.lib import data_store_migration
+from grr.lib import flags
+from grr.lib import server_startup
+
+flags.DEFINE_string("source", None,
+                    "Implementation of the data store to copy from.")
+
+flags.DEFINE_string("checkpoint", None,
+                    "File recording the progress of the migration.")
+
+flags.DEFINE_list(
+    "boundaries", [],
+    "Subjects at which the keyspace is partitioned. Defaults to the first "
+    "characters of the subjects.")
+
+flags.DEFINE_integer("threads", 10,
+                     "Number of partitions copied at the same time.")
+
+flags.DEFINE_integer("batch_size", 1000,
+                     "Number of subjects written to the destination at once.")
+
+flags.DEFINE_bool("verify", False,
+                  "Compare the destination with the source once copied.")
+
+
+def main(unused_argv):
+  """Main."""
+  server_startup.Init()
+
+  if not flags.FLAGS.source:
+    print "No data store to copy from, use --source."
+    return
+
+  try:
+    cls = data_store.DataStore.GetPlugin(flags.FLAGS.source)
+  except KeyError:
+    print "No data store %s found." % flags.FLAGS.source
+    return
+
+  source = cls()
+  source.Initialize()
+
+  token = access_control.ACLToken(
+      username="GRRMigration", reason="Migrating the data store")
+  migration = data_store_migration.DataStoreMigration(
+      source,
+      data_store.DB,
+      checkpoint_path=flags.FLAGS.checkpoint,
+      boundaries=flags.FLAGS.boundaries,
+      threads=flags.FLAGS.threads,
+      batch_size=flags.FLAGS.batch_size,
+      token=token)
+
+  print "Copied %d subjects." % migration.Run()
+
+  if flags.FLAGS.verify:
+    mismatches = migration.Verify()
+    print "Verified %d subjects, %d differ." % (migration.subjects,
+                                                len(mismatches))
+    for subject in mismatches:
+      print subject
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Replays recorded data store traffic against the configured data store.
+
+Traces are recorded by setting Datastore.implementation to RecordingDataStore
+on the frontends and workers. Replaying them against a data store shows the
+throughput and latencies it achieves for that traffic.
+"""
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import access_control
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import server_startup
+
+from grr.lib.data_stores import recording_data_store
+
+flags.DEFINE_list("traces", [], "Trace files to replay together.")
+
+flags.DEFINE_float(
+    "speed", 1.0, "How much faster than recorded the calls are replayed. 0 "
+    "replays them as fast as possible.")
+
+
+def main(unused_argv):
+  """Main."""
+  server_startup.Init()
+
+  if not flags.FLAGS.traces:
+    print "No traces to replay, use --traces."
+    return
+
+  token = access_control.ACLToken(
+      username="GRRReplay", reason="Replaying data store traffic")
+  replayer = recording_data_store.TraceReplayer(
+      data_store.DB, flags.FLAGS.traces, speed=flags.FLAGS.speed, token=token)
+  print replayer.Run()
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
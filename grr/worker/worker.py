@@ -17,6 +17,10 @@ from grr.lib import flags
 from grr.lib import server_startup
 from grr.lib import worker
 
+flags.DEFINE_integer("worker_process_index", None,
+                     "Set by the worker supervisor on the worker processes it "
+                     "starts.")
+
 
 def main(unused_argv):
   """Main."""
@@ -27,8 +31,24 @@ def main(unused_argv):
   server_startup.Init()
 
 
+  num_processes = config.CONFIG["Worker.processes"]
+  process_index = flags.FLAGS.worker_process_index
+  if num_processes > 1:
+    worker.InterruptOnSigterm()
+
+  if num_processes > 1 and process_index is None:
+    worker.WorkerSupervisor(num_processes).Run()
+    return
+
   token = access_control.ACLToken(username="GRRWorker").SetUID()
-  worker_obj = worker.GRRWorker(token=token)
+
+  shard_leases = None
+  if process_index is not None:
+    shard_leases = worker.NotificationShardLeases(
+        process_index, num_processes, token=token)
+    shard_leases.Start()
+
+  worker_obj = worker.GRRWorker(shard_leases=shard_leases, token=token)
   worker_obj.Run()
 
 
@@ -2,6 +2,8 @@
 """Tests for the worker."""
 
 
+import os
+import sys
 import threading
 import time
 
@@ -18,6 +20,7 @@ from grr.lib import queue_manager
 from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import server_stubs
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib import worker
@@ -388,6 +391,126 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
         flow_obj.context.state == rdf_flows.FlowContext.State.TERMINATED)
     self.assertEqual(flow_obj.context.current_state, "End")
 
+  def testProcessSignalledShards(self):
+    """Test that the worker only reads the shards it was signalled about."""
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+    session_id = flow_obj.session_id
+    flow_obj.Close()
+
+    self.SendResponse(session_id, "Hello")
+
+    worker_obj = worker.GRRWorker(token=self.token)
+
+    # Signals for other queues do not pick up the notification.
+    worker_obj.RunOnce(queue_shards=[rdfvalue.RDFURN("aff4:/X")])
+    worker_obj.thread_pool.Join()
+    self.assertEqual(RESULTS, [])
+
+    manager = queue_manager.QueueManager(token=self.token)
+    worker_obj.RunOnce(
+        queue_shards=manager.GetAllNotificationShards(session_id.Queue()))
+    worker_obj.thread_pool.Join()
+    self.assertEqual(RESULTS, ["Hello"])
+
+  def testProcessLeasedShards(self):
+    """Test that the worker only reads the shards it holds leases for."""
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+    session_id = flow_obj.session_id
+    flow_obj.Close()
+
+    self.SendResponse(session_id, "Hello")
+
+    shard_leases = worker.NotificationShardLeases(0, 1, token=self.token)
+    worker_obj = worker.GRRWorker(shard_leases=shard_leases, token=self.token)
+
+    # No leases yet.
+    worker_obj.RunOnce()
+    worker_obj.thread_pool.Join()
+    self.assertEqual(RESULTS, [])
+
+    shard_leases.Renew()
+    worker_obj.RunOnce()
+    worker_obj.thread_pool.Join()
+    self.assertEqual(RESULTS, ["Hello"])
+    shard_leases.Stop()
+
+  def testProcessMessagesWithPrefetching(self):
+    """Test that flows are processed correctly when prefetched in batches."""
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow")
+    session_id_1 = flow_obj.session_id
+    flow_obj.Close()
+
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+    session_id_2 = flow_obj.session_id
+    flow_obj.Close()
+
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+    session_id_3 = flow_obj.session_id
+    flow_obj.Close()
+
+    for i in range(1, 4):
+      self.SendResponse(session_id_1, "Hello1.%d" % i, request_id=i)
+    self.SendResponse(session_id_2, "Hello2")
+    self.SendResponse(session_id_3, "Hello3")
+
+    prefetched_flows = stats.STATS.GetMetricValue("worker_prefetched_flows")
+    with test_lib.ConfigOverrider({"Worker.prefetch_batch_size": 2}):
+      worker_obj = worker.GRRWorker(token=self.token)
+
+      # A flow which is locked by someone else is left alone.
+      with aff4.FACTORY.OpenWithLock(session_id_3, token=self.token):
+        worker_obj.RunOnce()
+        worker_obj.thread_pool.Join()
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("worker_prefetched_flows"),
+        prefetched_flows + 2)
+    self.assertEqual(
+        sorted(RESULTS), ["Hello1.1", "Hello1.2", "Hello1.3", "Hello2"])
+
+    # The processed requests are gone.
+    outstanding_requests = list(
+        data_store.DB.ReadRequestsAndResponses(session_id_1, token=self.token))
+    self.assertEqual(len(outstanding_requests), 7)
+
+    flow_obj = aff4.FACTORY.Open(session_id_2, token=self.token)
+    self.assertEqual(flow_obj.context.state,
+                     rdf_flows.FlowContext.State.TERMINATED)
+    flow_obj = aff4.FACTORY.Open(session_id_3, token=self.token)
+    self.assertEqual(flow_obj.context.state,
+                     rdf_flows.FlowContext.State.RUNNING)
+
+  def testPrefetchedFlowLeaseIsRenewed(self):
+    """Test that prefetched flows are only processed if their lease is valid."""
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow")
+    session_id_1 = flow_obj.session_id
+    flow_obj.Close()
+
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+    session_id_2 = flow_obj.session_id
+    flow_obj.Close()
+
+    self.SendResponse(session_id_1, "Hello1", request_id=1)
+    self.SendResponse(session_id_2, "Hello2")
+
+    update_lease = aff4.AFF4Object.UpdateLease
+    renewed = []
+
+    def UpdateLease(obj, duration):
+      renewed.append(obj.urn)
+      if obj.urn == session_id_2:
+        raise aff4.LockError("Lease expired.")
+      return update_lease(obj, duration)
+
+    with test_lib.ConfigOverrider({"Worker.prefetch_batch_size": 2}):
+      worker_obj = worker.GRRWorker(token=self.token)
+      with utils.Stubber(aff4.AFF4Object, "UpdateLease", UpdateLease):
+        worker_obj.RunOnce()
+        worker_obj.thread_pool.Join()
+
+    self.assertEqual(sorted(renewed), sorted([session_id_1, session_id_2]))
+    self.assertEqual(RESULTS, ["Hello1"])
+
   def testNoNotificationRescheduling(self):
     """Test that no notifications are rescheduled when a flow raises."""
 
@@ -1169,6 +1292,118 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
     self.assertIn("Out of CPU quota", errors[1].backtrace)
 
 
+class NotificationShardLeasesTest(test_lib.GRRBaseTest):
+  """Tests for the notification shard leases of worker processes."""
+
+  def _GetIndexes(self, shard_leases):
+    with shard_leases.lock:
+      return sorted(shard_leases.leases)
+
+  def testShardsAreDivided(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 5}):
+      leases_0 = worker.NotificationShardLeases(0, 2, token=self.token)
+      leases_1 = worker.NotificationShardLeases(1, 2, token=self.token)
+      leases_0.Renew()
+      leases_1.Renew()
+
+      self.assertEqual(self._GetIndexes(leases_0), [0, 1, 2])
+      self.assertEqual(self._GetIndexes(leases_1), [3, 4])
+
+      self.assertEqual(
+          leases_1.GetQueueShards([queues.FLOWS]),
+          [queues.FLOWS.Add("3"), queues.FLOWS.Add("4")])
+      self.assertEqual(
+          leases_0.GetQueueShards([queues.FLOWS])[0], queues.FLOWS)
+
+  def testShardsAreRebalancedWhenWorkersDie(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 5}):
+      with test_lib.FakeTime(1000):
+        leases_0 = worker.NotificationShardLeases(
+            0, 2, lease_time=60, token=self.token)
+        leases_1 = worker.NotificationShardLeases(
+            1, 2, lease_time=60, token=self.token)
+        leases_0.Renew()
+        leases_1.Renew()
+
+      with test_lib.FakeTime(1040):
+        leases_0.Renew()
+
+      # Worker 1 stopped renewing, once its leases expire worker 0 takes over
+      # all shards.
+      with test_lib.FakeTime(1080):
+        leases_0.Renew()
+        self.assertEqual(self._GetIndexes(leases_0), [0, 1, 2, 3, 4])
+
+        # A restarted worker gets its share back.
+        leases_1 = worker.NotificationShardLeases(
+            1, 2, lease_time=60, token=self.token)
+        leases_1.Renew()
+        self.assertEqual(self._GetIndexes(leases_1), [])
+
+        leases_0.Renew()
+        leases_1.Renew()
+        self.assertEqual(self._GetIndexes(leases_0), [0, 1, 2])
+        self.assertEqual(self._GetIndexes(leases_1), [3, 4])
+
+      leases_1.Stop()
+      leases_0.Renew()
+      self.assertEqual(self._GetIndexes(leases_0), [0, 1, 2, 3, 4])
+
+
+class WorkerSupervisorTest(test_lib.GRRBaseTest):
+  """Tests for the WorkerSupervisor."""
+
+  def testExitedProcessesAreRestarted(self):
+    supervisor = worker.WorkerSupervisor(
+        2, command=[sys.executable, "-c", "pass"])
+    supervisor.RESTART_DELAY = 0
+
+    restarts = stats.STATS.GetMetricValue("worker_process_restarts")
+    try:
+      supervisor.CheckProcesses()
+      self.assertEqual(len(supervisor.processes), 2)
+      first_processes = supervisor.processes.values()
+      for process in first_processes:
+        process.wait()
+
+      supervisor.CheckProcesses()
+      for process in first_processes:
+        self.assertNotIn(process, supervisor.processes.values())
+    finally:
+      supervisor.Stop()
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("worker_process_restarts"), restarts + 2)
+
+  def testStoppedProcessesAreInterrupted(self):
+    ready_path = os.path.join(self.temp_dir, "ready")
+    script = """
+import sys
+import time
+from grr.lib import worker
+worker.InterruptOnSigterm()
+open(%r, "w").close()
+try:
+  time.sleep(600)
+except KeyboardInterrupt:
+  sys.exit(3)
+""" % ready_path
+
+    supervisor = worker.WorkerSupervisor(
+        1, command=[sys.executable, "-c", script])
+    try:
+      supervisor.CheckProcesses()
+      process = supervisor.processes[0]
+      deadline = time.time() + 60
+      while not os.path.exists(ready_path) and time.time() < deadline:
+        time.sleep(0.1)
+    finally:
+      supervisor.Stop()
+
+    # The process was interrupted, so it could release its shard leases.
+    self.assertEqual(process.returncode, 3)
+
+
 def main(_):
   test_lib.main()
 